@@ -1,7 +1,7 @@
-from .multinomial import multinomial_sampling as multinomial_sampling_cython
-from .sampling import sampling_sameCov_chols
+from .multinomial import multinomial_sampling as multinomial_sampling_cython, alias_tables, alias_sampling
+from .sampling import sampling_sameCov_chols, sampling_Covs, sampling_streams_chols
 from .noise_em import (sigma_step_full_NoIS, sigma_step_diag_NoIS, mu_step_NoIS,
-                       mu_step_diag_IS, mu_step_full_IS,
+                       mu_step_IS, mu_step_diag_IS, mu_step_full_IS,
                        sigma_step_diag_IS, sigma_step_full_IS, mu_step_diag_IS_i, mu_step_full_IS_i,
                        test)
 
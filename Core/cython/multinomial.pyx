@@ -1,5 +1,7 @@
 cimport cython
+cimport openmp
 cimport numpy as np
+import multiprocessing
 import numpy as np
 from cython.parallel import prange
 
@@ -71,7 +73,7 @@ def multinomial_sampling(const double[:,:] weights, int size):
     cumweights = np.cumsum(weights,axis=1)
     alea = np.random.random_sample((N,size))
 
-    out = np.empty((N,size),dtype=np.int)
+    out = np.empty((N,size),dtype=long)
     cdef long[:,:] out_view = out
     cdef double[:,:] S = cumweights
     cdef double[:,:] A = alea
@@ -87,4 +89,108 @@ def multinomial_sampling(const double[:,:] weights, int size):
             while k < K and current_alea > S[n,k]:
                 k = k + 1
             out_view[n,i] = k
-    return out
\ No newline at end of file
+    return out
+
+# ---------------------------------- Alias method (Walker / Vose) ---------------------------------- #
+
+cdef int NUM_THREADS = multiprocessing.cpu_count()
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def alias_tables(const double[:,:] weights, int num_threads = 0):
+#    """Builds alias tables (Vose algorithm) for each row of weights (shape N,K), in O(K) per row.
+#    Weights don't need to be normalized.
+#
+#    :return: probs (shape N,K, float), aliases (shape N,K, int)
+#    """
+    cdef Py_ssize_t N = weights.shape[0]
+    cdef Py_ssize_t K = weights.shape[1]
+
+    if num_threads <= 0:
+        num_threads = NUM_THREADS
+
+    probs = np.empty((N, K))
+    aliases = np.empty((N, K), dtype=long)
+    cdef double[:,:] probs_view = probs
+    cdef long[:,:] aliases_view = aliases
+    cdef long[:,:] smalls = np.empty((num_threads, K), dtype=long)
+    cdef long[:,:] larges = np.empty((num_threads, K), dtype=long)
+
+    cdef Py_ssize_t n, k, nb_small, nb_large, thread_number
+    cdef long s, l
+    cdef double total
+
+    for n in prange(N, nogil=True, num_threads=num_threads, schedule='static'):
+        thread_number = openmp.omp_get_thread_num()
+        total = 0
+        for k in range(K):
+            total = total + weights[n, k]
+
+        nb_small = 0
+        nb_large = 0
+        for k in range(K):
+            probs_view[n, k] = weights[n, k] * K / total
+            aliases_view[n, k] = k
+            if probs_view[n, k] < 1:
+                smalls[thread_number, nb_small] = k
+                nb_small = nb_small + 1
+            else:
+                larges[thread_number, nb_large] = k
+                nb_large = nb_large + 1
+
+        while nb_small > 0 and nb_large > 0:
+            nb_small = nb_small - 1
+            nb_large = nb_large - 1
+            s = smalls[thread_number, nb_small]
+            l = larges[thread_number, nb_large]
+            aliases_view[n, s] = l
+            probs_view[n, l] = probs_view[n, l] + probs_view[n, s] - 1
+            if probs_view[n, l] < 1:
+                smalls[thread_number, nb_small] = l
+                nb_small = nb_small + 1
+            else:
+                larges[thread_number, nb_large] = l
+                nb_large = nb_large + 1
+
+        # remaining columns are full (up to rounding errors)
+        while nb_large > 0:
+            nb_large = nb_large - 1
+            probs_view[n, larges[thread_number, nb_large]] = 1
+        while nb_small > 0:
+            nb_small = nb_small - 1
+            probs_view[n, smalls[thread_number, nb_small]] = 1
+
+    return probs, aliases
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def alias_sampling(const double[:,:] probs, const long[:,:] aliases, int size, int num_threads = 0):
+#    """Draws size labels per row from alias tables (see alias_tables), in O(1) per draw.
+#
+#    :return: shape N,size
+#    """
+    cdef Py_ssize_t N = probs.shape[0]
+    cdef Py_ssize_t K = probs.shape[1]
+
+    if num_threads <= 0:
+        num_threads = NUM_THREADS
+
+    alea = np.random.random_sample((N, size))
+    out = np.empty((N, size), dtype=long)
+    cdef long[:,:] out_view = out
+    cdef double[:,:] A = alea
+
+    cdef Py_ssize_t n, i
+    cdef long k
+    cdef double x
+
+    for n in prange(N, nogil=True, num_threads=num_threads, schedule='static'):
+        for i in range(size):
+            x = A[n, i] * K
+            k = <long> x
+            if x - k >= probs[n, k]:
+                k = aliases[n, k]
+            out_view[n, i] = k
+    return out
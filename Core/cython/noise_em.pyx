@@ -10,8 +10,8 @@ from cython cimport view
 
 include "probas.pyx"
 
-cdef Py_ssize_t NUM_THREADS = multiprocessing.cpu_count()
-if NUM_THREADS > 0:
+cdef int NUM_THREADS = multiprocessing.cpu_count()
+if NUM_THREADS > 1:
     NUM_THREADS -= 1
 
 
@@ -208,36 +208,49 @@ cdef void _helper_mu(const double[:,:] X, const double[:] weights, const double[
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef void _run_C_mu_step_diag_IS(const double[:,:] Yobs, const double[:,:,:] Xs,
-                                    const double[:,:,:] meanss, const double[:,:] weightss,
-                                    const double[:,:,:] FXs, const long[:,:] mask,
-                                 const double[:] current_mean,
-                                    const double[:] current_cov, double[:,:] y_moins_mu_view,
-                                    double[:,:] log_p_tilde, const double[:,:,:] gllim_chol_covs,
-                                    double[:,:] tmp_mu, double[:] maximal_mu, double[:,:] ws,
-                                    double[:,:,:] tmp_KNs, double[:,:,:] tmp_KL) nogil:
+cdef void _run_mu_step_IS(const double[:,:] Yobs, const double[:,:,:] Xs,
+                          const double[:,:,:] meanss, const double[:,:] weightss,
+                          const double[:,:,:] FXs, const long[:,:] mask, const double[:] current_mean,
+                          bint diag, const double[:] current_cov, const double[:,:] current_cov_chol,
+                          const double[:,:,:] gllim_chol_covs, double[:] maximal_mu, double[:,:] ws,
+                          double[:,:] y_moins_mu_view, double[:,:] log_p_tilde, double[:,:] tmp_mu,
+                          double[:,:] acc_mu, double[:,:,:] tmp_KNs, double[:,:,:] tmp_KL,
+                          int num_threads) nogil:
+    """All observations in one parallel region. Buffers first dimension is num_threads :
+    each thread sums its esp_mu in acc_mu, reduced at the end."""
     cdef Py_ssize_t Ny = FXs.shape[0]
-    cdef Py_ssize_t Ns = FXs.shape[1]
     cdef Py_ssize_t D =  FXs.shape[2]
 
-    cdef Py_ssize_t i, d, thread_number, ns
+    cdef Py_ssize_t i, d, t, thread_number
+
+    for t in range(num_threads):
+        for d in range(D):
+            acc_mu[t,d] = 0
 
-    for i in prange(Ny, nogil=True, num_threads=NUM_THREADS):
+    for i in prange(Ny, nogil=True, num_threads=num_threads, schedule='static'):
         thread_number = openmp.omp_get_thread_num()
 
         for d in range(D):
             y_moins_mu_view[thread_number,d] = Yobs[i,d] - current_mean[d]
 
-        loggauspdf_diag(FXs[i],y_moins_mu_view[thread_number], current_cov, log_p_tilde[thread_number])
+        if diag:
+            loggauspdf_diag(FXs[i], y_moins_mu_view[thread_number], current_cov, log_p_tilde[thread_number])
+        else:
+            chol_loggausspdf_precomputed(FXs[i], y_moins_mu_view[thread_number], current_cov_chol,
+                                         log_p_tilde[thread_number], tmp_mu[thread_number])
 
         _helper_mu(Xs[i], weightss[i], meanss[i], gllim_chol_covs, log_p_tilde[thread_number],
                    FXs[i], mask[i], Yobs[i], tmp_mu[thread_number], ws[i],
                    tmp_KNs[thread_number], tmp_KL[thread_number])
 
-        for d in range(D):
-            maximal_mu[d] += tmp_mu[thread_number,d]
+        for d in range(D):  # no in-place operator : it would be a reduction
+            acc_mu[thread_number,d] = acc_mu[thread_number,d] + tmp_mu[thread_number,d]
 
-    scalar_mult_vect(1. / Ny,maximal_mu)
+    for d in range(D):
+        maximal_mu[d] = 0
+        for t in range(num_threads):
+            maximal_mu[d] += acc_mu[t,d]
+        maximal_mu[d] /= Ny
 
 
 def mu_step_diag_IS_i(np.ndarray yobs, const double[:,:] X,const double[:,:] means,
@@ -271,71 +284,6 @@ def mu_step_diag_IS_i(np.ndarray yobs, const double[:,:] X,const double[:,:] mea
     return np.asarray(tmp_mu), np.asarray(wsi)
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef void _run_C_mu_step_diag_IS_nopara(const double[:,:] Yobs, const double[:,:,:] Xs,
-                                    const double[:,:,:] meanss, const double[:,:] weightss,
-                                    const double[:,:,:] FXs, const long[:,:] mask,
-                                        const double[:] current_mean,
-                                    const double[:] current_cov, double[:] y_moins_mu_view,
-                                    double[:] log_p_tilde, double[:,:,:] gllim_chol_covs,
-                                    double[:] tmp_mu, double[:] maximal_mu, double[:,:] ws,
-                                    double[:,:] tmp_KNs, double[:,:] tmp_KL) nogil:
-    cdef Py_ssize_t Ny = FXs.shape[0]
-    cdef Py_ssize_t Ns = FXs.shape[1]
-    cdef Py_ssize_t D =  FXs.shape[2]
-
-    cdef Py_ssize_t i, d, ns
-
-    for i in range(Ny):
-
-        for d in range(D):
-            y_moins_mu_view[d] = Yobs[i,d] - current_mean[d]
-
-        loggauspdf_diag(FXs[i],y_moins_mu_view, current_cov, log_p_tilde)
-
-        _helper_mu(Xs[i], weightss[i], meanss[i], gllim_chol_covs, log_p_tilde,
-                   FXs[i], mask[i], Yobs[i], tmp_mu, ws[i],
-                   tmp_KNs, tmp_KL)
-
-        for d in range(D):
-            maximal_mu[d] += tmp_mu[d]
-
-    scalar_mult_vect(1. / Ny,maximal_mu)
-
-@cython.boundscheck(False)
-@cython.wraparound(False)
-cdef void _run_C_mu_step_full_IS(const double[:,:] Yobs, const double[:,:,:] Xs,
-                                    const double[:,:,:] meanss, const double[:,:] weightss,
-                                    const double[:,:,:] FXs, const long[:,:] mask,
-                                    const double[:,:,:] gllim_covs, const double[:] current_mean,
-                                    const double[:,:] current_cov, double[:,:] y_moins_mu_view,
-                                    double[:,:] log_p_tilde, double[:,:,:] gllim_chol_covs,
-                                    double[:,:] tmp_mu, double[:] maximal_mu, double[:,:] ws,
-                                    double[:,:,:] tmp_KNs, double[:,:,:] tmp_KL) nogil:
-    cdef Py_ssize_t Ny = FXs.shape[0]
-    cdef Py_ssize_t D =  FXs.shape[2]
-
-    cdef Py_ssize_t i, d, thread_number
-
-    for i in prange(Ny, nogil=True, num_threads=NUM_THREADS, schedule='static'):
-        thread_number = openmp.omp_get_thread_num()
-
-        for d in range(D):
-            y_moins_mu_view[thread_number,d] = Yobs[i,d] - current_mean[d]
-
-        chol_loggausspdf_precomputed(FXs[i],y_moins_mu_view[thread_number],current_cov, log_p_tilde[thread_number],
-                                     tmp_mu[thread_number])
-        _helper_mu(Xs[i], weightss[i], meanss[i], gllim_chol_covs, log_p_tilde[thread_number],
-                   FXs[i], mask[i], Yobs[i], tmp_mu[thread_number], ws[i],
-                   tmp_KNs[thread_number], tmp_KL[thread_number])
-
-        for d in range(D):
-            maximal_mu[d] += tmp_mu[thread_number,d]
-
-    scalar_mult_vect(1. / Ny,maximal_mu)
-
-
 def mu_step_full_IS_i(np.ndarray yobs, const double[:,:] X,const double[:,:] means,
                       const double[:] weights, const double[:,:] FX, const long[:] mask_x,
                       np.ndarray current_mean, const double[:,:] current_cov_chol,
@@ -437,81 +385,58 @@ def sigma_step_diag_NoIS(const double[:,:] Yobs, const double[:,:,:] FXs, const
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def mu_step_diag_IS(const double[:,:] Yobs, const double[:,:,:] Xs, const double[:,:,:] meanss,
-                    const double[:,:] weightss, const double[:,:,:] FXs, const long[:,:] mask,
-                    const double[:,:,:] gllim_covs, const double[:] current_mean,
-                    const double[:] current_cov, parallel=True):
+def mu_step_IS(const double[:,:] Yobs, const double[:,:,:] Xs, const double[:,:,:] meanss,
+               const double[:,:] weightss, const double[:,:,:] FXs, const long[:,:] mask,
+               gllim_covs, const double[:] current_mean, current_cov, int num_threads = 0):
+    """Mu step with IS for all observations, in one parallel region with thread-local accumulators.
+    current_cov is diagonal (shape D) or full (shape D,D).
+    num_threads : 0 for all available cores, 1 for sequential.
+    Returns maximal_mu (shape D) and weights ws (shape Ny,Ns)"""
     cdef Py_ssize_t Ny = FXs.shape[0]
     cdef Py_ssize_t Ns = FXs.shape[1]
     cdef Py_ssize_t D =  FXs.shape[2]
-    cdef Py_ssize_t K =  gllim_covs.shape[0]
-    cdef Py_ssize_t L =  gllim_covs.shape[1]
+    cdef Py_ssize_t K =  meanss.shape[1]
+    cdef Py_ssize_t L =  meanss.shape[2]
+
+    if num_threads <= 0:
+        num_threads = NUM_THREADS
 
+    current_cov = np.asarray(current_cov, dtype=np.double)
+    diag = current_cov.ndim == 1
+    current_cov_diag = current_cov if diag else np.zeros(D)
+    current_cov_chol = np.zeros((1, 1)) if diag else np.linalg.cholesky(current_cov)
+    gllim_chol_covs = np.linalg.cholesky(np.asarray(gllim_covs, dtype=np.double))
 
     ws = np.zeros((Ny,Ns))
     maximal_mu = np.zeros(D)
-    gllim_chol_covs = np.zeros((K, L, L))
-    for k in range(K):
-        gllim_chol_covs[k] = np.linalg.cholesky(gllim_covs[k])
-
-
-    if parallel:
-        tmp_mu = np.zeros((NUM_THREADS,D))
-        log_p_tilde = np.zeros((NUM_THREADS,Ns))
-        tmp_KNs = np.zeros((NUM_THREADS, K,Ns))
-        tmp_KL = np.zeros((NUM_THREADS, K,L))
-        y_moins_mu = np.zeros((NUM_THREADS,D))
-        _run_C_mu_step_diag_IS(Yobs, Xs, meanss, weightss, FXs, mask,
-                               current_mean, current_cov,
-          y_moins_mu, log_p_tilde, gllim_chol_covs,
-          tmp_mu, maximal_mu, ws, tmp_KNs, tmp_KL)
-    else:
-        tmp_mu = np.zeros(D)
-        log_p_tilde = np.zeros(Ns)
-        tmp_KNs = np.zeros(( K,Ns))
-        tmp_KL = np.zeros(( K,L))
-        y_moins_mu = np.zeros(D)
-        _run_C_mu_step_diag_IS_nopara(Yobs, Xs, meanss, weightss, FXs, mask,
-                                      current_mean, current_cov,
-          y_moins_mu, log_p_tilde, gllim_chol_covs,
-          tmp_mu, maximal_mu, ws, tmp_KNs, tmp_KL)
+    tmp_mu = np.zeros((num_threads,D))
+    acc_mu = np.zeros((num_threads,D))
+    log_p_tilde = np.zeros((num_threads,Ns))
+    tmp_KNs = np.zeros((num_threads, K,Ns))
+    tmp_KL = np.zeros((num_threads, K,L))
+    y_moins_mu = np.zeros((num_threads,D))
+
+    _run_mu_step_IS(Yobs, Xs, meanss, weightss, FXs, mask, current_mean,
+                    diag, current_cov_diag, current_cov_chol, gllim_chol_covs, maximal_mu, ws,
+                    y_moins_mu, log_p_tilde, tmp_mu, acc_mu, tmp_KNs, tmp_KL, num_threads)
 
     return maximal_mu, ws
 
 
-@cython.boundscheck(False)
-@cython.wraparound(False)
-def mu_step_full_IS(const double[:,:] Yobs, const double[:,:,:] Xs, const double[:,:,:] meanss,
+def mu_step_diag_IS(const double[:,:] Yobs, const double[:,:,:] Xs, const double[:,:,:] meanss,
                     const double[:,:] weightss, const double[:,:,:] FXs, const long[:,:] mask,
                     const double[:,:,:] gllim_covs, const double[:] current_mean,
-                    const double[:,:] current_cov, parallel = None):
-    cdef Py_ssize_t Ny = FXs.shape[0]
-    cdef Py_ssize_t Ns = FXs.shape[1]
-    cdef Py_ssize_t D =  FXs.shape[2]
-    cdef Py_ssize_t K =  gllim_covs.shape[0]
-    cdef Py_ssize_t L =  gllim_covs.shape[1]
-
-    tmp_mu = np.zeros((NUM_THREADS,D))
-    ws = np.zeros((Ny,Ns))
-    maximal_mu = np.zeros(D)
-    log_p_tilde = np.zeros((NUM_THREADS,Ns))
-    tmp_KNs = np.zeros((NUM_THREADS, K,Ns))
-    tmp_KL = np.zeros((NUM_THREADS, K,L))
-    y_moins_mu = np.zeros((NUM_THREADS,D))
-
-    gllim_chol_covs = np.zeros((K, L, L))
-    for k in range(K):
-        gllim_chol_covs[k] = np.linalg.cholesky(gllim_covs[k])
-
-    current_cov_chol = np.linalg.cholesky(current_cov)
-
+                    const double[:] current_cov, parallel=True):
+    return mu_step_IS(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean, current_cov,
+                      num_threads=0 if parallel else 1)
 
-    _run_C_mu_step_full_IS(Yobs, Xs, meanss, weightss, FXs, mask,
-                              gllim_covs, current_mean, current_cov_chol,
-                              y_moins_mu, log_p_tilde, gllim_chol_covs,
-                              tmp_mu, maximal_mu, ws, tmp_KNs, tmp_KL)
 
-    return maximal_mu, ws
+def mu_step_full_IS(const double[:,:] Yobs, const double[:,:,:] Xs, const double[:,:,:] meanss,
+                    const double[:,:] weightss, const double[:,:,:] FXs, const long[:,:] mask,
+                    const double[:,:,:] gllim_covs, const double[:] current_mean,
+                    const double[:,:] current_cov, parallel = None):
+    return mu_step_IS(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean, current_cov,
+                      num_threads=1 if parallel is False else 0)
 
 
 def sigma_step_diag_IS(Yobs, FXs, ws, mask, maximal_mu):
@@ -0,0 +1 @@
+cdef void cholesky(const double[:,:] A, double[:,:] L) nogil
@@ -1,7 +1,16 @@
 cimport cython
+cimport openmp
 cimport numpy as np
+import multiprocessing
 import numpy as np
 from cython.parallel import prange
+from libc.math cimport sqrt, log
+from libc.stdint cimport uint64_t
+
+from .probas cimport cholesky
+
+cdef int NUM_THREADS = multiprocessing.cpu_count()
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -23,12 +32,13 @@ cdef void AdotBplusC(const double[:,:] A, const double[:] b, const double[:] c ,
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def sampling_sameCov_chols(const double[:,:,:] means_list, const long[:,:] clusters_list,
-                          const double[:,:,:] chols, const double[:,:] alea):
+                          const double[:,:,:] chols, const double[:,:] alea, out = None):
 #    """Samples from N Gaussian Mixture Models
 #
 #    :param means_list: shape N,K,L
 #    :param clusters_list: shape N,size
 #    :param covs_list: shape K,L,L
+#    :param out: shape N,size,L, allocated if None
 #    :return: shape N,size,L
 #    """
     cdef Py_ssize_t N = means_list.shape[0]
@@ -36,7 +46,8 @@ def sampling_sameCov_chols(const double[:,:,:] means_list, const long[:,:] clust
     cdef Py_ssize_t L = means_list.shape[2]
     cdef Py_ssize_t size = alea.shape[0]
 
-    out = np.zeros((N, size, L))
+    if out is None:
+        out = np.zeros((N, size, L))
     cdef double[:,:,:] out_view = out
 
     cdef Py_ssize_t n,s
@@ -47,4 +58,133 @@ def sampling_sameCov_chols(const double[:,:,:] means_list, const long[:,:] clust
             k = clusters_list[n][s]
 #            out_view[n, s] = dot(chols[k],alea[s]) + means[k]
             AdotBplusC(chols[k],alea[s],means_list[n][k],out_view[n,s])
-    return out
\ No newline at end of file
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sampling_Covs(const double[:,:,:] means_list, const long[:,:] clusters_list,
+                  const double[:,:,:,:] covs_list, const double[:,:] alea, double[:,:,:] out,
+                  int num_threads = 0):
+#    """Samples from N Gaussian Mixture Models with differents covariances, filling out (shape N,size,L)
+#    Each covariance is factorised once, and only if its cluster is drawn.
+#
+#    :param means_list: shape N,K,L
+#    :param clusters_list: shape N,size
+#    :param covs_list: shape N,K,L,L
+#    :param num_threads: 0 for all cores
+#    """
+    cdef Py_ssize_t N = means_list.shape[0]
+    cdef Py_ssize_t K = means_list.shape[1]
+    cdef Py_ssize_t L = means_list.shape[2]
+    cdef Py_ssize_t size = alea.shape[0]
+
+    if num_threads <= 0:
+        num_threads = NUM_THREADS
+    # upper parts are never written, so they stay null
+    cdef double[:,:,:,:] chols = np.zeros((num_threads, K, L, L))
+    cdef long[:,:] factorised = np.full((num_threads, K), -1, dtype=long)  # last n using this slot
+
+    cdef Py_ssize_t n, s, thread_number
+    cdef long k
+
+    for n in prange(N, nogil=True, num_threads=num_threads, schedule='static'):
+        thread_number = openmp.omp_get_thread_num()
+        for s in range(size):
+            k = clusters_list[n, s]
+            if factorised[thread_number, k] != n:
+                cholesky(covs_list[n, k], chols[thread_number, k])
+                factorised[thread_number, k] = n
+            AdotBplusC(chols[thread_number, k], alea[s], means_list[n, k], out[n, s])
+
+
+# ------------------------------------ Independent streams ------------------------------------ #
+# Each mixture n owns a xoshiro256** state (states[n], 4 words), updated in place.
+# The draws of mixture n only depend on its own state, so results don't depend on threads scheduling,
+# and sampling by chunks gives the same values as one big call.
+
+
+cdef inline uint64_t _rotl(const uint64_t x, int k) nogil:
+    return (x << k) | (x >> (64 - k))
+
+
+cdef inline uint64_t _next(uint64_t* s) nogil:
+    cdef uint64_t result = _rotl(s[1] * 5, 7) * 9
+    cdef uint64_t t = s[1] << 17
+    s[2] ^= s[0]
+    s[3] ^= s[1]
+    s[1] ^= s[2]
+    s[0] ^= s[3]
+    s[2] ^= t
+    s[3] = _rotl(s[3], 45)
+    return result
+
+
+cdef inline double _uniform(uint64_t* s) nogil:
+    """Uniform in [0,1), with 53 bits of randomness"""
+    return (_next(s) >> 11) * (1.0 / 9007199254740992.0)
+
+
+cdef inline void _normal_pair(uint64_t* s, double* out) nogil:
+    """Marsaglia polar method : writes two independent standard normals in out[0], out[1]"""
+    cdef double u, v, r
+    while True:
+        u = 2. * _uniform(s) - 1.
+        v = 2. * _uniform(s) - 1.
+        r = u * u + v * v
+        if r < 1. and r > 0.:
+            break
+    r = sqrt(-2. * log(r) / r)
+    out[0] = u * r
+    out[1] = v * r
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def sampling_streams_chols(const double[:,:,:] means_list, const double[:,:] weights_list,
+                           const double[:,:,:,:] chols, uint64_t[:,::1] states, double[:,:,:] out,
+                           int num_threads = 0):
+#    """Samples from N Gaussian Mixture Models, filling out (shape N,size,L)
+#
+#    :param means_list: shape N,K,L
+#    :param weights_list: shape N,K
+#    :param chols: shape 1,K,L,L (same covs) or N,K,L,L
+#    :param states: shape N,4, random states (modified in place)
+#    :param num_threads: 0 for all cores
+#    """
+    cdef Py_ssize_t N = means_list.shape[0]
+    cdef Py_ssize_t K = means_list.shape[1]
+    cdef Py_ssize_t L = means_list.shape[2]
+    cdef Py_ssize_t size = out.shape[1]
+    cdef bint same_cov = chols.shape[0] == 1
+
+    if num_threads <= 0:
+        num_threads = NUM_THREADS
+    # one more slot since normals come by pairs, and padding to keep threads on separate cache lines
+    cdef double[:,::1] alea = np.zeros((num_threads, L + 9))
+
+    cdef Py_ssize_t n, s, l, j, c, k, thread_number
+    cdef double u, acc, v
+
+    for n in prange(N, nogil=True, num_threads=num_threads, schedule='static'):
+        thread_number = openmp.omp_get_thread_num()
+        if same_cov:
+            c = 0
+        else:
+            c = n
+        for s in range(size):
+            u = _uniform(&states[n, 0])
+            k = 0
+            acc = weights_list[n, 0]
+            while k < K - 1 and u >= acc:
+                k = k + 1
+                acc = acc + weights_list[n, k]
+
+            for l in range(0, L, 2):
+                _normal_pair(&states[n, 0], &alea[thread_number, l])
+
+            for l in range(L):
+                v = means_list[n, k, l]
+                for j in range(l + 1):
+                    v = v + chols[c, k, l, j] * alea[thread_number, j]
+                out[n, s, l] = v
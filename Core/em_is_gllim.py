@@ -1,9 +1,12 @@
 """Implements a crossed EM - GLLiM algorith to evaluate noise in model.
 Diagonal covariance is assumed"""
+import functools
 import json
 import logging
 import multiprocessing
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import coloredlogs
 import numba as nb
@@ -11,7 +14,7 @@ import numpy as np
 from joblib import Parallel, delayed
 
 import hapke.cython
-from Core import cython
+from Core import cython, probas_helper
 from Core.gllim import jGLLiM
 from tools import context
 
@@ -22,6 +25,15 @@ init_X_precision_factor = 10
 maxIterGlliM = 100
 stoppingRatioGLLiM = 0.005
 
+WARM_START = True
+"""GLLiM steps start from the previous GLLiM step theta"""
+maxIterGlliMWarm = 20
+"""Max iterations for warm started GLLiM steps : the previous theta is already close to convergence"""
+
+TRAINING_REFRESH = None
+"""Noiseless training data (X, F(X)) is simulated once, only noise is drawn at each GLLiM step.
+If given, training data is simulated again every TRAINING_REFRESH iterations"""
+
 
 N_sample_IS = 100000
 
@@ -29,17 +41,81 @@ INIT_COV_NOISE = 0.005  # initial noise
 INIT_MEAN_NOISE = 0  # initial noise offset
 maxIter = 100
 
+CONVERGENCE_TOL = 1e-3
+"""Iterations with relative changes of noise mean and covariance below this count as converged.
+Mean change is relative to the noise standard deviation. None to always run maxIter iterations"""
+CONVERGENCE_PATIENCE = 3
+"""Number of consecutive converged iterations before stopping"""
+
 NO_IS = False
 """If it's True, dont use Importance sampling"""
 
 PARALLEL = True
-"""Uses cython parallel version for mu step with IS"""
+"""Uses cython parallel version for mu step with IS (one parallel region for all observations),
+instead of one joblib task per observation"""
+
+CHUNK_SIZE_IS = None
+"""If given, IS samples are drawn, evaluated and weighted by chunks of this size, and only running sums are kept
+(memory O(Ny * CHUNK_SIZE_IS) instead of O(Ny * N_sample_IS))"""
+
+ESS_TARGET = None
+"""If given, IS sample sizes are adapted to each observation : samples are drawn by batches of ADAPTIVE_BATCH_IS,
+until the effective sample size of the observation reaches ESS_TARGET (at most N_sample_IS samples)"""
+ADAPTIVE_BATCH_IS = 1000
+
+RECYCLING_GENERATIONS = None
+"""If given, IS samples (and their F values) of the last RECYCLING_GENERATIONS iterations (current included)
+are kept in a pool, and reweighted under the mixture of proposals (balance heuristic).
+Each iteration only draws N_sample_IS_fresh new samples (topped up to N_sample_IS samples in the pool)"""
+N_sample_IS_fresh = 10000
+
+SAMPLING_METHOD = "mc"
+"""Sampling of GLLiM posterior : 'mc', 'qmc' (randomised quasi-Monte Carlo, lower variance for the same
+number of F evaluations ; N_sample_IS should then be a power of 2) or 'streams' (one random stream per observation :
+chunked and adaptive steps then draw the same samples, whatever CHUNK_SIZE_IS or ADAPTIVE_BATCH_IS)"""
 
 WITH_THREADS = True
 """Uses threading backend for joblib"""
 
 N_JOBS = multiprocessing.cpu_count()
 
+
+class NoiseEMConfig:
+    """Parameters of a noise estimation. Missing parameters are taken from the module level values at creation,
+    so that concurrent estimations with different settings don't interfere."""
+
+    PARAMETERS = ("Ntrain", "K", "init_X_precision_factor", "maxIterGlliM", "stoppingRatioGLLiM", "WARM_START",
+                  "maxIterGlliMWarm", "TRAINING_REFRESH", "N_sample_IS", "INIT_COV_NOISE", "INIT_MEAN_NOISE",
+                  "maxIter", "CONVERGENCE_TOL", "CONVERGENCE_PATIENCE", "NO_IS", "PARALLEL", "CHUNK_SIZE_IS",
+                  "ESS_TARGET", "ADAPTIVE_BATCH_IS", "RECYCLING_GENERATIONS", "N_sample_IS_fresh",
+                  "SAMPLING_METHOD", "WITH_THREADS", "N_JOBS")
+
+    def __init__(self, **parameters):
+        unknown = set(parameters) - set(self.PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unknown noise estimation parameters : {unknown}")
+        module_values = globals()
+        for name in self.PARAMETERS:
+            setattr(self, name, parameters.get(name, module_values[name]))
+
+
+class TrainingCache:
+    """Noiseless training data (X, F(X)) shared by noise estimations on the same context. Thread safe."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        self._datas = {}
+
+    def get(self, cont, N):
+        key = (id(cont), N)
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:  # only one simulation by context
+            if key not in self._datas:
+                self._datas[key] = (cont, cont.get_data_training(N))  # keeps a reference : id stays valid
+            return self._datas[key][1]
+
 # ------------------------ Linear case ------------------------ #
 @nb.njit(cache=True)
 def _helper_mu_lin(y, F, K, inverse_current_cov, current_mean):
@@ -118,32 +194,37 @@ def _em_step_lin(F, Yobs, prior_cov, current_cov, current_mean):
     _sigma_step = _sigma_step_diag_lin if current_cov.ndim == 1 else _sigma_step_full_lin
     maximal_sigma = _sigma_step(F, K, esp_mu, maximal_mu)
     logging.debug(f"Noise covariance estimation done in {time.time()-ti:.3f} s")
-    return maximal_mu, maximal_sigma
+    return maximal_mu, maximal_sigma, {}
 
 
 # -------------------------- General case -------------------------- #
-def _init(cont: context.abstractHapkeModel):
-    gllim = jGLLiM(K, sigma_type="full", verbose=False)
-    Xtrain, Ytrain = cont.get_data_training(Ntrain)
-    Ytrain = cont.add_noise_data(Ytrain, covariance=INIT_COV_NOISE, mean=INIT_MEAN_NOISE)  # 0 offset
-
-    m = cont.get_X_uniform(K)
+def _init(cont: context.abstractHapkeModel, training=None, config=None):
+    """training is the noiseless data (X, F(X)). If None, it's simulated."""
+    config = config or NoiseEMConfig()
+    gllim = jGLLiM(config.K, sigma_type="full", verbose=False)
+    Xtrain, Ytrain = cont.get_data_training(config.Ntrain) if training is None else training
+    Ytrain = cont.add_noise_data(Ytrain, covariance=config.INIT_COV_NOISE, mean=config.INIT_MEAN_NOISE)  # 0 offset
+
+    m = cont.get_X_uniform(config.K)
     rho = np.ones(gllim.K) / gllim.K
-    precisions = init_X_precision_factor * np.array([np.eye(Xtrain.shape[1])] * gllim.K)
+    precisions = config.init_X_precision_factor * np.array([np.eye(Xtrain.shape[1])] * gllim.K)
     rnk = gllim._T_GMM_init(Xtrain, 'random',
                             weights_init=rho, means_init=m, precisions_init=precisions)
     gllim.fit(Xtrain, Ytrain, {"rnk": rnk}, maxIter=1)
     return gllim.theta
 
 
-def _gllim_step(cont: context.abstractHapkeModel, current_noise_cov, current_noise_mean, current_theta):
+def _gllim_step(cont: context.abstractHapkeModel, current_noise_cov, current_noise_mean, current_theta,
+                training=None, maxIter=None, config=None):
+    """training is the noiseless data (X, F(X)). If None, it's simulated."""
+    config = config or NoiseEMConfig()
     ti = time.time()
-    gllim = jGLLiM(K, sigma_type="full", stopping_ratio=stoppingRatioGLLiM)
-    Xtrain, Ytrain = cont.get_data_training(Ntrain)
+    gllim = jGLLiM(config.K, sigma_type="full", stopping_ratio=config.stoppingRatioGLLiM)
+    Xtrain, Ytrain = cont.get_data_training(config.Ntrain) if training is None else training
 
     Ytrain = cont.add_noise_data(Ytrain, covariance=current_noise_cov, mean=current_noise_mean)
 
-    gllim.fit(Xtrain, Ytrain, current_theta, maxIter=maxIterGlliM)
+    gllim.fit(Xtrain, Ytrain, current_theta, maxIter=config.maxIterGlliM if maxIter is None else maxIter)
     gllim.inversion()
     logging.debug(f"GLLiM step done in {time.time() -ti:.3f} s")
     return gllim
@@ -151,10 +232,11 @@ def _gllim_step(cont: context.abstractHapkeModel, current_noise_cov, current_noi
 
 # ------------------- WITHOUT IS ------------------- #
 
-def _em_step_NoIS(gllim, compute_Fs, get_X_mask, Yobs, current_cov, *args):
-    Xs = gllim.predict_sample(Yobs, nb_per_Y=N_sample_IS)
+def _em_step_NoIS(gllim, compute_Fs, get_X_mask, Yobs, current_cov, *args, config=None):
+    config = config or NoiseEMConfig()
+    Xs = gllim.predict_sample(Yobs, nb_per_Y=config.N_sample_IS, method=config.SAMPLING_METHOD)
     mask = get_X_mask(Xs)
-    logging.debug(f"Average ratio of F-non-compatible samplings : {mask.sum(axis=1).mean() / N_sample_IS:.5f}")
+    logging.debug(f"Average ratio of F-non-compatible samplings : {mask.sum(axis=1).mean() / config.N_sample_IS:.5f}")
     ti = time.time()
 
     FXs = compute_Fs(Xs, mask)
@@ -168,12 +250,14 @@ def _em_step_NoIS(gllim, compute_Fs, get_X_mask, Yobs, current_cov, *args):
     _sigma_step = cython.sigma_step_diag_NoIS if current_cov.ndim == 1 else cython.sigma_step_full_NoIS
     maximal_sigma = _sigma_step(Yobs, FXs, mask, maximal_mu)
     logging.debug(f"Noise covariance estimation done in {time.time()-ti:.3f} s")
-    return maximal_mu, maximal_sigma
+    return maximal_mu, maximal_sigma, {}
 
 
 # --------------------------------- WITH IS --------------------------------- #
 
-def mu_step_diag_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean, current_cov):
+def mu_step_diag_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean, current_cov,
+                           config=None):
+    config = config or NoiseEMConfig()
     Ny, Ns, D = FXs.shape
     K, L, _ = gllim_covs.shape
     gllim_chol_covs = np.zeros((K, L, L))
@@ -183,8 +267,8 @@ def mu_step_diag_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, cu
     maximal_mu = np.zeros(D)
     ws = np.zeros((Ny,Ns))
 
-    prefer = "threads" if WITH_THREADS else None
-    res = Parallel(n_jobs=N_JOBS, prefer=prefer)(delayed(cython.mu_step_diag_IS_i)(Yobs[i], Xs[i], meanss[i], weightss[i], FXs[i],
+    prefer = "threads" if config.WITH_THREADS else None
+    res = Parallel(n_jobs=config.N_JOBS, prefer=prefer)(delayed(cython.mu_step_diag_IS_i)(Yobs[i], Xs[i], meanss[i], weightss[i], FXs[i],
                                             mask[i], current_mean, current_cov,
                                             gllim_chol_covs) for i in range(Ny))
 
@@ -194,7 +278,9 @@ def mu_step_diag_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, cu
     return maximal_mu / Ny, ws
 
 
-def mu_step_full_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean, current_cov):
+def mu_step_full_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean, current_cov,
+                           config=None):
+    config = config or NoiseEMConfig()
     Ny, Ns, D = FXs.shape
     K, L, _ = gllim_covs.shape
     gllim_chol_covs = np.zeros((K, L, L))
@@ -205,8 +291,8 @@ def mu_step_full_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, cu
     maximal_mu = np.zeros(D)
     ws = np.zeros((Ny,Ns))
 
-    prefer = "threads" if WITH_THREADS else None
-    res = Parallel(n_jobs=N_JOBS, prefer=prefer)(delayed(cython.mu_step_full_IS_i)(Yobs[i], Xs[i], meanss[i], weightss[i], FXs[i],
+    prefer = "threads" if config.WITH_THREADS else None
+    res = Parallel(n_jobs=config.N_JOBS, prefer=prefer)(delayed(cython.mu_step_full_IS_i)(Yobs[i], Xs[i], meanss[i], weightss[i], FXs[i],
                                             mask[i], current_mean, current_cov_chol,
                                             gllim_chol_covs) for i in range(Ny))
 
@@ -217,18 +303,21 @@ def mu_step_full_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, cu
 
 
 def _log_sample_size(ws):
+    """Returns the effective sample size of each observation"""
     ws = np.copy(ws)
     mask = ~ np.isfinite(ws)
     ws[mask] = 0
 
     effective_sample_size = np.sum(ws, axis = 1) ** 2 / np.sum(np.square(ws), axis=1)
-    logging.debug("Effective mean sample size : {:.1f} / {}".format(effective_sample_size.mean(),N_sample_IS))
+    logging.debug("Effective mean sample size : {:.1f} / {}".format(effective_sample_size.mean(), ws.shape[1]))
+    return effective_sample_size
 
 
-def _em_step_IS(gllim, compute_Fs, get_X_mask, Yobs, current_cov, current_mean):
-    Xs = gllim.predict_sample(Yobs, nb_per_Y=N_sample_IS)
+def _em_step_IS(gllim, compute_Fs, get_X_mask, Yobs, current_cov, current_mean, config=None):
+    config = config or NoiseEMConfig()
+    Xs = gllim.predict_sample(Yobs, nb_per_Y=config.N_sample_IS, method=config.SAMPLING_METHOD)
     mask = get_X_mask(Xs)
-    logging.debug(f"Average ratio of F-non-compatible samplings : {mask.sum(axis=1).mean() / N_sample_IS:.5f}")
+    logging.debug(f"Average ratio of F-non-compatible samplings : {mask.sum(axis=1).mean() / config.N_sample_IS:.5f}")
     ti = time.time()
 
     meanss, weightss, _ = gllim._helper_forward_conditionnal_density(Yobs)
@@ -240,14 +329,17 @@ def _em_step_IS(gllim, compute_Fs, get_X_mask, Yobs, current_cov, current_mean):
 
     assert np.isfinite(FXs).all()
 
-    if current_cov.ndim == 1:
+    if config.PARALLEL:
+        maximal_mu, ws = cython.mu_step_IS(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean,
+                                           current_cov)
+    elif current_cov.ndim == 1:
         maximal_mu, ws = mu_step_diag_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean,
-                                                current_cov)
+                                                current_cov, config=config)
     else:
         maximal_mu, ws = mu_step_full_IS_joblib(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean,
-                                                current_cov)
+                                                current_cov, config=config)
     assert np.isfinite(maximal_mu).all()
-    _log_sample_size(ws)
+    effective_sample_size = _log_sample_size(ws)
 
     logging.debug(f"Noise mean estimation done in {time.time()-ti:.3f} s")
 
@@ -255,33 +347,269 @@ def _em_step_IS(gllim, compute_Fs, get_X_mask, Yobs, current_cov, current_mean):
     _sigma_step = cython.sigma_step_diag_IS if current_cov.ndim == 1 else cython.sigma_step_full_IS
     maximal_sigma = _sigma_step(Yobs, FXs, ws, mask, maximal_mu)
     logging.debug(f"Noise covariance estimation done in {time.time()-ti:.3f} s")
+    return maximal_mu, maximal_sigma, {"ess": effective_sample_size.tolist()}
+
+
+# no 'nnan' nor 'ninf' fast math flags : invalid samples are detected with isfinite and -inf log-weights
+@nb.njit(nogil=True, parallel=True, fastmath={"reassoc", "contract", "arcp"})
+def _accumulate_IS(Yobs, FXs, log_qs, mask, current_mean, current_precision, diag, log_max, S0, S0_square, S1, S2):
+    """Adds a chunk of samples to the running sums of observations.
+    Weights are p_tilde / q, up to a constant per observation, rescaled by exp(- log_max) (running maximum) :
+    S0 = sum w, S0_square = sum w^2, S1 = sum w (F - y), S2 = sum w (F - y)(F - y)^T (only diagonal if diag)"""
+    Ny, Ns, D = FXs.shape
+    for i in nb.prange(Ny):
+        log_ws = np.empty(Ns)
+        u = np.empty(D)
+        chunk_max = - np.inf
+        for j in range(Ns):
+            log_ws[j] = - np.inf
+            if mask[i, j] or not np.isfinite(log_qs[i, j]):
+                continue
+            valid = True
+            for d in range(D):
+                u[d] = Yobs[i, d] - current_mean[d] - FXs[i, j, d]
+                valid = valid and np.isfinite(FXs[i, j, d])
+            if not valid:
+                continue
+            log_ws[j] = - 0.5 * u.dot(current_precision.dot(u)) - log_qs[i, j]
+            chunk_max = max(chunk_max, log_ws[j])
+
+        if chunk_max == - np.inf:
+            continue
+        if chunk_max > log_max[i]:
+            scale = np.exp(log_max[i] - chunk_max)
+            S0[i] *= scale
+            S0_square[i] *= scale * scale
+            S1[i] *= scale
+            S2[i] *= scale
+            log_max[i] = chunk_max
+
+        for j in range(Ns):
+            if log_ws[j] == - np.inf:
+                continue
+            w = np.exp(log_ws[j] - log_max[i])
+            S0[i] += w
+            S0_square[i] += w * w
+            for d in range(D):
+                u[d] = FXs[i, j, d] - Yobs[i, d]
+                S1[i, d] += w * u[d]
+            for d1 in range(D):
+                if diag:
+                    S2[i, d1, d1] += w * u[d1] * u[d1]
+                else:
+                    for d2 in range(D):
+                        S2[i, d1, d2] += w * u[d1] * u[d2]
+
+
+def _IS_running_sums(mixtures, compute_Fs, get_X_mask, Yobs, current_cov, current_mean, batch_size, config,
+                     ess_target=None):
+    """Draws samples from mixtures (conditionnal law of X) by batches of batch_size, until N_sample_IS samples
+    per observation, or until the observation effective sample size reaches ess_target (if given).
+    Returns running sums (see _accumulate_IS), effective sample sizes and number of samples (shape Ny)"""
+    Ny, D = Yobs.shape
+    diag = current_cov.ndim == 1
+    current_precision = np.diag(1 / current_cov) if diag else np.linalg.inv(current_cov)
+    log_max, S0, S0_square = np.full(Ny, - np.inf), np.zeros(Ny), np.zeros(Ny)
+    S1, S2 = np.zeros((Ny, D)), np.zeros((Ny, D, D))
+    nb_samples, effective_sample_size = np.zeros(Ny, dtype=int), np.zeros(Ny)
+
+    streams = config.SAMPLING_METHOD == "streams"
+    states = probas_helper.GMM_streams(Ny) if streams else None
+
+    time_sampling, time_F, time_weights, nb_invalid = 0, 0, 0, 0
+    while True:
+        active = nb_samples < config.N_sample_IS
+        if ess_target is not None:
+            active *= effective_sample_size < ess_target
+        index = np.nonzero(active)[0]
+        if len(index) == 0:
+            break
+        size = min(batch_size, config.N_sample_IS - nb_samples[index].min())
+        all_active = len(index) == Ny
+
+        ti = time.time()
+        sub_mixtures = mixtures if all_active else mixtures[index]
+        sub_states = states if (all_active or not streams) else states[index]
+        Xs = sub_mixtures.sample(size, method=config.SAMPLING_METHOD, states=sub_states)
+        if streams and not all_active:
+            states[index] = sub_states
+        mask = get_X_mask(Xs)
+        nb_invalid += mask.sum()
+        time_sampling += time.time() - ti
+
+        ti = time.time()
+        FXs = compute_Fs(Xs, mask)
+        time_F += time.time() - ti
+
+        ti = time.time()
+        log_qs = sub_mixtures.logpdf(Xs)
+        if all_active:
+            _accumulate_IS(Yobs, FXs, log_qs, mask, current_mean, current_precision, diag,
+                           log_max, S0, S0_square, S1, S2)
+        else:
+            sums = log_max[index], S0[index], S0_square[index], S1[index], S2[index]
+            _accumulate_IS(Yobs[index], FXs, log_qs, mask, current_mean, current_precision, diag, *sums)
+            log_max[index], S0[index], S0_square[index], S1[index], S2[index] = sums
+        nb_samples[index] += size
+        np.divide(S0 ** 2, S0_square, out=effective_sample_size, where=S0_square > 0)
+        time_weights += time.time() - ti
+
+    logging.debug(f"Average ratio of F-non-compatible samplings : {nb_invalid / nb_samples.sum():.5f}")
+    logging.debug(f"Sampling done in {time_sampling:.3f} s, computation of F in {time_F:.3f} s, "
+                  f"weights in {time_weights:.3f} s")
+    logging.debug(f"Effective sample size : mean {effective_sample_size.mean():.1f}, "
+                  f"min {effective_sample_size.min():.1f} - Number of samples : mean {nb_samples.mean():.0f} "
+                  f"/ {config.N_sample_IS}")
+    return (S0, S1, S2), effective_sample_size, nb_samples
+
+
+def _IS_steps(S0, S1, S2, diag):
+    """Mu and sigma steps from running sums"""
+    Ny = len(S0)
+    # observations without valid sample are ignored, as in the cython steps
+    valid = S0 > 0
+    S1 = S1[valid] / S0[valid, None]
+    S2 = S2[valid] / S0[valid, None, None]
+    maximal_mu = - S1.sum(axis=0) / Ny
+    # sum w (F + mu - y)(F + mu - y)^T = S2 + S1 mu^T + mu S1^T + mu mu^T (normalized weights)
+    cross = S1[:, :, None] * maximal_mu[None, None, :]
+    maximal_sigma = (S2 + cross + cross.transpose((0, 2, 1))).sum(axis=0) / Ny
+    maximal_sigma += valid.sum() / Ny * np.outer(maximal_mu, maximal_mu)
+    if diag:
+        maximal_sigma = np.diag(maximal_sigma).copy()
+    assert np.isfinite(maximal_mu).all()
     return maximal_mu, maximal_sigma
 
 
+def _em_step_IS_chunked(gllim, compute_Fs, get_X_mask, Yobs, current_cov, current_mean, config=None):
+    """Same as _em_step_IS, with samples drawn by chunks of CHUNK_SIZE_IS"""
+    config = config or NoiseEMConfig()
+    sums, effective_sample_size, _ = _IS_running_sums(gllim.conditionnal_mixture(Yobs), compute_Fs, get_X_mask,
+                                                      Yobs, current_cov, current_mean, config.CHUNK_SIZE_IS, config)
+    maximal_mu, maximal_sigma = _IS_steps(*sums, current_cov.ndim == 1)
+    return maximal_mu, maximal_sigma, {"ess": effective_sample_size.tolist()}
+
+
+def _em_step_IS_adaptive(gllim, compute_Fs, get_X_mask, Yobs, current_cov, current_mean, config=None):
+    """Same as _em_step_IS, with a number of samples adapted to each observation (see ESS_TARGET)"""
+    config = config or NoiseEMConfig()
+    sums, effective_sample_size, nb_samples = _IS_running_sums(gllim.conditionnal_mixture(Yobs), compute_Fs,
+                                                               get_X_mask, Yobs, current_cov, current_mean,
+                                                               config.ADAPTIVE_BATCH_IS, config,
+                                                               ess_target=config.ESS_TARGET)
+    maximal_mu, maximal_sigma = _IS_steps(*sums, current_cov.ndim == 1)
+    return maximal_mu, maximal_sigma, {"ess": effective_sample_size.tolist(), "nb_samples": nb_samples.tolist()}
+
+
+class SamplePool:
+    """Bounded pool of IS samples of the last iterations (at most max_generations). Each generation is (proposal, Xs, FXs, mask, log_qs),
+    where proposal is the ConditionalMixture samples were drawn from, and log_qs are the log densities
+    of Xs under the proposals of the pool, by generation id"""
+
+    def __init__(self, max_generations):
+        self.max_generations = max_generations
+        self.generations = {}
+        self._next_id = 0
+
+    @property
+    def nb_samples(self):
+        return sum(g[1].shape[1] for g in self.generations.values())
+
+    def drop_oldest(self):
+        """Makes room for a new generation"""
+        while self.generations and len(self.generations) >= self.max_generations:
+            oldest = min(self.generations)
+            del self.generations[oldest]
+            for *_, log_qs in self.generations.values():
+                del log_qs[oldest]
+
+    def add(self, proposal, Xs, FXs, mask):
+        """Evaluates the new proposal on pooled samples and pooled proposals on new samples"""
+        new_id = self._next_id
+        self._next_id += 1
+        for _, old_Xs, _, _, log_qs in self.generations.values():
+            log_qs[new_id] = proposal.logpdf(old_Xs)
+        log_qs = {id_: g[0].logpdf(Xs) for id_, g in self.generations.items()}
+        log_qs[new_id] = proposal.logpdf(Xs)
+        self.generations[new_id] = (proposal, Xs, FXs, mask, log_qs)
+
+    def samples(self):
+        """Returns pooled Xs, FXs, mask, and log density of the mixture of proposals
+        (weighted by the number of samples drawn from each one)"""
+        ids = sorted(self.generations)
+        sizes = np.array([self.generations[id_][1].shape[1] for id_ in ids])
+        log_props = np.log(sizes / sizes.sum())
+        Xs, FXs, mask, log_qs = [], [], [], []
+        for id_ in ids:
+            _, X, FX, m, lq = self.generations[id_]
+            Xs.append(X)
+            FXs.append(FX)
+            mask.append(m)
+            terms = np.array([lq[j] + log_prop for j, log_prop in zip(ids, log_props)])
+            max_terms = terms.max(axis=0)
+            max_terms[~ np.isfinite(max_terms)] = 0
+            log_qs.append(max_terms + np.log(np.exp(terms - max_terms).sum(axis=0)))
+        return (np.concatenate(Xs, axis=1), np.concatenate(FXs, axis=1), np.concatenate(mask, axis=1),
+                np.concatenate(log_qs, axis=1))
+
+
+def _em_step_IS_recycled(pool: SamplePool, gllim, compute_Fs, get_X_mask, Yobs, current_cov, current_mean,
+                         config=None):
+    """Same as _em_step_IS, reusing samples of previous iterations (see RECYCLING_GENERATIONS)"""
+    config = config or NoiseEMConfig()
+    Ny, D = Yobs.shape
+    mixtures = gllim.conditionnal_mixture(Yobs)
+    pool.drop_oldest()
+    size = max(config.N_sample_IS_fresh, config.N_sample_IS - pool.nb_samples)
+    ti = time.time()
+    Xs = mixtures.sample(size, method=config.SAMPLING_METHOD)
+    mask = get_X_mask(Xs)
+    FXs = compute_Fs(Xs, mask)
+    logging.debug(f"Sampling and computation of F ({size} new samples) done in {time.time()-ti:.3f} s")
+
+    ti = time.time()
+    pool.add(mixtures, Xs, FXs, mask)
+    Xs, FXs, mask, log_qs = pool.samples()
+    diag = current_cov.ndim == 1
+    current_precision = np.diag(1 / current_cov) if diag else np.linalg.inv(current_cov)
+    log_max, S0, S0_square = np.full(Ny, - np.inf), np.zeros(Ny), np.zeros(Ny)
+    S1, S2 = np.zeros((Ny, D)), np.zeros((Ny, D, D))
+    _accumulate_IS(Yobs, FXs, log_qs, mask, current_mean, current_precision, diag, log_max, S0, S0_square, S1, S2)
+    effective_sample_size = np.zeros(Ny)
+    np.divide(S0 ** 2, S0_square, out=effective_sample_size, where=S0_square > 0)
+    logging.debug(f"Weights of {Xs.shape[1]} pooled samples ({len(pool.generations)} iterations) computed in "
+                  f"{time.time()-ti:.3f} s. Effective mean sample size : {effective_sample_size.mean():.1f}")
+
+    maximal_mu, maximal_sigma = _IS_steps(S0, S1, S2, diag)
+    return maximal_mu, maximal_sigma, {"ess": effective_sample_size.tolist(), "nb_samples": Xs.shape[1]}
+
+
+def _relative_changes(mean, cov, new_mean, new_cov):
+    """Change of noise mean, relative to the noise standard deviation, and relative change of covariance"""
+    diag = np.asarray(new_cov) if new_cov.ndim == 1 else np.diag(new_cov)
+    delta_mean = np.linalg.norm(new_mean - mean) / np.sqrt(diag.mean())
+    delta_cov = np.linalg.norm(new_cov - cov) / np.linalg.norm(new_cov)
+    return delta_mean, delta_cov
+
+
 class NoiseEM:
     """Base class for noise estimation based on EM-like procedure"""
 
     cont: context.abstractHapkeModel
 
-    def __init__(self, Yobs, cont, cov_type):
+    def __init__(self, Yobs, cont, cov_type, config: NoiseEMConfig = None, training_cache: TrainingCache = None):
         self.Yobs = Yobs
         self.cont = cont
         self.cov_type = cov_type
+        self.config = config or NoiseEMConfig()
+        self.training_cache = training_cache
 
     def get_X_mask(self, X):
-        m = np.asarray(~ self.cont.is_X_valid(X), dtype=int)
-        return m
+        return self.cont.X_mask(X, invalid=True, dtype=int)
 
     def compute_Fs(self, Xs, mask):
-        D = self.cont.D
-        N, Ns, _ = Xs.shape
-        FXs = np.empty((N, Ns, D))
-        F = self.cont.F
-        for i, (X, mask_x) in enumerate(zip(Xs, mask)):
-            FX = F(X)
-            FX[mask_x == 1, :] = 0  # anyway, ws will be 0
-            FXs[i] = FX
-        return FXs
+        # invalid samples are set to 0 : anyway, ws will be 0
+        return self.cont.F_batched(Xs, mask=mask, n_jobs=self.config.N_JOBS)
 
     def fast_compute_Hapke(self, Xs, mask):
         N, Ns, _ = Xs.shape
@@ -290,12 +618,15 @@ class NoiseEM:
             perm = np.array(self.cont.HAPKE_VECT_PERMUTATION)
         else:
             perm = np.arange(self.cont.L)
-        args = (np.asarray(self.cont.geometries, dtype=np.double), Xs, mask,
+        geometries = np.asarray(self.cont.geometries, dtype=np.double)
+        if getattr(self, "_geometry_plan", None) is None:  # geometries are fixed during the estimation
+            self._geometry_plan = hapke.cython.GeometryPlan(*geometries)
+        args = (geometries, Xs, mask,
                                               partiel, self.cont.DEFAULT_VALUES,
                                               self.cont.variables_lims[:, 0],
                                               self.cont.variables_range, perm)
 
-        FXs = hapke.cython.compute_many_Hapke(*args)
+        FXs = hapke.cython.compute_many_Hapke(*args, plan=self._geometry_plan)
 
         return FXs
 
@@ -303,8 +634,8 @@ class NoiseEM:
         return f"""
         Covariance constraint : {self.cov_type}
         Nobs = {len(self.Yobs)} 
-        Initial covariance noise : {INIT_COV_NOISE} 
-        Initial mean noise : {INIT_MEAN_NOISE}
+        Initial covariance noise : {self.config.INIT_COV_NOISE} 
+        Initial mean noise : {self.config.INIT_MEAN_NOISE}
         """
 
     def _get_F(self):
@@ -332,21 +663,42 @@ class NoiseEM:
 
         current_theta = self._init_gllim()
         base_cov = np.eye(self.cont.D) if self.cov_type == "full" else np.ones(self.cont.D)
-        current_noise_cov, current_noise_mean = INIT_COV_NOISE * base_cov, INIT_MEAN_NOISE * np.ones(self.cont.D)
-        history = [(current_noise_mean.tolist(), current_noise_cov.tolist())]
+        current_noise_cov = self.config.INIT_COV_NOISE * base_cov
+        current_noise_mean = self.config.INIT_MEAN_NOISE * np.ones(self.cont.D)
+        history = [(current_noise_mean.tolist(), current_noise_cov.tolist(), {})]
 
-        for current_iter in range(maxIter):
+        nb_converged, start_time = 0, time.time()
+        for current_iter in range(self.config.maxIter):
+            ti = time.time()
             gllim = self._gllim_step(current_noise_cov, current_noise_mean, current_theta)
+            if self.config.WARM_START and gllim is not None:
+                current_theta = gllim.theta
+            time_gllim = time.time() - ti
 
-            max_mu, max_sigma = em_step(gllim, F, self.get_X_mask, Yobs, current_noise_cov, current_noise_mean)
+            ti = time.time()
+            max_mu, max_sigma, infos = em_step(gllim, F, self.get_X_mask, Yobs, current_noise_cov,
+                                               current_noise_mean, config=self.config)
+            time_em = time.time() - ti
+
+            delta_mean, delta_cov = _relative_changes(current_noise_mean, current_noise_cov, max_mu, max_sigma)
+            tol = self.config.CONVERGENCE_TOL
+            converged = tol is not None and max(delta_mean, delta_cov) < tol
+            nb_converged = nb_converged + 1 if converged else 0
+            infos.update(time_gllim=time_gllim, time_em=time_em, delta_mean=delta_mean, delta_cov=delta_cov)
 
             log_sigma = max_sigma if self.cov_type == "diag" else np.diag(max_sigma)
             logging.info(f"""
-        Iteration {current_iter+1}/{maxIter}. 
+        Iteration {current_iter+1}/{self.config.maxIter} ({time_gllim:.1f} s GLLiM, {time_em:.1f} s EM). 
             New estimated OFFSET : {max_mu}
-            New estimated COVARIANCE : {log_sigma}""")
+            New estimated COVARIANCE : {log_sigma}
+            Relative changes : {delta_mean:.2e} (offset), {delta_cov:.2e} (covariance)""")
             current_noise_cov, current_noise_mean = max_sigma, max_mu
-            history.append((current_noise_mean.tolist(), current_noise_cov.tolist()))
+            history.append((current_noise_mean.tolist(), current_noise_cov.tolist(), infos))
+            if nb_converged >= self.config.CONVERGENCE_PATIENCE:
+                logging.info(f"Noise estimation converged after {current_iter + 1} iterations")
+                break
+        history[-1][2]["converged"] = nb_converged >= self.config.CONVERGENCE_PATIENCE
+        logging.info(f"Noise estimation done in {time.time() - start_time:.1f} s")
         return history
 
 
@@ -360,7 +712,7 @@ class NoiseEMLinear(NoiseEM):
         return self.cont.F_matrix
 
     def _get_em_step(self):
-        def em_step(gllim, F, func_mask, Yobs, current_noise_cov, current_noise_mean):
+        def em_step(gllim, F, func_mask, Yobs, current_noise_cov, current_noise_mean, config=None):
             return _em_step_lin(F, Yobs, self.cont.PRIOR_COV, current_noise_cov, current_noise_mean)
 
         return em_step
@@ -370,7 +722,7 @@ class NoiseEMGLLiM(NoiseEM):
 
     def _get_starting_logging(self):
         s = super()._get_starting_logging()
-        return f" with GLLiM \n\tNSample = {N_sample_IS}" + s
+        return f" with GLLiM \n\tNSample = {self.config.N_sample_IS}" + s
 
     def _get_F(self):
         if isinstance(self.cont, context.abstractHapkeModel):
@@ -380,11 +732,29 @@ class NoiseEMGLLiM(NoiseEM):
             logging.info("Using generic Python computation of F")
             return self.compute_Fs
 
+    def _get_training(self):
+        """Noiseless training data, simulated again every TRAINING_REFRESH gllim steps"""
+        step = self._nb_gllim_steps
+        refresh = self.config.TRAINING_REFRESH and step > 0 and step % self.config.TRAINING_REFRESH == 0
+        if self._training is None and self.training_cache is not None:
+            self._training = self.training_cache.get(self.cont, self.config.Ntrain)
+        elif self._training is None or refresh:
+            ti = time.time()
+            self._training = self.cont.get_data_training(self.config.Ntrain)
+            logging.debug(f"Training data simulated in {time.time() - ti:.3f} s")
+        return self._training
+
     def _init_gllim(self):
-        return _init(self.cont)
+        self._training, self._nb_gllim_steps = None, 0
+        return _init(self.cont, training=self._get_training(), config=self.config)
 
     def _gllim_step(self, current_noise_cov, current_noise_mean, current_theta):
-        return _gllim_step(self.cont, current_noise_cov, current_noise_mean, current_theta)
+        warm = self.config.WARM_START and self._nb_gllim_steps > 0
+        maxIter = self.config.maxIterGlliMWarm if warm else self.config.maxIterGlliM
+        gllim = _gllim_step(self.cont, current_noise_cov, current_noise_mean, current_theta,
+                            training=self._get_training(), maxIter=maxIter, config=self.config)
+        self._nb_gllim_steps += 1
+        return gllim
 
     def _get_em_step(self):
         return _em_step_NoIS
@@ -394,54 +764,96 @@ class NoiseEMISGLLiM(NoiseEMGLLiM):
 
     def _get_starting_logging(self):
         s = NoiseEM._get_starting_logging(self)
-        return f" with IS-GLLiM \n\tNSampleIS = {N_sample_IS}" + s
+        return f" with IS-GLLiM \n\tNSampleIS = {self.config.N_sample_IS}" + s
 
     def _get_em_step(self):
-        return _em_step_IS
+        if self.config.RECYCLING_GENERATIONS:
+            return functools.partial(_em_step_IS_recycled, SamplePool(self.config.RECYCLING_GENERATIONS))
+        if self.config.ESS_TARGET:
+            return _em_step_IS_adaptive
+        return _em_step_IS_chunked if self.config.CHUNK_SIZE_IS else _em_step_IS
 
 
 
-def fit(Yobs, cont: context.abstractFunctionModel, cov_type="diag", assume_linear=False):
+def fit(Yobs, cont: context.abstractFunctionModel, cov_type="diag", assume_linear=False,
+        config: NoiseEMConfig = None, training_cache: TrainingCache = None):
     Yobs = np.copy(Yobs, "C")  # to ensure Y is contiguous
+    config = config or NoiseEMConfig()
     if assume_linear:
-        fitter = NoiseEMLinear(Yobs, cont, cov_type)
-    elif NO_IS:
-        fitter = NoiseEMGLLiM(Yobs, cont, cov_type)
+        fitter = NoiseEMLinear(Yobs, cont, cov_type, config=config, training_cache=training_cache)
+    elif config.NO_IS:
+        fitter = NoiseEMGLLiM(Yobs, cont, cov_type, config=config, training_cache=training_cache)
     else:
-        fitter = NoiseEMISGLLiM(Yobs, cont, cov_type)
+        fitter = NoiseEMISGLLiM(Yobs, cont, cov_type, config=config, training_cache=training_cache)
     return fitter.run()
 
 
+@nb.njit(parallel=True, cache=True)
+def _start_thread_pool(x):
+    for i in nb.prange(x.shape[0]):
+        x[i] = i
+
+
+def configure_threading():
+    """Requires a thread safe numba threading layer (tbb or omp), needed by fit_many : parallel kernels
+    launched from several threads abort with the workqueue layer.
+    Affects every numba parallel kernel of the process, and is only effective before the first one runs :
+    programs using fit_many should call it at startup."""
+    if nb.config.THREADING_LAYER in ("default", "workqueue"):
+        nb.config.THREADING_LAYER = "threadsafe"
+
+
+def _start_threadsafe_pool():
+    """Starts numba thread pool from the calling thread (a pool started by a worker thread may hang at exit),
+    and checks that its threading layer supports concurrent parallel kernels."""
+    configure_threading()
+    _start_thread_pool(np.zeros(1))
+    if nb.threading_layer() == "workqueue":
+        raise RuntimeError("Concurrent noise estimations need a thread safe numba threading layer (tbb or omp), "
+                           "but workqueue is already in use : call configure_threading() before any "
+                           "parallel computation.")
+
+
+def fit_many(problems, max_workers=None):
+    """Runs several noise estimations concurrently, in threads (compiled steps release the GIL).
+    Problems on the same context share training simulations.
+    Needs a thread safe numba threading layer (see configure_threading).
+
+    :param problems: list of dict with keys Yobs, cont, and optionally cov_type, assume_linear,
+        config (NoiseEMConfig)
+    :param max_workers: number of concurrent estimations (default : N_JOBS)
+    :return: list of histories (same order as problems)
+    """
+    training_cache = TrainingCache()
+    _start_threadsafe_pool()
+    with ThreadPoolExecutor(max_workers=max_workers or N_JOBS) as executor:
+        futures = [executor.submit(fit, training_cache=training_cache, **problem) for problem in problems]
+        return [future.result() for future in futures]
+
+
 # ------------------ maintenance purpose ------------------ #
 def _profile():
-    global maxIter, Nobs, N_sample_IS, INIT_COV_NOISE, NO_IS
-    NO_IS = True
-    maxIter = 1
     Nobs = 200
-    N_sample_IS = 80000
+    config = NoiseEMConfig(NO_IS=True, maxIter=1, N_sample_IS=80000)
     cont = context.LabContextOlivine(partiel=(0, 1, 2, 3))
 
     _, Yobs = cont.get_data_training(Nobs)
     Yobs = cont.add_noise_data(Yobs, covariance=0.005, mean=0.1)
     Yobs = np.copy(Yobs, "C")  # to ensure Y is contiguous
 
-    fit(Yobs, cont, cov_type="diag")
+    fit(Yobs, cont, cov_type="diag", config=config)
 
 
 def _debug():
-    global maxIter, Nobs, N_sample_IS, INIT_COV_NOISE, NO_IS
-    NO_IS = False
-    maxIter = 20
     Nobs = 40
-    N_sample_IS = 20
+    config = NoiseEMConfig(NO_IS=False, maxIter=20, N_sample_IS=20, INIT_COV_NOISE=0.005)
     # cont = context.LabContextOlivine(partiel=(0, 1, 2, 3))
     cont = context.LinearFunction()
-    INIT_COV_NOISE = 0.005
     _, Yobs = cont.get_data_training(Nobs)
     Yobs = cont.add_noise_data(Yobs, covariance=0.05, mean=2)
     Yobs = np.copy(Yobs, "C")  # to ensure Y is contiguous
 
-    fit(Yobs, cont, cov_type="full", assume_linear=False)
+    fit(Yobs, cont, cov_type="full", assume_linear=False, config=config)
 
 
 
@@ -22,7 +22,7 @@ from sklearn.mixture.gaussian_mixture import _compute_precision_cholesky
 
 from Core import probas_helper, mixture_merging
 from Core.probas_helper import chol_loggausspdf, densite_melange, dominant_components, chol_loggausspdf_iso, \
-    GMM_sampling, chol_loggausspdf_diag
+    GMM_sampling, chol_loggausspdf_diag, MixtureDensity, ConditionalMixture
 from tools import regularization
 import Core.cython
 
@@ -646,9 +646,87 @@ class GLLiM:
             self.AkListS[k] = aS
             self.bkListS[k] = bS
 
+        # factorisations of the previous inversion
+        self._GammakListS_chol = self._SigmakListS_chol = None
+        self._GammakListS_logdet = self._SigmakListS_logdet = None
+
         if self.verbose is not None:
             logging.debug(f"GLLiM inversion done in {time.time()-start_time_inversion:.3f} s")
 
+    @property
+    def GammakListS_chol(self):
+        """Cholesky factors of GammakListS. Computed once per inversion"""
+        if getattr(self, "_GammakListS_chol", None) is None:
+            self._GammakListS_chol = np.linalg.cholesky(self.GammakListS)
+        return self._GammakListS_chol
+
+    @property
+    def SigmakListS_chol(self):
+        """Cholesky factors of SigmakListS. Computed once per inversion"""
+        if getattr(self, "_SigmakListS_chol", None) is None:
+            self._SigmakListS_chol = np.linalg.cholesky(self.SigmakListS)
+        return self._SigmakListS_chol
+
+    @property
+    def GammakListS_logdet(self):
+        """log det(GammakListS), from the cholesky factors. Computed once per inversion"""
+        if getattr(self, "_GammakListS_logdet", None) is None:
+            self._GammakListS_logdet = 2 * np.sum(np.log(np.diagonal(self.GammakListS_chol, axis1=1, axis2=2)),
+                                                  axis=1)
+        return self._GammakListS_logdet
+
+    @property
+    def SigmakListS_logdet(self):
+        """log det(SigmakListS), from the cholesky factors. Computed once per inversion"""
+        if getattr(self, "_SigmakListS_logdet", None) is None:
+            self._SigmakListS_logdet = 2 * np.sum(np.log(np.diagonal(self.SigmakListS_chol, axis1=1, axis2=2)),
+                                                  axis=1)
+        return self._SigmakListS_logdet
+
+    def inference_parameters(self):
+        """Returns the arrays needed by forward prediction (after inversion), with pre-factorised covariances
+        and their log-determinants (log det(cov), not log det(chol))."""
+        return dict(pikList=self.pikList, AkListS=self.AkListS, bkListS=self.bkListS, ckListS=self.ckListS,
+                    GammakListS=self.GammakListS, GammakListS_chol=self.GammakListS_chol,
+                    GammakListS_logdet=self.GammakListS_logdet,
+                    SigmakListS=self.SigmakListS, SigmakListS_chol=self.SigmakListS_chol,
+                    SigmakListS_logdet=self.SigmakListS_logdet)
+
+    @classmethod
+    def from_inference_parameters(cls, params, verbose=None):
+        """Builds a model ready for forward prediction, from the output of `inference_parameters`
+        (arrays may be read-only memory maps). Neither fit nor inversion are needed.
+        Prior parameters (pi, c, Gamma, A, b, Sigma) are not available, so X_density and predict_cluster
+        can't be used."""
+        K, L, D = params["AkListS"].shape
+        gllim = cls(K, 0, sigma_type="full", gamma_type="full", verbose=verbose)
+        gllim.D, gllim.Lt = D, L
+        gllim.pikList = params["pikList"]
+        gllim.AkListS, gllim.bkListS, gllim.ckListS = params["AkListS"], params["bkListS"], params["ckListS"]
+        gllim.GammakListS, gllim.SigmakListS = params["GammakListS"], params["SigmakListS"]
+        gllim._GammakListS_chol, gllim._SigmakListS_chol = params["GammakListS_chol"], params["SigmakListS_chol"]
+        # computed from the factors if missing
+        gllim._GammakListS_logdet = params.get("GammakListS_logdet")
+        gllim._SigmakListS_logdet = params.get("SigmakListS_logdet")
+        return gllim
+
+    @property
+    def X_mixture(self):
+        """Prior mixture on X (pi, c, Gamma). Factorisations are kept as long as parameters are the same objects."""
+        params = tuple(getattr(self, name, None) for name in
+                       ("pikList", "ckList_T", "ckList_W", "GammakList_T", "GammakList_W"))
+        cached = getattr(self, "_X_mixture_params", None)
+        if cached is None or any(p is not c for p, c in zip(params, cached)):
+            self._X_mixture = MixtureDensity(self.pikList, self.ckList, self.GammakList)
+            self._X_mixture_params = params
+        return self._X_mixture
+
+    def conditionnal_mixture(self, Y):
+        """Returns the law of X knowing Y, as a ConditionalMixture (using factorisations of the inversion)"""
+        proj, alpha, _ = self._helper_forward_conditionnal_density(Y)
+        return ConditionalMixture(alpha, proj, self.SigmakListS, chols=self.SigmakListS_chol,
+                                  half_log_dets=0.5 * self.SigmakListS_logdet)
+
     @property
     def norm2_SigmaSGammaInv(self):
         return np.array([np.linalg.norm(x, 2) for x in
@@ -665,12 +743,13 @@ class GLLiM:
         YT = np.array(Y.T, dtype=float)
 
         proj = np.empty((self.L, N, self.K))  # AkS * Y + BkS
-        logalpha = np.zeros((N, self.K))  # log N(ckS,GammakS)(Y)
-
-        for (k, pik, Ak, bk, ck, Gammak) in zip(range(self.K), self.pikList, self.AkListS,
-                                                self.bkListS, self.ckListS, self.GammakListS):
+        for (k, Ak, bk) in zip(range(self.K), self.AkListS, self.bkListS):
             proj[:, :, k] = Ak.dot(YT) + np.expand_dims(bk, axis=1)
-            logalpha[:, k] = np.log(pik) + chol_loggausspdf(YT, ck.reshape((self.D, 1)), Gammak)
+
+        # log pik N(ckS,GammakS)(Y)
+        logalpha = probas_helper._components_logpdf(np.ascontiguousarray(YT.T), self.ckListS, self.GammakListS_chol,
+                                                    0.5 * self.GammakListS_logdet).T
+        logalpha += np.log(self.pikList)[None, :]
 
         log_density = logsumexp(logalpha, axis=1, keepdims=True)
         logalpha -= log_density
@@ -705,16 +784,11 @@ class GLLiM:
     def predict_cluster(self, X, with_covariance=False):
         """Backward prediction
         If with_covariance is True, the importance of one cluster is computed with the height of gaussian as well."""
-        N = X.shape[0]
-        prob = np.empty((self.K, N))
-        if with_covariance:
+        prob = self.X_mixture.components_logpdf(X) + np.log(self.pikList)[:, None]
+        if with_covariance:  # poids = pik / sqrt( det(Sigma))
             chols = np.linalg.cholesky(self.full_SigmakList)
             dets = np.sum(np.log(np.array([np.diag(c) for c in chols])), axis=1)
-        for k, ck, Gammak, pik in zip(range(self.K), self.ckList, self.GammakList, self.pikList):
-            r = chol_loggausspdf(X.T, ck[:, None], Gammak) + np.log(pik)
-            if with_covariance:  # poids = pik / sqrt( det(Sigma))
-                r = r - dets[k]
-            prob[k] = r
+            prob -= dets[:, None]
         choice = np.argmax(prob, axis=0)
         prob = np.exp(prob)
         prob = prob / prob.sum(axis=0)
@@ -727,14 +801,10 @@ class GLLiM:
         if (not marginals) and not X_points.shape[1] == self.L:
             raise WrongContextError("Dimension of X samples doesn't match the choosen Lw")
 
+        mixture = self.X_mixture
         if marginals:
-            means = self.ckList[:, marginals]  # K , len(marginals)
-            covs = self.GammakList[:, marginals, :][:, :, marginals]  # K, len(marginals), len(marginals)
-        else:
-            means = self.ckList
-            covs = self.GammakList
-
-        return densite_melange(X_points, self.pikList, means, covs)
+            mixture = mixture.marginal(marginals)
+        return mixture.pdf(X_points)
 
     def forward_density(self, Y, X_points, marginals=None, sub_densities=0):
         """Return conditionnal density of X knowing Y, evaluated at X_points.
@@ -744,46 +814,46 @@ class GLLiM:
 
         if (not marginals) and not X_points.shape[1] == self.L:
             raise WrongContextError("Dimension of X samples doesn't match the choosen Lw")
-        proj, alpha, _ = self._helper_forward_conditionnal_density(Y)
-
+        mixtures = self.conditionnal_mixture(Y)
+        if marginals:
+            mixtures = mixtures.marginal(marginals)
 
         NX, D = X_points.shape
         N = Y.shape[0]
-        if marginals:
-            proj = proj[:, :, marginals]  # len(marginals) , N , K
-            covs = self.SigmakListS[:, marginals, :][:, :, marginals]  # K, len(marginals), len(marginals)
-        else:
-            covs = self.SigmakListS
 
-        densites = np.empty((N, NX))
-        sub_dens = np.empty((sub_densities, N, NX))
         t = time.time()
-        for n, meann, alphan in zip(range(N), proj, alpha):
-            densites[n] = densite_melange(X_points, alphan, meann, covs)
-            if sub_densities:
-                dominants = dominant_components(alphan, meann, covs)[0:sub_densities]
-                for i, (_, w, m, c) in enumerate(dominants):
-                    sub_dens[i, n] = np.exp(chol_loggausspdf(X_points.T, m.reshape((D, 1)), c)) * w
+        densites = mixtures.pdf(X_points)
+        sub_dens = np.empty((sub_densities, N, NX))
+        if sub_densities:
+            heights = mixtures.component_heights()
+            for n in range(N):
+                dominants = np.argsort(- heights[n], kind="stable")[0:sub_densities]
+                log_dens = probas_helper._components_logpdf(X_points, mixtures.meanss[n, dominants],
+                                                            mixtures.chols[dominants], mixtures.half_log_dets[dominants])
+                sub_dens[:len(dominants), n] = np.exp(log_dens) * mixtures.weightss[n, dominants][:, None]
         if self.verbose:
             logging.debug("Density calcul time {:.3f}".format(time.time() - t))
 
         return densites, sub_dens
 
 
-    def predict_sample(self, Y, nb_per_Y=10):
-        """Compute law of X knowing Y and nb_per_Y points following this law"""
-        proj, alpha, _ = self._helper_forward_conditionnal_density(Y)
+    def predict_sample(self, Y, nb_per_Y=10, method="mc"):
+        """Compute law of X knowing Y and nb_per_Y points following this law.
+        method is 'mc' (pseudo-random) or 'qmc' (randomised quasi-Monte Carlo, nb_per_Y should be a power of 2)"""
+        mixtures = self.conditionnal_mixture(Y)
         ti = time.time()
-        covs = self.SigmakListS
-        s = GMM_sampling(proj, alpha, covs, nb_per_Y)
+        s = mixtures.sample(nb_per_Y, method=method)
         logging.debug(f"Sampling from mixture ({len(Y)} series of {nb_per_Y}) done in {time.time()-ti:.3f} s")
         return s
 
 
-    def merged_prediction(self, Y):
+    def merged_prediction(self, Y, pruning=None, pruning_mode="drop"):
+        """Reduces the conditionnal mixtures to 2 components. For large K, pruning (int : number of components,
+        float : weight threshold) discards the weakest components first (see mixture_merging.bulk_merge)"""
         meanss, weightss, _ = self._helper_forward_conditionnal_density(Y)
         ti = time.time()
-        Xmean, Covs, Xweight = mixture_merging.merge_predict(weightss, meanss, self.SigmakListS)
+        Xmean, Covs, Xweight = mixture_merging.merge_predict(weightss, meanss, self.SigmakListS,
+                                                             pruning=pruning, pruning_mode=pruning_mode)
         logging.info(f"Merging of GMM mixture done in {time.time() - ti:.3f} s")
         return Xmean, Covs, Xweight
 
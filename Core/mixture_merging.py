@@ -10,31 +10,121 @@ import numba as nb
 from Core import probas_helper
 
 
-def merge_predict(weights, means, covs):
+def merge_predict(weights, means, covs, target_K=2, threshold=None, pruning=None, pruning_mode="drop",
+                  with_discarded=False):
     """Entry point
 
     :param weights: shape N,K
     :param means: shape N,K,L
-    :param covs: shape K,L,L
-    :return: tuple ( N,L ; N,L,L ; N,2,L)
+    :param covs: shape K,L,L (shared by all observations)
+    :param target_K: number of components kept
+    :param threshold: if given, stops merging when the best discrimination is above threshold
+    :param pruning: if given, pre-reduction by weights (see bulk_merge)
+    :param pruning_mode: 'drop' or 'moment' (see bulk_merge)
+    :param with_discarded: also returns the mass discarded by pruning (shape N)
+    :return: tuple ( N,L ; N,L,L ; N,target_K,L)
     """
-    N, _ = weights.shape
-    ws, ms, covs = _merge(weights, means, np.array([covs] * N))
+    if pruning is None:
+        N, K, _ = means.shape
+        indexes, sizes, own_covs = np.arange(K)[None, :], np.full(N, K), np.empty((1,) + covs.shape[1:])
+        discarded = np.zeros(N)
+    else:
+        weights, means, indexes, sizes, own_covs, discarded = bulk_merge(weights, means, covs, pruning,
+                                                                         mode=pruning_mode)
+    ws, ms, covs = _reduce(weights, means, indexes, sizes, own_covs, covs, target_K, threshold)
     Xpred, Covs = probas_helper.mean_cov_melange(ws, ms, covs)
     Xweights = ms  # "modes"
+    if with_discarded:
+        return Xpred, Covs, Xweights, discarded
     return Xpred, Covs, Xweights
 
 
-def _merge(weightss, meanss, covss, with_plot=False):
+def _merge(weightss, meanss, covs, target_K=2, threshold=None):
+    """Reduces each mixture to target_K components.
+    Covariances are not copied per observation : components point to the shared covs until they are merged.
+    If threshold is given, a mixture may keep more components : outputs are then padded with null components
+    (zero weight, mean and covariance).
+
+    :return: shapes N,K' ; N,K',L ; N,K',L,L with K' = target_K if threshold is None
+    """
+    N, K, _ = meanss.shape
+    return _reduce(weightss, meanss, np.arange(K)[None, :], np.full(N, K), np.empty((1,) + covs.shape[1:]), covs,
+                   target_K, threshold)
+
+
+def _reduce(weightss, meanss, indexes, sizes, own_covs, covs, target_K, threshold):
+    """Same as _merge, for mixtures described by bulk_merge outputs"""
+    N, K, L = meanss.shape
+    target_K = min(target_K, K)
+    threshold = np.inf if threshold is None else threshold
+    max_K = target_K if threshold == np.inf else K
+    out_ws, out_ms, out_covs = np.zeros((N, max_K)), np.zeros((N, max_K, L)), np.zeros((N, max_K, L, L))
+    shared_logdets = np.linalg.slogdet(covs)[1]
+    nb_chunks = max(1, min(N, nb.config.NUMBA_NUM_THREADS))
+    counts = _reduce_rows(weightss, meanss, np.asarray(indexes, dtype=np.int64), np.asarray(sizes, dtype=np.int64),
+                          own_covs, covs, shared_logdets, target_K, threshold, out_ws, out_ms, out_covs,
+                          _heap_capacity(K), nb_chunks)
+    max_K = counts.max() if N > 0 else target_K
+    logging.debug(f"{N} mixtures reduced from {K} to {target_K} - {max_K} components")
+    return out_ws[:, :max_K], out_ms[:, :max_K], out_covs[:, :max_K]
+
+
+def bulk_merge(weightss, meanss, covs, threshold, mode="drop"):
+    """Pre-reduction of the weakest components, in term of weights.
+    If threshold is int, only keeps the threshold heaviest components.
+    If threshold is float, only keeps components with weights >= threshold (at least the heaviest one).
+    Discarded components are either dropped (mode 'drop', kept weights are rescaled to the initial mass)
+    or moment-matched into one component (mode 'moment').
+
+    :param weightss: shape N,K
+    :param meanss: shape N,K,L
+    :param covs: shape K,L,L (shared)
+    :return: weightss N,K' ; meanss N,K',L ; indexes N,K' (shared cov of each slot, -1 for the moment-matched
+        component) ; sizes N (number of used slots, the others are padding) ;
+        own_covs N,L,L (cov of the moment-matched component) ; discarded mass N
+    """
     N, K, L = meanss.shape
-    current_ws, current_ms, current_covs = weightss, meanss, covss
-    while K > 2:
-        current_ws, current_ms, current_covs = _K_step(current_ws, current_ms, current_covs)
-        K -= 1
-        logging.debug("Current mixture size : {}".format(K))
-        if with_plot:
-            _show_density(current_ws, current_ms, current_covs)
-    return current_ws, current_ms, current_covs
+    order = np.argsort(- weightss, axis=1, kind="stable")
+    sorted_ws = np.take_along_axis(weightss, order, axis=1)
+    if isinstance(threshold, (int, np.integer)):
+        kept = np.broadcast_to(np.arange(K) < threshold, (N, K))
+    else:
+        kept = sorted_ws >= threshold
+        kept[:, 0] = True
+    sizes = kept.sum(axis=1)
+    max_K = sizes.max() if N > 0 else 0  # kept components are the first ones
+    total = weightss.sum(axis=1)
+    ws = np.where(kept, sorted_ws, 0)
+    discarded = total - ws.sum(axis=1)
+    indexes = order[:, :max_K]
+    ms = np.take_along_axis(meanss, indexes[:, :, None], axis=1)
+    logging.debug(f"Pruning from {K} to {max_K} components. Discarded mass : mean {discarded.mean():.2e}, "
+                  f"max {discarded.max():.2e}")
+
+    if mode == "drop":
+        ws = ws[:, :max_K] * (total / (total - discarded))[:, None]
+        return ws, ms, indexes, sizes, np.empty((1, L, L)), discarded
+    elif mode != "moment":
+        raise ValueError(f"Unknown pruning mode {mode}")
+
+    discarded_ws = np.empty_like(weightss)
+    np.put_along_axis(discarded_ws, order, sorted_ws - ws, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        discarded_ws /= discarded[:, None]
+    discarded_ws[discarded == 0] = 0
+    moment_means, own_covs = probas_helper.mean_cov_melange(discarded_ws, meanss, covs)
+
+    # the moment-matched component takes the first free slot
+    rows = np.arange(N)
+    with_moment = discarded > 0
+    ws = np.concatenate((ws[:, :max_K], np.zeros((N, 1))), axis=1)
+    ms = np.concatenate((ms, np.zeros((N, 1, L))), axis=1)
+    indexes = np.concatenate((indexes, np.zeros((N, 1), dtype=indexes.dtype)), axis=1)
+    ws[rows, sizes] = discarded
+    ms[rows, sizes] = moment_means
+    indexes[rows[with_moment], sizes[with_moment]] = -1
+    sizes = sizes + with_moment
+    return ws, ms, indexes, sizes, own_covs, discarded
 
 
 @nb.njit(cache=True, fastmath=True, nogil=True)
@@ -56,59 +146,169 @@ def B(w1, m1, C1, w2, m2, C2):
     """Compute upper bound for discrimination eq (21).
     Returns discrimination value and merged gaussian"""
     w, m, C = merge_2_gaussians(w1, w2, m1, m2, C1, C2)
-    (ld0, _), (ld1, _), (ld2, _) = np.linalg.slogdet(C), np.linalg.slogdet(C1), np.linalg.slogdet(C2)
+    (_, ld0), (_, ld1), (_, ld2) = np.linalg.slogdet(C), np.linalg.slogdet(C1), np.linalg.slogdet(C2)
     d = 0.5 * ((w1 + w2) * ld0 - w1 * ld1 - w2 * ld2)
     return d, w, m, C
 
 
 @nb.njit(cache=True, fastmath=True, nogil=True)
-def find_pair_to_merge(weights, means, covs):
-    K, L = means.shape
-    best_disc, best_merged_w, best_merged_m, best_merged_cov = np.inf, 0, np.zeros(L), np.zeros((L, L))
-    best_i, best_j = None, None
-    for i in range(K):
-        wi, mi, Ci = weights[i], means[i], covs[i]
-        for j in range(i + 1, K):
-            wj, mj, Cj = weights[j], means[j], covs[j]
-            d, merged_w, merged_m, merged_cov = B(wi, mi, Ci, wj, mj, Cj)
-            if d < best_disc:
-                best_disc = d
-                best_merged_w = merged_w
-                best_merged_m = merged_m
-                best_merged_cov = merged_cov
-                best_i, best_j = i, j
-    return best_i, best_j, best_merged_w, best_merged_m, best_merged_cov
-
-
-@nb.njit(fastmath=True, parallel=True)
-def _K_step(current_ws, current_ms, current_covs):
-    N, K, L = current_ms.shape
-    new_weights, new_means, new_covs = np.zeros((N, K - 1)), np.zeros((N, K - 1, L)), np.zeros((N, K - 1, L, L))
-    for n in range(N):
-        weights, means, covs = current_ws[n], current_ms[n], current_covs[n]
-        i, j, merged_w, merged_m, merged_cov = find_pair_to_merge(weights, means, covs)
-        keep_w = [weights[k] for k in range(K) if not (k == i or k == j)]
-        keep_m = [means[k] for k in range(K) if not (k == i or k == j)]
-        keep_cov = [covs[k] for k in range(K) if not (k == i or k == j)]
-        for k in range(K - 2):
-            new_weights[n][k] = keep_w[k]
-            new_means[n][k] = keep_m[k]
-            new_covs[n][k] = keep_cov[k]
-        new_weights[n][K - 2] = merged_w
-        new_means[n][K - 2] = merged_m
-        new_covs[n][K - 2] = merged_cov
-    return new_weights, new_means, new_covs
-
-
-# def bulk_merge(weights, means, covs, threshold):
-#     """Merge the weakest components, in term of weights.
-#     If threshold is int, only keeps threshold components.
-#     If threshold if float, only keeps components  with weights >= threshold"""
-#     if type(threshold) is int:
-#         sorted(zip(weights, means, covs), key=lambda t: t[0])[threshold:]
+def _slot_cov(k, index, shared_covs, pool, owned):
+    """Covariance of slot k : the shared one, or the one of the merged component stored in the pool"""
+    if owned[k]:
+        return pool[k]
+    return shared_covs[index[k]]
+
+
+@nb.njit(cache=True, fastmath=True, nogil=True)
+def _pair_cost(i, j, weights, means, index, shared_covs, pool, owned, logdets):
+    """Same as B, with cached log-determinants of the components (one slogdet per pair)"""
+    _, _, C = merge_2_gaussians(weights[i], weights[j], means[i], means[j],
+                                _slot_cov(i, index, shared_covs, pool, owned),
+                                _slot_cov(j, index, shared_covs, pool, owned))
+    _, ld0 = np.linalg.slogdet(C)
+    return 0.5 * ((weights[i] + weights[j]) * ld0 - weights[i] * logdets[i] - weights[j] * logdets[j])
+
+
+# Pair costs are stored in an array-based binary min-heap : costs (shape capacity) and
+# pairs (shape capacity,4 : slot i, slot j, version of i, version of j at push time).
+# Entries are never removed when a slot changes : they are skipped at pop time if versions are outdated.
+
+@nb.njit(cache=True, nogil=True)
+def _heap_swap(costs, pairs, a, b):
+    costs[a], costs[b] = costs[b], costs[a]
+    for c in range(4):
+        pairs[a, c], pairs[b, c] = pairs[b, c], pairs[a, c]
+
+
+@nb.njit(cache=True, nogil=True)
+def _heap_push(costs, pairs, size, cost, i, j, vi, vj):
+    """Returns the new size"""
+    pos = size
+    costs[pos] = cost
+    pairs[pos, 0], pairs[pos, 1], pairs[pos, 2], pairs[pos, 3] = i, j, vi, vj
+    while pos > 0:
+        parent = (pos - 1) // 2
+        if costs[parent] <= costs[pos]:
+            break
+        _heap_swap(costs, pairs, parent, pos)
+        pos = parent
+    return size + 1
+
+
+@nb.njit(cache=True, nogil=True)
+def _heap_pop(costs, pairs, size):
+    """Removes the root (read it before). Returns the new size"""
+    size -= 1
+    _heap_swap(costs, pairs, 0, size)
+    pos = 0
+    while True:
+        child = 2 * pos + 1
+        if child >= size:
+            break
+        if child + 1 < size and costs[child + 1] < costs[child]:
+            child += 1
+        if costs[pos] <= costs[child]:
+            break
+        _heap_swap(costs, pairs, pos, child)
+        pos = child
+    return size
+
+
+def _heap_capacity(K):
+    """Initial pairs, plus at most K-1 new pairs for each of the K-1 merges"""
+    return K * (K - 1) // 2 + (K - 1) ** 2
+
+
+@nb.njit(cache=True, fastmath=True, nogil=True)
+def _reduce_row(weights, means, index, nb_components, own_cov, shared_covs, shared_logdets, target_K, threshold,
+                out_w, out_m, out_cov, w, m, pool, owned, alive, logdets, versions, costs, pairs):
+    """Reduces one mixture (weights shape K, means shape K,L) to target_K components (or until the best
+    discrimination is above threshold), written in out_*. Returns the number of components kept.
+    Only the first nb_components slots are used. Slot k has covariance shared_covs[index[k]],
+    or own_cov if index[k] is -1.
+    Other arguments are workspaces : the merged component takes the slot of its first parent,
+    and its covariance is stored in pool."""
+    K = weights.shape[0]
+    w[:] = weights
+    m[:] = means
+    versions[:] = 0
+    for k in range(K):
+        alive[k] = k < nb_components
+        owned[k] = alive[k] and index[k] < 0
+        if owned[k]:
+            pool[k] = own_cov
+            logdets[k] = np.linalg.slogdet(own_cov)[1]
+        elif alive[k]:
+            logdets[k] = shared_logdets[index[k]]
+
+    size = 0
+    for i in range(nb_components):
+        for j in range(i + 1, nb_components):
+            size = _heap_push(costs, pairs, size, _pair_cost(i, j, w, m, index, shared_covs, pool, owned, logdets),
+                              i, j, 0, 0)
 
+    nb_alive = nb_components
+    while nb_alive > target_K and size > 0:
+        cost = costs[0]
+        i, j, vi, vj = pairs[0, 0], pairs[0, 1], pairs[0, 2], pairs[0, 3]
+        size = _heap_pop(costs, pairs, size)
+        if vi != versions[i] or vj != versions[j] or not (alive[i] and alive[j]):
+            continue  # outdated pair
+        if cost > threshold:
+            break
 
+        merged_w, merged_m, merged_cov = merge_2_gaussians(w[i], w[j], m[i], m[j],
+                                                           _slot_cov(i, index, shared_covs, pool, owned),
+                                                           _slot_cov(j, index, shared_covs, pool, owned))
+        w[i] = merged_w
+        m[i] = merged_m
+        pool[i] = merged_cov
+        owned[i] = True
+        logdets[i] = np.linalg.slogdet(pool[i])[1]
+        alive[j] = False
+        versions[i] += 1
+        versions[j] += 1
+        nb_alive -= 1
 
+        for k in range(K):
+            if alive[k] and k != i:
+                a, b = min(i, k), max(i, k)
+                size = _heap_push(costs, pairs, size,
+                                  _pair_cost(a, b, w, m, index, shared_covs, pool, owned, logdets),
+                                  a, b, versions[a], versions[b])
+
+    kept = 0
+    for k in range(K):
+        if alive[k]:
+            out_w[kept] = w[k]
+            out_m[kept] = m[k]
+            out_cov[kept] = _slot_cov(k, index, shared_covs, pool, owned)
+            kept += 1
+    return kept
+
+
+@nb.njit(cache=True, fastmath=True, nogil=True, parallel=True)
+def _reduce_rows(weightss, meanss, indexes, sizes, own_covs, shared_covs, shared_logdets, target_K, threshold,
+                 out_ws, out_ms, out_covs, capacity, nb_chunks):
+    """Observations are split in nb_chunks contiguous chunks, reduced in parallel.
+    Each chunk allocates its workspaces once, and writes in place in out_*.
+    indexes (shape N,K) and own_covs (shape N,L,L) may be shared by all observations (first dimension of 1)."""
+    N, K, L = meanss.shape
+    i_step = 0 if indexes.shape[0] == 1 else 1  # index clamping for shared arrays
+    c_step = 0 if own_covs.shape[0] == 1 else 1
+    counts = np.empty(N, dtype=np.int64)
+    chunk_size = (N + nb_chunks - 1) // nb_chunks
+    for c in nb.prange(nb_chunks):
+        w, m, pool = np.empty(K), np.empty((K, L)), np.empty((K, L, L))
+        owned, alive = np.zeros(K, dtype=np.bool_), np.zeros(K, dtype=np.bool_)
+        logdets, versions = np.empty(K), np.zeros(K, dtype=np.int64)
+        costs, pairs = np.empty(capacity), np.empty((capacity, 4), dtype=np.int64)
+        for n in range(c * chunk_size, min(N, (c + 1) * chunk_size)):
+            counts[n] = _reduce_row(weightss[n], meanss[n], indexes[n * i_step], sizes[n], own_covs[n * c_step],
+                                    shared_covs, shared_logdets, target_K, threshold,
+                                    out_ws[n], out_ms[n], out_covs[n],
+                                    w, m, pool, owned, alive, logdets, versions, costs, pairs)
+    return counts
 
 
 # ---------------------- DEBUG Tools ---------------------- #
@@ -147,6 +347,7 @@ def _test():
     meanss = np.random.random_sample((N, K, L))
 
     a, b, c = merge_predict(wks, meanss, covs)
+    _show_density(*_merge(wks, meanss, covs))
 
 
 if __name__ == '__main__':
@@ -8,6 +8,7 @@ import numpy as np
 import numba as nb
 import scipy.optimize
 import scipy.optimize.linesearch
+import scipy.spatial
 
 from tools import context
 
@@ -20,6 +21,11 @@ INIT_MEAN_NOISE = 0  # initial noise offset
 
 maxIter = 1000
 
+USE_KDTREE = True  # nearest images searched in a KD-tree over Ytrain, instead of brute force
+
+METHOD = "lbfgs"  # "lbfgs" (quasi-Newton, one training generation) or "gd" (line search, resampled each iteration)
+# Only for training based estimation : the linear case always uses "gd"
+
 verbosity = 1
 
 
@@ -65,11 +71,10 @@ def dJ_lin(b, F, Yobs):
 def sigma_estimator_diag_lin(b, F, Yobs):
     Nobs, D = Yobs.shape
     s = np.zeros(D)
+    norms = np.square(F).sum(axis=0)
     for i in nb.prange(Nobs):
         u = b - Yobs[i]
-        z2 = (u.reshape((-1, 1)) * F).sum(axis=0) / np.square(F).sum(axis=0)
-        proj = (z2.reshape((1, -1)) * F).sum(axis=1)
-
+        proj = F.dot(F.T.dot(u) / norms)
         s += (u - proj) ** 2
     return s / Nobs
 
@@ -157,6 +162,74 @@ def sigma_estimator_diag(b, Ytrain, Yobs):
     return s / Nobs
 
 
+# ------------------ Indexed search ------------------ #
+
+class ImageIndex:
+    """KD-tree over simulated images Ytrain. Since d(y - b, Ytrain) = d(y, Ytrain + b),
+    nearest images for any offset b are queries at Yobs - b.
+
+    Nearest images are cached : if the nearest and second nearest images of yobs - b0 are at distances d1 and d2,
+    the nearest image of yobs - b is the same as long as |b - b0| <= (d2 - d1) / 2. Only observations outside
+    this margin (close to a Voronoi cell boundary) are searched again."""
+
+    def __init__(self, Ytrain):
+        self.Ytrain = Ytrain
+        self.shape = Ytrain.shape
+        self.tree = scipy.spatial.cKDTree(Ytrain)
+        self._Yobs = None
+        self.nb_searches, self.nb_reused = 0, 0
+
+    def _search(self, Q):
+        dists, n_mins = self.tree.query(Q, k=2, workers=-1)
+        self.nb_searches += len(Q)
+        return n_mins[:, 0], (dists[:, 1] - dists[:, 0]) / 2
+
+    def nearest(self, b, Yobs):
+        """Returns the index of the nearest image of each yobs - b"""
+        if self._Yobs is not Yobs:
+            self._Yobs = Yobs
+            self._anchors = np.empty(Yobs.shape)
+            self._anchors[:] = b
+            self._n_min, self._margins = self._search(Yobs - b)
+            return self._n_min
+        shifts = np.sqrt(np.square(self._anchors - b).sum(axis=1))
+        stale = np.nonzero(shifts > self._margins)[0]
+        self.nb_reused += len(Yobs) - len(stale)
+        if len(stale) > 0:
+            self._anchors[stale] = b
+            self._n_min[stale], self._margins[stale] = self._search(Yobs[stale] - b)
+        return self._n_min
+
+    def residuals(self, b, Yobs):
+        """Returns Ytrain[n_min] - yobs + b for each observation, shape (Nobs, D)"""
+        return self.Ytrain[self.nearest(b, Yobs)] - Yobs + b
+
+
+def J_index(b, index: ImageIndex, Yobs):
+    u = index.residuals(b, Yobs)
+    return np.square(u).sum() / len(Yobs)
+
+
+def dJ_index(b, index: ImageIndex, Yobs):
+    """Half of the real gradient"""
+    return index.residuals(b, Yobs).mean(axis=0)
+
+
+def J_and_gradient_index(b, index: ImageIndex, Yobs):
+    """J and its (whole) gradient, with one nearest images search"""
+    u = index.residuals(b, Yobs)
+    return np.square(u).sum() / len(Yobs), 2 * u.mean(axis=0)
+
+
+def sigma_estimator_full_index(b, index: ImageIndex, Yobs):
+    u = index.residuals(b, Yobs)
+    return u.T.dot(u) / len(Yobs)
+
+
+def sigma_estimator_diag_index(b, index: ImageIndex, Yobs):
+    return np.square(index.residuals(b, Yobs)).mean(axis=0)
+
+
 class GradientDescent:
     """Base class for noise estimation with Gradient Descent
     Actual computation are made by JIT compiled helpers
@@ -185,7 +258,60 @@ class GradientDescent:
         """Should return functions to compute J and dJ"""
         raise NotImplementedError
 
+    def _get_J_and_gradient(self):
+        """Returns a function computing J and its gradient at once"""
+        Jfunc, dJfunc = self._get_J_dJ()
+
+        def J_and_gradient(b, Farg, Yobs):
+            return Jfunc(b, Farg, Yobs), 2 * dJfunc(b, Farg, Yobs)
+
+        return J_and_gradient
+
     def run(self):
+        return self.run_lbfgs() if METHOD == "lbfgs" else self.run_gd()
+
+    def run_lbfgs(self):
+        """Minimizes J with L-BFGS, on one training generation"""
+        Yobs = self.Yobs
+        Nobs, D = Yobs.shape
+        current_noise_mean = INIT_MEAN_NOISE * np.ones(D)
+        Farg = self._get_F_arg()
+
+        log = "Starting noise mean estimation with L-BFGS" + self._get_starting_logging(Farg)
+        logging.info(log)
+
+        sigma_estimator = self._get_sigma_estimator()
+        J_and_gradient = self._get_J_and_gradient()
+        last = {}
+
+        def fun(b):
+            last["b"], (last["J"], grad) = np.copy(b), J_and_gradient(b, Farg, Yobs)
+            return last["J"], grad
+
+        Jinit, _ = fun(current_noise_mean)
+        history = [(current_noise_mean.tolist(), sigma_estimator(current_noise_mean, Farg, Yobs).tolist(), Jinit)]
+
+        def callback(b):
+            current_J = last["J"] if np.array_equal(last.get("b"), b) else fun(b)[0]
+            sigma = sigma_estimator(b, Farg, Yobs)
+            logging.info(f"Iteration {len(history) - 1}")
+            if verbosity >= 2:
+                log_sigma = sigma if self.cov_type == "diag" else np.diag(sigma)
+                logging.info(f"""
+        New estimated OFFSET : {b}
+        New estimated COVARIANCE : {log_sigma}""")
+            history.append((b.tolist(), sigma.tolist(), current_J))
+
+        ti = time.time()
+        res = scipy.optimize.minimize(fun, current_noise_mean, jac=True, method="L-BFGS-B", callback=callback,
+                                      options={"maxiter": maxIter, "ftol": TOL})
+        self.counts = {"nit": res.nit, "nfev": res.nfev, "njev": res.njev}
+        if isinstance(Farg, ImageIndex):
+            self.counts.update(nb_searches=Farg.nb_searches, nb_reused=Farg.nb_reused)
+        logging.info(f"L-BFGS done in {time.time() - ti:.3f} s ({res.message}). Evaluations : {self.counts}")
+        return history
+
+    def run_gd(self):
         Yobs = self.Yobs
         Nobs, D = Yobs.shape
         current_noise_mean = INIT_MEAN_NOISE * np.ones(D)
@@ -241,8 +367,8 @@ class GradientDescentGeneral(GradientDescent):
 
     def __init__(self, Yobs, cov_type, Ytrain):
         super().__init__(Yobs, cov_type, True)
-        if cov_type == "full":
-            logging.warning(f"Full covariance not supported for linear case. "
+        if cov_type == "full" and not USE_KDTREE:
+            logging.warning(f"Full covariance only supported with KD-tree search. "
                             f"Diagonal constraint used")
         self.Ytrain = Ytrain
 
@@ -253,13 +379,24 @@ class GradientDescentGeneral(GradientDescent):
         return s
 
     def _get_sigma_estimator(self):
-        return sigma_estimator_diag
+        if not USE_KDTREE:
+            return sigma_estimator_diag
+        return sigma_estimator_diag_index if self.cov_type == "diag" else sigma_estimator_full_index
 
     def _get_J_dJ(self):
-        return J, dJ
+        return (J_index, dJ_index) if USE_KDTREE else (J, dJ)
+
+    def _get_J_and_gradient(self):
+        return J_and_gradient_index if USE_KDTREE else super()._get_J_and_gradient()
 
     def _get_F_arg(self):
-        return self.Ytrain()
+        Ytrain = self.Ytrain()
+        if not USE_KDTREE:
+            return Ytrain
+        ti = time.time()
+        index = ImageIndex(Ytrain)
+        logging.debug(f"KD-tree built in {time.time() - ti:.3f} s")
+        return index
 
 
 class GradientDescentLinear(GradientDescent):
@@ -273,9 +410,15 @@ class GradientDescentLinear(GradientDescent):
         s = " (Linear case)" + s
         return s
 
+    def _get_sigma_estimator(self):
+        return sigma_estimator_diag_lin
+
     def _get_J_dJ(self):
         return J_lin, dJ_lin
 
+    def run(self):
+        return self.run_gd()
+
     def _get_F_arg(self):
         return self.Fmatrix
 
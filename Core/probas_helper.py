@@ -1,9 +1,12 @@
 import logging
 import time
+import warnings
 
 import numpy as np
 import numba as nb
 from scipy import linalg
+from scipy.special import ndtri
+from scipy.stats import qmc
 
 from Core import cython
 
@@ -261,44 +264,73 @@ def mean_melange(weightss, meanss):
     return mean
 
 
-def mean_cov_melange(weightss, meanss, covs):
-    if covs.ndim == 4:  # diferrents covs for each obs
-        return _mean_cov_melange_pluriCov(weightss, meanss, covs)
-    else:
-        return _mean_cov_melange_monoCov(weightss, meanss, covs)
-
+def mean_cov_melange(weightss, meanss, covs, out_mean=None, out_cov=None):
+    """Mean and covariance of N mixtures.
 
-@nb.njit(cache=True)
-def _mean_cov_melange_monoCov(weightss, meanss, covs):
+    :param weightss: shape N,K
+    :param meanss: shape N,K,L
+    :param covs: shape K,L,L (same covs) or N,K,L,L (diferrents covs for each obs)
+    :param out_mean: shape N,L. If given, written in place
+    :param out_cov: shape N,L,L. If given, written in place
+    """
     N, K, L = meanss.shape
-    mean_mel = np.zeros((N, L))
-    t = covs[0].shape
-    covs_mel = np.empty((N, *t))
-    for n in range(N):
-        wn, mn = weightss[n], meanss[n]
-        mean_mel[n] = _mean_melange(wn, mn)
-        covs_mel[n] = covariance_melange(wn, mn, covs)
-    return mean_mel, covs_mel
+    out_mean = np.empty((N, L)) if out_mean is None else out_mean
+    out_cov = np.empty((N, L, L)) if out_cov is None else out_cov
+    covs = covs[None, :, :, :] if covs.ndim == 3 else covs
+    _mean_cov_melange_para(weightss, meanss, covs, out_mean, out_cov, np.empty((0, L, L)), True)
+    return out_mean, out_cov
 
 
-@nb.njit(cache=True)
-def _mean_cov_melange_pluriCov(weightss, meanss, covs):
+def mean_cov_melange_decomposed(weightss, meanss, covs, out_mean=None, out_within=None, out_between=None):
+    """Same as mean_cov_melange, but returns covariance as within-components and between-components terms
+    (sum w_k cov_k and sum w_k (m_k - m)(m_k - m)^T)."""
     N, K, L = meanss.shape
-    mean_mel = np.zeros((N, L))
-    t = covs[0, 0].shape
-    covs_mel = np.empty((N, *t))
-    for n in range(N):
-        wn, mn, cn = weightss[n], meanss[n], covs[n]
-        mmm = _mean_melange(wn, mn)
-        mean_mel[n] = mmm
-        covs_mel[n] = covariance_melange(wn, mn, cn)
-    return mean_mel, covs_mel
-
-
-def dominant_components(weights,means,covs,threshold=None,sort_by="height",dets=None):
+    out_mean = np.empty((N, L)) if out_mean is None else out_mean
+    out_within = np.empty((N, L, L)) if out_within is None else out_within
+    out_between = np.empty((N, L, L)) if out_between is None else out_between
+    covs = covs[None, :, :, :] if covs.ndim == 3 else covs
+    _mean_cov_melange_para(weightss, meanss, covs, out_mean, out_within, out_between, False)
+    return out_mean, out_within, out_between
+
+
+@nb.njit(nogil=True, parallel=True, fastmath=True, cache=True)
+def _mean_cov_melange_para(weightss, meanss, covs, out_mean, out_within, out_between, total):
+    """One pass over the N mixtures, without temporary arrays.
+    covs has shape 1,K,L,L (shared) or N,K,L,L.
+    If total, between-components term is added to out_within and out_between is not used."""
+    N, K, L = meanss.shape
+    c_step = 0 if covs.shape[0] == 1 else 1  # index clamping for shared covs
+    for n in nb.prange(N):
+        c = n * c_step
+        for i in range(L):
+            m = 0.
+            for k in range(K):
+                m += weightss[n, k] * meanss[n, k, i]
+            out_mean[n, i] = m
+
+        for i in range(L):
+            for j in range(i + 1):
+                w = 0.
+                b = 0.
+                for k in range(K):
+                    w += weightss[n, k] * covs[c, k, i, j]
+                    b += weightss[n, k] * (meanss[n, k, i] - out_mean[n, i]) * (meanss[n, k, j] - out_mean[n, j])
+                if total:
+                    w += b
+                else:
+                    out_between[n, i, j] = b
+                    out_between[n, j, i] = b
+                out_within[n, i, j] = w
+                out_within[n, j, i] = w
+
+
+def dominant_components(weights,means=None,covs=None,threshold=None,sort_by="height",dets=None):
     """Returns a sorted list of parameters of mixture. Order is made on height or weight.
     If threshold is given, gets rid of components with weight <= threshold.
-    If dets is given, use instead of re-computing det(covs)"""
+    If dets is given, use instead of re-computing det(covs).
+    weights may also be a MixtureDensity, whose factorisations are then used."""
+    if isinstance(weights, MixtureDensity):
+        weights, means, covs, dets = weights.weights, weights.means, weights.covs, np.exp(weights.half_log_dets)
     if dets is None:
         chols = np.linalg.cholesky(covs)
         dets = np.prod(np.array([np.diag(c) for c in chols]),axis=1)
@@ -333,8 +365,21 @@ def dominant_components(weights,means,covs,threshold=None,sort_by="height",dets=
 #             out[n, s] = chols[k].dot(alea[s]) + means[k]
 #     return out
 
+ALIAS_THRESHOLD = 500
+"""Above this number of draws per row, labels are drawn with alias tables (O(1) per draw, after a O(K) setup)"""
+
+
+def multinomial_sampling(weights_list: np.ndarray, size: int):
+    """Draws size labels for each row of weights_list (shape N,K).
+    :return: shape N,size"""
+    if size >= ALIAS_THRESHOLD:
+        probs, aliases = cython.alias_tables(weights_list)
+        return cython.alias_sampling(probs, aliases, size)
+    return cython.multinomial_sampling_cython(weights_list, size)
+
+
 def _GMM_sampling_sameCov(means_list: np.ndarray, clusters_list: np.ndarray,
-                          covs_list: np.ndarray, alea: np.ndarray):
+                          covs_list: np.ndarray, alea: np.ndarray, out: np.ndarray = None):
     """Samples from N Gaussian Mixture Models
 
     :param means_list: shape N,K,L
@@ -346,13 +391,12 @@ def _GMM_sampling_sameCov(means_list: np.ndarray, clusters_list: np.ndarray,
     size, _ = alea.shape
     chols = cholesky_list(covs_list)
 
-    out = cython.sampling_sameCov_chols(means_list, clusters_list, chols, alea)
+    out = cython.sampling_sameCov_chols(means_list, clusters_list, chols, alea, out=out)
     return out
 
 
-@nb.njit(cache=True, fastmath=True)
 def _GMM_sampling_Covs(means_list: np.ndarray, clusters_list: np.ndarray,
-                       covs_list: np.ndarray, alea: np.ndarray):
+                       covs_list: np.ndarray, alea: np.ndarray, out: np.ndarray = None):
     """Samples from N Gaussian Mixture Models
 
     :param means_list: shape N,K,L
@@ -362,38 +406,363 @@ def _GMM_sampling_Covs(means_list: np.ndarray, clusters_list: np.ndarray,
     """
     N, K, L = means_list.shape
     size, _ = alea.shape
-    out = np.empty((N, size, L))
-
-    for n in range(N):
-        clusters = clusters_list[n]
-        means = means_list[n]
-        chols = cholesky_list(covs_list[n])
-        for s in range(size):
-            k = clusters[s]
-            out[n, s] = chols[k].dot(alea[s]) + means[k]
+    if out is None:
+        out = np.empty((N, size, L))
+    cython.sampling_Covs(means_list, clusters_list, covs_list, alea, out)
     return out
 
 
 def GMM_sampling(means_list: np.ndarray, weights_list: np.ndarray,
-                 covs_list: np.ndarray, size: int):
+                 covs_list: np.ndarray, size: int, out: np.ndarray = None):
     """Samples from N Gaussian Mixture Models
 
     :param means_list: shape N,K,L
     :param weights_list: shape N,K
     :param covs_list: shape N,K,L,L or shape K,L,L (same covs)
     :param size:
+    :param out: shape N,size,L. If given, samples are written in it
     :return:
     """
     _, _, L = means_list.shape
     alea = np.random.multivariate_normal(np.zeros(L), np.eye(L), size)
 
-    clusters_list = cython.multinomial_sampling_cython(weights_list, size)
+    clusters_list = multinomial_sampling(weights_list, size)
+
+
+    if covs_list.ndim == 3:
+        return _GMM_sampling_sameCov(means_list, clusters_list, covs_list, alea, out=out)
+    else:
+        return _GMM_sampling_Covs(means_list, clusters_list, covs_list, alea, out=out)
+
+
+def GMM_streams(N: int, seed=None):
+    """Returns N independent random states (shape N,4) for GMM_sampling_chunks, spawned from seed.
+    If seed is None, it is drawn from numpy global random state (so that np.random.seed fixes the streams)."""
+    if seed is None:
+        seed = np.random.randint(2 ** 32)
+    children = np.random.SeedSequence(seed).spawn(N)
+    return np.array([c.generate_state(4, np.uint64) for c in children])
+
+
+def GMM_sampling_chunks(means_list: np.ndarray, weights_list: np.ndarray, covs_list: np.ndarray, size: int,
+                        chunk_size: int = None, seed=None, states: np.ndarray = None, num_threads: int = 0):
+    """Samples from N Gaussian Mixture Models, yielding blocks of shape N,chunk_size,L (the last one may be smaller).
+    Contrary to GMM_sampling, each mixture has its own random stream (and its own normal draws).
+    Results only depend on seed (or states), not on chunk_size nor num_threads.
+
+    :param means_list: shape N,K,L
+    :param weights_list: shape N,K
+    :param covs_list: shape N,K,L,L or shape K,L,L (same covs)
+    :param size: total number of samples per mixture
+    :param chunk_size: None to sample everything at once
+    :param states: random states as returned by GMM_streams. Modified in place, so that
+        a following call continues the streams. If not given, states are spawned from seed.
+    :param num_threads: 0 to use all cores
+    """
+    N, _, L = means_list.shape
+    if states is None:
+        states = GMM_streams(N, seed)
+    if covs_list.ndim == 3:
+        chols = cholesky_list(covs_list)[None, :, :, :]
+    else:
+        chols = np.linalg.cholesky(covs_list)
+    chunk_size = chunk_size or size
+    for start in range(0, size, chunk_size):
+        out = np.empty((N, min(chunk_size, size - start), L))
+        cython.sampling_streams_chols(means_list, weights_list, chols, states, out, num_threads=num_threads)
+        yield out
+
+
+def GMM_sampling_streams(means_list: np.ndarray, weights_list: np.ndarray, covs_list: np.ndarray, size: int,
+                         seed=None, states: np.ndarray = None, num_threads: int = 0):
+    """Same as GMM_sampling, with independent and reproducible streams. See GMM_sampling_chunks
+    :return: shape N,size,L
+    """
+    return next(GMM_sampling_chunks(means_list, weights_list, covs_list, size, seed=seed, states=states,
+                                    num_threads=num_threads))
+
+
+@nb.njit(nogil=True, parallel=True, fastmath=True, cache=True)
+def _affine_components(means_list, clusters_list, chols, Z, out):
+    """out[n,s] = means_list[n,k] + chols[n,k] Z[n,s], with k = clusters_list[n,s].
+    chols has shape 1,K,L,L (shared) or N,K,L,L."""
+    N, size, L = Z.shape
+    c_step = 0 if chols.shape[0] == 1 else 1
+    for n in nb.prange(N):
+        c = n * c_step
+        for s in range(size):
+            k = clusters_list[n, s]
+            for i in range(L):
+                v = means_list[n, k, i]
+                for j in range(i + 1):
+                    v += chols[c, k, i, j] * Z[n, s, j]
+                out[n, s, i] = v
+
+
+_QMC_BITS = 52
+_qmc_size_warned = False
 
 
+def _GMM_sampling_qmc_chols(means_list, weights_list, chols, size, seed=None, out=None):
+    """See GMM_sampling_qmc. chols has shape 1,K,L,L (shared) or N,K,L,L"""
+    global _qmc_size_warned
+    N, K, L = means_list.shape
+    rng = np.random.default_rng(seed)
+    m = int(np.ceil(np.log2(max(size, 1))))
+    if size != 2 ** m and not _qmc_size_warned:
+        warnings.warn(f"QMC sampling with {size} points (not a power of 2) : the first {size} points of a Sobol net "
+                      f"of {2 ** m} are used, so their balance properties are lost")
+        _qmc_size_warned = True
+    U = qmc.Sobol(L + 1, scramble=True, seed=rng).random_base2(m)[:size]
+    # independent random digital shift for each mixture (keeps the net structure)
+    U = (U * 2 ** _QMC_BITS).astype(np.uint64)[None, :, :]
+    U = U ^ rng.integers(0, 2 ** _QMC_BITS, size=(N, 1, L + 1), dtype=np.uint64)
+    U = (U + 0.5) / 2 ** _QMC_BITS
+
+    cumweights = np.cumsum(weights_list, axis=1)
+    clusters_list = np.empty((N, size), dtype=int)
+    for n in range(N):
+        u_cluster = U[n, :, 0] * cumweights[n, -1]
+        clusters_list[n] = np.minimum(np.searchsorted(cumweights[n], u_cluster, side="right"), K - 1)
+    Z = ndtri(U[:, :, 1:])
+    out = np.empty((N, size, L)) if out is None else out
+    _affine_components(means_list, clusters_list, chols, Z, out)
+    return out
+
+
+def GMM_sampling_qmc(means_list: np.ndarray, weights_list: np.ndarray, covs_list: np.ndarray, size: int,
+                     seed=None, out: np.ndarray = None):
+    """Randomised quasi-Monte Carlo sampling of N Gaussian Mixture Models.
+    A scrambled Sobol sequence in dimension L+1 is randomised again for each mixture (digital shift) :
+    the first coordinate chooses the component (so that counts per component are stratified), the others
+    are mapped to N(0,I) by the inverse normal cdf. Each point still follows the mixture law, so importance weights are unchanged,
+    but integrals have much lower variance. size should be a power of 2.
+
+    :param means_list: shape N,K,L
+    :param weights_list: shape N,K
+    :param covs_list: shape N,K,L,L or shape K,L,L (same covs)
+    :return: shape N,size,L
+    """
     if covs_list.ndim == 3:
-        return _GMM_sampling_sameCov(means_list, clusters_list, covs_list, alea)
+        chols = cholesky_list(covs_list)[None, :, :, :]
     else:
-        return _GMM_sampling_Covs(means_list, clusters_list, covs_list, alea)
+        chols = np.linalg.cholesky(covs_list)
+    return _GMM_sampling_qmc_chols(means_list, weights_list, chols, size, seed=seed, out=out)
+
+
+@nb.njit(nogil=True, parallel=True, fastmath=True, cache=True)
+def _components_logpdf(x_points, means, chols, half_log_dets):
+    """log pdf of each component, with precomputed cholesky factors.
+    x_points shape N,L ; means shape K,L ; chols shape K,L,L ; half_log_dets shape K
+    Returns shape K,N"""
+    N, L = x_points.shape
+    K = means.shape[0]
+    out = np.empty((K, N))
+    for n in nb.prange(N):
+        z = np.empty(L)
+        for k in range(K):
+            q = 0.
+            for i in range(L):
+                v = x_points[n, i] - means[k, i]
+                for j in range(i):
+                    v -= chols[k, i, j] * z[j]
+                z[i] = v / chols[k, i, i]
+                q += z[i] ** 2
+            out[k, n] = -0.5 * (L * _LOG_2PI + q) - half_log_dets[k]
+    return out
+
+
+MIXTURE_BLOCK_SIZE = 256
+"""Number of points processed together by the mixture log-density kernel (kept in cache over all components)"""
+
+
+# no 'nnan' nor 'ninf' fast math flags : -inf weights and densities must be handled exactly
+@nb.njit(nogil=True, parallel=True, fastmath={"reassoc", "contract", "arcp"}, cache=True)
+def _mixtures_logpdf(x_points, log_weightss, meanss, chols, half_log_dets, block_size):
+    """Log-density of N mixtures sharing covariances, computed in log space with a streaming logsumexp.
+    Work is split in (mixture, block of points) jobs ; in a job, components are the outer loop, so that
+    one cholesky factor and the block of points stay in cache.
+
+    :param x_points: shape 1,NX,L (same points for every mixture) or N,NX,L
+    :param log_weightss: shape N,K
+    :param meanss: shape N,K,L
+    :param chols: shape K,L,L
+    :param half_log_dets: shape K
+    :return: shape N,NX
+    """
+    N, K, L = meanss.shape
+    NX = x_points.shape[1]
+    x_step = 0 if x_points.shape[0] == 1 else 1
+    nb_blocks = (NX + block_size - 1) // block_size
+    out = np.empty((N, NX))
+    for job in nb.prange(N * nb_blocks):
+        n = job // nb_blocks
+        start = (job % nb_blocks) * block_size
+        size = min(block_size, NX - start)
+        x = x_points[n * x_step]
+        maxs = np.full(size, -np.inf)
+        sums = np.zeros(size)
+        z = np.empty(L)
+        for k in range(K):
+            log_w = log_weightss[n, k]
+            if log_w == -np.inf:
+                continue
+            for p in range(size):
+                q = 0.
+                for i in range(L):
+                    v = x[start + p, i] - meanss[n, k, i]
+                    for j in range(i):
+                        v -= chols[k, i, j] * z[j]
+                    z[i] = v / chols[k, i, i]
+                    q += z[i] ** 2
+                v = log_w - 0.5 * (L * _LOG_2PI + q) - half_log_dets[k]
+                if v > maxs[p]:
+                    sums[p] = sums[p] * np.exp(maxs[p] - v) + 1.
+                    maxs[p] = v
+                else:
+                    sums[p] += np.exp(v - maxs[p])
+        for p in range(size):
+            out[n, start + p] = maxs[p] + np.log(sums[p])
+    return out
+
+
+def _half_log_dets(chols):
+    """log(sqrt(det(cov))) from cholesky factors (shape ...,L,L)"""
+    return np.sum(np.log(np.diagonal(chols, axis1=-2, axis2=-1)), axis=-1)
+
+
+class MixtureDensity:
+    """Gaussian mixture whose covariances are factorised once, at creation.
+
+    :param weights: shape K
+    :param means: shape K,L
+    :param covs: shape K,L,L
+    :param chols: cholesky factors of covs, computed if not given
+    :param half_log_dets: log(sqrt(det(cov))), computed from chols if not given
+    """
+
+    def __init__(self, weights, means, covs, chols=None, half_log_dets=None):
+        self.weights, self.means, self.covs = weights, means, covs
+        self.chols = cholesky_list(covs) if chols is None else chols
+        self.half_log_dets = _half_log_dets(self.chols) if half_log_dets is None else half_log_dets
+
+    @property
+    def K(self):
+        return self.means.shape[0]
+
+    @property
+    def L(self):
+        return self.means.shape[1]
+
+    def marginal(self, marginals):
+        """Mixture of the marginal law on marginals dimensions"""
+        covs = self.covs[:, marginals, :][:, :, marginals]
+        return MixtureDensity(self.weights, self.means[:, marginals], covs)
+
+    def components_logpdf(self, x_points):
+        """Returns log pdf of each component (not weighted), shape K,N"""
+        return _components_logpdf(x_points, self.means, self.chols, self.half_log_dets)
+
+    def logpdf(self, x_points):
+        """x_points shape N,L. Returns shape N"""
+        with np.errstate(divide="ignore"):
+            log_weights = np.log(self.weights)
+        return _mixtures_logpdf(x_points[None, :, :], log_weights[None, :], self.means[None, :, :],
+                                self.chols, self.half_log_dets, MIXTURE_BLOCK_SIZE)[0]
+
+    def pdf(self, x_points):
+        return np.exp(self.logpdf(x_points))
+
+    def component_heights(self):
+        """Heights of weighted components : weight / sqrt(det(cov))"""
+        return self.weights * np.exp(- self.half_log_dets)
+
+    def mean_cov(self):
+        return _mean_melange(self.weights, self.means), covariance_melange(self.weights, self.means, self.covs)
+
+    def sample(self, size, method="mc", seed=None):
+        """Returns shape size,L. method is 'mc' (pseudo-random), 'qmc' (see GMM_sampling_qmc)
+        or 'streams' (see GMM_sampling_chunks)"""
+        if method == "qmc":
+            return _GMM_sampling_qmc_chols(self.means[None, :, :], self.weights[None, :], self.chols[None, :, :, :],
+                                           size, seed=seed)[0]
+        if method == "streams":
+            out = np.empty((1, size, self.L))
+            cython.sampling_streams_chols(self.means[None, :, :], self.weights[None, :], self.chols[None, :, :, :],
+                                          GMM_streams(1, seed), out)
+            return out[0]
+        alea = np.random.multivariate_normal(np.zeros(self.L), np.eye(self.L), size)
+        clusters = multinomial_sampling(self.weights[None, :], size)
+        return cython.sampling_sameCov_chols(self.means[None, :, :], clusters, self.chols, alea)[0]
+
+
+class ConditionalMixture:
+    """N Gaussian mixtures sharing the same covariances (typically, law of X knowing Y for N observations).
+    Covariances are factorised once.
+
+    :param weightss: shape N,K
+    :param meanss: shape N,K,L
+    :param covs: shape K,L,L
+    :param chols: cholesky factors of covs, computed if not given
+    :param half_log_dets: log(sqrt(det(cov))), computed from chols if not given
+    """
+
+    def __init__(self, weightss, meanss, covs, chols=None, half_log_dets=None):
+        self.weightss, self.meanss, self.covs = weightss, meanss, covs
+        self.chols = cholesky_list(covs) if chols is None else chols
+        self.half_log_dets = _half_log_dets(self.chols) if half_log_dets is None else half_log_dets
+
+    def __len__(self):
+        return self.meanss.shape[0]
+
+    def __getitem__(self, n):
+        """Mixture of observation n, or ConditionalMixture of observations n (slice or indexes),
+        sharing factorisations"""
+        if isinstance(n, slice) or np.ndim(n) > 0:
+            return ConditionalMixture(self.weightss[n], self.meanss[n], self.covs, chols=self.chols,
+                                      half_log_dets=self.half_log_dets)
+        return MixtureDensity(self.weightss[n], self.meanss[n], self.covs, chols=self.chols,
+                              half_log_dets=self.half_log_dets)
+
+    def marginal(self, marginals):
+        covs = self.covs[:, marginals, :][:, :, marginals]
+        return ConditionalMixture(self.weightss, self.meanss[:, :, marginals], covs)
+
+    def logpdf(self, x_points):
+        """x_points shape NX,L (same points for each mixture) or N,NX,L. Returns shape N,NX"""
+        if x_points.ndim == 2:
+            x_points = x_points[None, :, :]
+        with np.errstate(divide="ignore"):
+            log_weightss = np.log(self.weightss)
+        return _mixtures_logpdf(x_points, log_weightss, self.meanss, self.chols, self.half_log_dets,
+                                MIXTURE_BLOCK_SIZE)
+
+    def pdf(self, x_points):
+        return np.exp(self.logpdf(x_points))
+
+    def component_heights(self):
+        """shape N,K"""
+        return self.weightss * np.exp(- self.half_log_dets)[None, :]
+
+    def mean_cov(self):
+        return mean_cov_melange(self.weightss, self.meanss, self.covs)
+
+    def sample(self, size, method="mc", seed=None, states=None):
+        """Returns shape N,size,L. method is 'mc' (pseudo-random), 'qmc' (see GMM_sampling_qmc) or 'streams'
+        (one random stream per mixture, see GMM_sampling_chunks). For 'streams', states (shape N,4) are continued
+        and updated in place if given, so that sampling by chunks gives the same values as one call."""
+        if method == "qmc":
+            return _GMM_sampling_qmc_chols(self.meanss, self.weightss, self.chols[None, :, :, :], size, seed=seed)
+        L = self.meanss.shape[2]
+        if method == "streams":
+            if states is None:
+                states = GMM_streams(len(self), seed)
+            out = np.empty((len(self), size, L))
+            cython.sampling_streams_chols(self.meanss, self.weightss, self.chols[None, :, :, :], states, out)
+            return out
+        alea = np.random.multivariate_normal(np.zeros(L), np.eye(L), size)
+        clusters = multinomial_sampling(self.weightss, size)
+        return cython.sampling_sameCov_chols(self.meanss, clusters, self.chols, alea)
 
 
 if __name__ == '__main__':
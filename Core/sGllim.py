@@ -2,6 +2,7 @@ import numpy as np
 from sklearn.mixture.gaussian_mixture import _estimate_gaussian_parameters
 
 from Core.gllim import GLLiM, get_full_covariances, jGLLiM
+from Core.probas_helper import multinomial_sampling
 
 
 class sGLLiM(GLLiM):
@@ -21,9 +22,7 @@ class sGLLiM(GLLiM):
 
 
         N = rnk.shape[0]
-        s = rnk.cumsum(axis=1)
-        r = np.random.rand(N)[:,None]
-        Z = (s < r).sum(axis=1)
+        Z = multinomial_sampling(rnk, 1)[:, 0]
         if self.verbose:
             print("Choix Z for first obs:",Z[0])
 
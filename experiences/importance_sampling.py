@@ -8,7 +8,17 @@ import numpy
 import numpy as np
 
 from Core.gllim import GLLiM
-from Core.probas_helper import densite_melange, chol_loggausspdf_diag, chol_loggausspdf_precomputed
+from Core.probas_helper import chol_loggausspdf_diag, chol_loggausspdf_precomputed
+from tools.context import valid_mask
+
+
+def gllim_log_q(Xs: numpy.ndarray, Y: numpy.ndarray, gllim: GLLiM):
+    """Compute log of conditionnal density X | Y = y
+    Y shape : Ny,D
+    Xs shape : Ny, Nsample, L
+    return shape Ny, Nsample
+    """
+    return gllim.conditionnal_mixture(Y).logpdf(Xs)
 
 
 def gllim_q(Xs: numpy.ndarray, Y: numpy.ndarray, gllim: GLLiM):
@@ -17,11 +27,7 @@ def gllim_q(Xs: numpy.ndarray, Y: numpy.ndarray, gllim: GLLiM):
     Xs shape : Ny, Nsample, L
     return shape Ny, Nsample
     """
-    Ny, Nsample, _ = Xs.shape
-    meanss, weightss, _ = gllim._helper_forward_conditionnal_density(Y)
-    covs = gllim.SigmakListS
-    out = np.array([densite_melange(X, weights, means, covs) for means, weights, X in zip(meanss, weightss, Xs)])
-    return out
+    return np.exp(gllim_log_q(Xs, Y, gllim))
 
 
 def p_tilde(FXs, Y, noise_cov, noise_mean):
@@ -32,6 +38,11 @@ def p_tilde(FXs, Y, noise_cov, noise_mean):
     noise_mean : shape D (offfset)
     return shape Ny, Nsample
     """
+    return numpy.exp(log_p_tilde(FXs, Y, noise_cov, noise_mean))
+
+
+def log_p_tilde(FXs, Y, noise_cov, noise_mean):
+    """Log of p_tilde"""
     Ny, Nsample, _ = FXs.shape
     out = numpy.empty((Ny, Nsample))
     Y = np.asarray(Y, dtype=float)
@@ -43,12 +54,12 @@ def p_tilde(FXs, Y, noise_cov, noise_mean):
         for i, (y, FX) in enumerate(zip(Y, FXs)):
             out[i] = chol_loggausspdf_precomputed(FX.T + noise_mean.T[:, None], y[:, None], chol)
 
-    return numpy.exp(out)  # we used log pdf so far
+    return out
 
 
-def mean_IS(Y, gllim, F, noise_cov, noise_mean, Nsample=50000):
+def mean_IS(Y, gllim, F, noise_cov, noise_mean, Nsample=50000, method="mc"):
     G = lambda x: x
-    return compute_is(Y, gllim, G, F, noise_cov, noise_mean, Nsample=Nsample)
+    return compute_is(Y, gllim, G, F, noise_cov, noise_mean, Nsample=Nsample, method=method)
 
 
 def _clean_integrate(G: Callable[[np.ndarray], np.ndarray], Xs, ws):
@@ -57,7 +68,7 @@ def _clean_integrate(G: Callable[[np.ndarray], np.ndarray], Xs, ws):
         ws : weights
     """
     GX = G(Xs)
-    mask = ~ np.array([(np.all((0 <= x) * (x <= 1), axis=1) if x.shape[0] > 0 else None) for x in Xs])
+    mask = valid_mask(Xs, np.array([[0., 1.]] * Xs.shape[-1]), invalid=True)
     mask1 = numpy.isfinite(GX).prod(axis=2)
     if GX.ndim == 4:
         mask1 = mask1.prod(axis=2)
@@ -78,26 +89,27 @@ def _clean_integrate(G: Callable[[np.ndarray], np.ndarray], Xs, ws):
     return numpy.sum(GX * ws, axis=1) / numpy.sum(ws, axis=1)
 
 
-def _weight_sample(gllim, Y, F, noise_cov, noise_mean, Nsample):
-    Xs = gllim.predict_sample(Y, nb_per_Y=Nsample)
-    mask = ~ np.array([(np.all((0 <= x) * (x <= 1), axis=1) if x.shape[0] > 0 else None) for x in Xs])
+def _weight_sample(gllim, Y, F, noise_cov, noise_mean, Nsample, method="mc"):
+    Xs = gllim.predict_sample(Y, nb_per_Y=Nsample, method=method)
+    mask = valid_mask(Xs, np.array([[0., 1.]] * Xs.shape[-1]), invalid=True)
     Ny, Nsample, _ = Xs.shape
     FXs = np.ones((Ny, Nsample, gllim.D))
     for i, X in enumerate(Xs):
         fx = F(X)
         fx[mask[i], :] = 0
         FXs[i] = fx
-    ws = p_tilde(FXs, Y, noise_cov, noise_mean) / gllim_q(Xs, Y, gllim)
+    ws = np.exp(log_p_tilde(FXs, Y, noise_cov, noise_mean) - gllim_log_q(Xs, Y, gllim))
     return Xs, ws
 
 
-def compute_is(Y, gllim, G, F, noise_cov, noise_mean, Nsample=50000):
+def compute_is(Y, gllim, G, F, noise_cov, noise_mean, Nsample=50000, method="mc"):
     """Compute E[ G(X) | Y = y] for given parameters (gllim) and noise (r)
     G(X) has to be vectoriel (for generality), ie G : shape (Ny, Nsample, _) -> shape (Ny, Nsample,_).
+    method is the proposal sampling : 'mc' or 'qmc' (randomised quasi-Monte Carlo, Nsample should be a power of 2)
     Return shape : (Ny, _)
     """
     ti = time.time()
-    Xs, ws = _weight_sample(gllim, Y, F, noise_cov, noise_mean, Nsample)
+    Xs, ws = _weight_sample(gllim, Y, F, noise_cov, noise_mean, Nsample, method=method)
     logging.debug(f"Samplings and weights computed in {time.time()-ti:.3f} s")
     return _clean_integrate(G, Xs, ws)
 
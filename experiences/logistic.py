@@ -30,12 +30,9 @@ class LogisticOlivineContext(LabContextOlivine):
     #     D = self.variables_range * emx / (1 + emx)**2
     #     return np.matmul(dF,np.array([np.diag(d) for d in D]))
 
-    def is_X_valid(self,X : np.array):
-        if type(X) is list:
-            mask = [(np.ones(x.shape[0],dtype=bool) if x.shape[0] > 0 else None) for x in X]
-        else:
-            mask = np.ones(X.shape[0],dtype=bool)
-        return mask
+    @property
+    def X_bounds(self):
+        return None  # logit space
 
     def normalize_X(self,X):
         return expit(X)
@@ -92,8 +92,11 @@ class RtlsH2OPolaireNormalized(RtlsH2OPolaire):
         X = super()._get_X_grid(N)
         return self.normalize_X(X)
 
-    def is_X_valid(self, X: np.array):
-        raise NotImplementedError
+    @property
+    def X_bounds(self):
+        """Image of [0,1] by normalize_X"""
+        L = self.L
+        return np.array([self.normalize_X(np.zeros(L)), self.normalize_X(np.ones(L))]).T
 
 
 
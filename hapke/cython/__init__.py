@@ -1,2 +1,3 @@
 from .hapke import Hapke_vect as Hapke_cython
 from .hapke import compute_many_Hapke
+from .hapke import GeometryPlan
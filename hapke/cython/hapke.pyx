@@ -1,5 +1,6 @@
 # cython: profile=True
 
+import multiprocessing
 cimport cython
 cimport numpy as np
 import numpy as np
@@ -10,6 +11,8 @@ from cython.parallel import prange
 
 cdef int VARIANT = 2002
 
+cdef int NUM_THREADS = multiprocessing.cpu_count()
+
 DTYPE = np.double
 ctypedef np.double_t DTYPE_t
 ctypedef (double,double,double,double,double,double,double,double) T8Double
@@ -28,28 +31,6 @@ cdef double pi = np.pi
 
 
 
-cdef T5Double fast_e1_e2(double R,double x, double x0) nogil:
-    cdef double tr, tr2, trtx, trtx0, e2x, e1x, e2x0 , e1x0,
-    tr = tan(R)
-    tr2 = tr**2
-    trtx = tr * tan(x)
-    trtx0 = tr * tan(x0)
-    if trtx == 0:
-        e1x = 0
-        e2x = 0
-    else:
-        e1x = exp(-2 / (trtx * pi))
-        e2x = exp(-1 / (trtx**2 * pi ))
-
-    if trtx0 == 0:
-        e1x0 = 0
-        e2x0 = 0
-    else:
-        e1x0 = exp(-2 / (trtx0  * pi))
-        e2x0 = exp(-1 / (trtx0 **2 * pi ))
-    return e1x,e2x, e1x0, e2x0, tr
-
-
 cdef double H_2002(double x,double y) nogil:
     return (1 + 2 * x) / (1 + 2 * x * y)
 
@@ -79,30 +60,83 @@ cdef T8Double _geom_roughness(double theta0, double theta, double phi) nogil:
     return theta0, theta, cose, sine,cosi,sini,phir,f
 
 
-cdef T3Double compute_roughness(T8Double geom_infos,double R) nogil:
-    """phi in degrees for numerical stability"""
-    cdef double xidz, cose,sine, cosi, sini, e2R, e1R, e2R0, e1R0, mu_b, mu0_b, phir, f, mu0_e, mu_e, S, tR
+# Geometry-only terms of a GeometryPlan
+cdef enum:
+    G_THETA0, G_THETA, G_COSE, G_SINE, G_COSI, G_SINI, G_PHIR, G_F,
+    G_CTHETA, G_ALPHA, G_TAN_THETA, G_TAN_THETA0, G_COS_PHIR, G_SIN2_HALF_PHIR, G_TAN_HALF_PHASE,
+    NB_GEOM_TERMS
+
 
-    theta0,theta ,cose,sine ,cosi,sini,phir,f = geom_infos
+cdef class GeometryPlan:
+    """Geometry-only terms of Hapke model, computed once for fixed geometries (SZA, VZA, DPHI in degrees).
+    terms has shape D, NB_GEOM_TERMS"""
+
+    cdef readonly double[:, ::1] terms
+
+    def __init__(self, double[:] SZA, double[:] VZA, double[:] DPHI):
+        cdef Py_ssize_t d
+        cdef double theta0r, thetar, ctheta
+        cdef double[:, ::1] g = np.zeros((SZA.shape[0], NB_GEOM_TERMS), dtype=DTYPE)
+
+        for d in range(SZA.shape[0]):
+            theta0r = SZA[d] * pi / 180
+            thetar = VZA[d] * pi / 180
+            (g[d, G_THETA0], g[d, G_THETA], g[d, G_COSE], g[d, G_SINE],
+             g[d, G_COSI], g[d, G_SINI], g[d, G_PHIR], g[d, G_F]) = _geom_roughness(theta0r, thetar, DPHI[d])
+
+            ctheta = cos(theta0r) * cos(thetar) + sin(thetar) * sin(theta0r) * cos(g[d, G_PHIR])
+            g[d, G_CTHETA] = ctheta
+            g[d, G_ALPHA] = 4 * cos(theta0r)
+            g[d, G_TAN_THETA] = tan(thetar)
+            g[d, G_TAN_THETA0] = tan(theta0r)
+            g[d, G_COS_PHIR] = cos(g[d, G_PHIR])
+            g[d, G_SIN2_HALF_PHIR] = sin(g[d, G_PHIR] / 2) ** 2
+            g[d, G_TAN_HALF_PHASE] = tan(acos(ctheta) / 2)
+        self.terms = g
+
+    @property
+    def D(self):
+        return self.terms.shape[0]
+
+
+@cython.cdivision(True)
+cdef T3Double compute_roughness(const double* g, double tR, double xidz) nogil:
+    """g are the terms of one geometry, tR = tan(R), xidz = 1 / sqrt(1 + pi tan(R)^2)"""
+    cdef double e2R, e1R, e2R0, e1R0, trtx, trtx0, mu_b, mu0_b, mu0_e, mu_e, S
+    cdef double cose = g[G_COSE], sine = g[G_SINE], cosi = g[G_COSI], sini = g[G_SINI]
+    cdef double phir = g[G_PHIR], f = g[G_F], cphir = g[G_COS_PHIR], s2phir = g[G_SIN2_HALF_PHIR]
+
+    trtx = tR * g[G_TAN_THETA]
+    trtx0 = tR * g[G_TAN_THETA0]
+    if trtx == 0:
+        e1R = 0
+        e2R = 0
+    else:
+        e1R = exp(-2 / (trtx * pi))
+        e2R = exp(-1 / (trtx**2 * pi ))
 
-    xidz = 1 / sqrt(1 + pi * (tan(R) ** 2))
-    e1R, e2R, e1R0, e2R0, tR = fast_e1_e2(R, theta, theta0)
+    if trtx0 == 0:
+        e1R0 = 0
+        e2R0 = 0
+    else:
+        e1R0 = exp(-2 / (trtx0  * pi))
+        e2R0 = exp(-1 / (trtx0 **2 * pi ))
 
     mu_b = xidz * (cose + sine * tR * e2R / (2 - e1R))
     mu0_b = xidz * (cosi + sini * tR * e2R0 / (2 - e1R0))
 
-    if theta0 <= theta:
-        mu0_e = xidz * (cosi + sini * tR * (cos(phir) * e2R + (sin(phir / 2) ** 2) * e2R0) / (
+    if g[G_THETA0] <= g[G_THETA]:
+        mu0_e = xidz * (cosi + sini * tR * (cphir * e2R + s2phir * e2R0) / (
                 2 - e1R - (phir/ pi) * e1R0))
-        mu_e = xidz * (cose + sine * tR * (e2R - (sin(phir / 2) ** 2) * e2R0) / (
+        mu_e = xidz * (cose + sine * tR * (e2R - s2phir * e2R0) / (
                 2 - e1R - (phir / pi) * e1R0))
 
         S = mu_e * cosi * xidz / mu_b / mu0_b / (1 - f + f * xidz * cosi / mu0_b)
     else:
-        mu0_e = xidz * (cosi + sini * tR * (e2R0 - sin(phir / 2) ** 2 * e2R) / (
+        mu0_e = xidz * (cosi + sini * tR * (e2R0 - s2phir * e2R) / (
                 2 - e1R0 - (phir / pi) * e1R))
 
-        mu_e = xidz * (cose + sine * tR * (cos(phir) * e2R0 + sin(phir / 2) ** 2 * e2R) / (
+        mu_e = xidz * (cose + sine * tR * (cphir * e2R0 + s2phir * e2R) / (
                 2 - e1R0 - (phir / pi) * e1R))
 
         S = mu_e * cosi * xidz / mu_b / mu0_b / (1 - f + f * xidz * cose / mu_b)
@@ -110,84 +144,106 @@ cdef T3Double compute_roughness(T8Double geom_infos,double R) nogil:
     return mu0_e,mu_e, S
 
 
+@cython.cdivision(True)
+cdef double _reff(const double* g, double tR, double xidz, double gamma,
+                  double w, double b, double c, double h, double b0) nogil:
+    """Reflectance for one geometry. tR, xidz (see compute_roughness) and gamma = sqrt(1 - w) only depend on X"""
+    cdef double MUP, MU, S, bc, b2, P, B, H, H0, reff
+
+    MUP, MU, S = compute_roughness(g, tR, xidz)
+    bc = 2 * b * g[G_CTHETA]
+    b2 = b**2
+    P =  (1 - c) * (1 - b2) / ((1 + bc + b2)**1.5)
+    P = P + c *(1 - b2) / ((1- bc + b2)**1.5)
+
+    B = b0 * h / ( h + g[G_TAN_HALF_PHASE] )
+    if VARIANT == 1993:
+        H0 = H_1993(MUP,gamma)
+        H = H_1993(MU,gamma)
+    else:
+        H0 = H_2002(MUP,gamma)
+        H = H_2002(MU,gamma)
+    reff = ( (w / (MU + MUP)) * ((1 + B) * P + (H0 * H) - 1)  )
+    return reff *  S * MUP  / g[G_ALPHA]
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void C_Hapke_vect(const double[:] SZA, const double[:] VZA, const double[:] DPHI,
+cdef void C_Hapke_vect(const double[:, ::1] g,
                        const double[:] W, const double[:] R1, const double[:] BB,
                        const double[:] CC, const double[:] HH, const double[:] B0,
                        double[:,:] out) nogil:
-    """ Write the result in out  """
-
-    cdef double theta0r, thetar, phir, r, c, b, h, b0, w, reff, MUP, MU, S,  ctheta, theta
-    cdef double bc,b2,P, B, H, H0, gamma, alpha# var temporaires
-    cdef T8Double geom_infos
-
+    """ Write the result in out. g are the terms of a GeometryPlan """
+    cdef double tR, xidz, gamma
     cdef Py_ssize_t Nx = W.shape[0]
-    cdef Py_ssize_t D = SZA.shape[0]
+    cdef Py_ssize_t D = g.shape[0]
 
     cdef Py_ssize_t n,d # loop indices
 
-    for d in range(D):
-        theta0r = SZA[d] * pi / 180
-        thetar = VZA[d] * pi / 180
-        geom_infos = _geom_roughness(theta0r,thetar,DPHI[d])
-
-        phir = DPHI[d] * pi / 180
-        ctheta = cos(theta0r) * cos(thetar) + sin(thetar) * sin(theta0r) * cos(phir)
-        theta = acos(ctheta)
-
-        alpha = 4 * cos(theta0r)
-
-        for n in range(Nx):
-            r = R1[n] * pi / 180  # radians
-            MUP, MU, S = compute_roughness(geom_infos,r)
-            c = CC[n]
-            b = BB[n]
-            h = HH[n]
-            b0 = B0[n]
-            w = W[n]
-            bc = 2 * b * ctheta
-            b2 = b**2
-            P =  (1 - c) * (1 - b2) / ((1 + bc + b2)**1.5)
-            P = P + c *(1 - b2) / ((1- bc + b2)**1.5)
-
-            B = b0 * h / ( h + tan(theta/2) )
-            gamma = sqrt(1 - w)
-            if VARIANT == 1993:
-                H0 = H_1993(MUP,gamma)
-                H = H_1993(MU,gamma)
-            else:
-                H0 = H_2002(MUP,gamma)
-                H = H_2002(MU,gamma)
-            reff = ( (w / (MU + MUP)) * ((1 + B) * P + (H0 * H) - 1)  )
-            reff = reff *  S * MUP  / alpha
-            out[n,d] = reff
+    for n in range(Nx):
+        tR = tan(R1[n] * pi / 180)
+        xidz = 1 / sqrt(1 + pi * (tR ** 2))
+        gamma = sqrt(1 - W[n])
+        for d in range(D):
+            out[n,d] = _reff(&g[d, 0], tR, xidz, gamma, W[n], BB[n], CC[n], HH[n], B0[n])
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void C_Hapke_vect_parallel(const double[:, ::1] g,
+                                const double[:] W, const double[:] R1, const double[:] BB,
+                                const double[:] CC, const double[:] HH, const double[:] B0,
+                                double[:, ::1] rows, double[:,:] out, int num_threads) nogil:
+    """Same as C_Hapke_vect, parallel over (parameter row, geometry) pairs.
+    rows (shape Nx, 3) stores terms depending only on X"""
+    cdef Py_ssize_t Nx = W.shape[0]
+    cdef Py_ssize_t D = g.shape[0]
+    cdef Py_ssize_t k, n, d
+    cdef double tR
+
+    for n in prange(Nx, nogil=True, num_threads=num_threads, schedule='static'):
+        tR = tan(R1[n] * pi / 180)
+        rows[n, 0] = tR
+        rows[n, 1] = 1 / sqrt(1 + pi * (tR ** 2))
+        rows[n, 2] = sqrt(1 - W[n])
+
+    for k in prange(Nx * D, nogil=True, num_threads=num_threads, schedule='static'):
+        n = k // D
+        d = k % D
+        out[n,d] = _reff(&g[d, 0], rows[n, 0], rows[n, 1], rows[n, 2], W[n], BB[n], CC[n], HH[n], B0[n])
+
 
 def Hapke_vect(double[:] SZA, double[:] VZA, double[:] DPHI, double[:] W, double[:] R1, double[:] BB,
-double[:] CC, double[:] HH, double[:] B0):
-    """ Returns a matrix of reflectance of shape Nx , D """
+double[:] CC, double[:] HH, double[:] B0, int num_threads = 0, GeometryPlan plan = None):
+    """ Returns a matrix of reflectance of shape Nx , D
+    num_threads : 0 for all available cores, 1 for sequential.
+    plan : GeometryPlan of (SZA, VZA, DPHI), to avoid computing it again."""
     cdef Py_ssize_t Nx = W.shape[0]
-    cdef Py_ssize_t D = SZA.shape[0]
 
-    reff = np.zeros((Nx,D),dtype=DTYPE)
-
-    C_Hapke_vect(SZA, VZA, DPHI, W, R1, BB, CC, HH, B0 , reff)
+    if plan is None:
+        plan = GeometryPlan(SZA, VZA, DPHI)
+    reff = np.zeros((Nx,plan.D),dtype=DTYPE)
 
+    if num_threads <= 0:
+        num_threads = NUM_THREADS
+    if num_threads == 1:
+        C_Hapke_vect(plan.terms, W, R1, BB, CC, HH, B0 , reff)
+    else:
+        C_Hapke_vect_parallel(plan.terms, W, R1, BB, CC, HH, B0, np.zeros((Nx, 3), dtype=DTYPE), reff, num_threads)
     return reff
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef void _compute_many(const double[:] SZA,const double[:] VZA,const double[:] DPHI,const double[:,:,:] Xs,
+cdef void _compute_many(const double[:, ::1] g,const double[:,:,:] Xs,
                         const long[:,:] mask, const long[:] partiel_indexes, const long[:] permutation,
                         const double[:] x0, const double[:] xrange,
                         double[:,:,:] Xfull, double[:,:,:] out) nogil:
     cdef Py_ssize_t N = Xs.shape[0]
     cdef Py_ssize_t Ns = Xs.shape[1]
-    cdef Py_ssize_t D = SZA.shape[0]
+    cdef Py_ssize_t D = g.shape[0]
     cdef Py_ssize_t Lpartiel = Xs.shape[2]
     cdef Py_ssize_t L = x0.shape[0]
 
@@ -201,7 +257,7 @@ cdef void _compute_many(const double[:] SZA,const double[:] VZA,const double[:]
             for n in range(Ns):
                 Xfull[i,n,hapke_vect_index] = x0[j] + xrange[j] * Xs[i,n,j]
 
-        C_Hapke_vect(SZA, VZA, DPHI, Xfull[i,:,0], Xfull[i,:,1], Xfull[i,:,2], Xfull[i,:,3], Xfull[i,:,4], Xfull[i,:,5], out[i])
+        C_Hapke_vect(g, Xfull[i,:,0], Xfull[i,:,1], Xfull[i,:,2], Xfull[i,:,3], Xfull[i,:,4], Xfull[i,:,5], out[i])
         for n in range(Ns):
             if mask[i,n]:
                 for d in range(D):
@@ -209,20 +265,22 @@ cdef void _compute_many(const double[:] SZA,const double[:] VZA,const double[:]
 
 
 def compute_many_Hapke(geometries, Xs, mask, partiel_indexes, default_values,
-                       x0, xrange, permutation):
+                       x0, xrange, permutation, GeometryPlan plan = None):
     """ Compute Hapke(X) and apply the mask.
     prepare X by adding default values and scaling with x0 + xrange * X
     then permutes axes according to permutation : permutation[i] gives the place of Xfull[i] in Hapke_vect
     L = len(partiel_indexes) + len(default_values)
+    plan : GeometryPlan of geometries, to avoid computing it again.
     """
     SZA, VZA, DPHI = geometries
+    if plan is None:
+        plan = GeometryPlan(np.asarray(SZA, dtype=DTYPE), np.asarray(VZA, dtype=DTYPE), np.asarray(DPHI, dtype=DTYPE))
     N, Ns, _ = Xs.shape
-    D = SZA.shape[0]
-    FXs = np.zeros((N, Ns, D))
+    FXs = np.zeros((N, Ns, plan.D))
 
     Xfull = np.array([[default_values] * Ns] * N)
 
-    _compute_many(SZA, VZA, DPHI, Xs, mask, np.array(partiel_indexes), np.array(permutation), np.array(x0),
+    _compute_many(plan.terms, Xs, mask, np.array(partiel_indexes), np.array(permutation), np.array(x0),
                   np.array(xrange), Xfull, FXs)
 
     return FXs
@@ -0,0 +1,65 @@
+import os
+import tempfile
+import time
+
+import numpy as np
+import pytest
+from scipy.stats import multivariate_normal
+
+from Core.gllim import GLLiM
+from tools import archive
+
+
+def test_inference_file(N=5000, L=3, D=6, K=20, Nobs=200):
+    """GLLiM saved for inference, and loaded back (memory map) : same arrays and same predictions"""
+    print("\nTesting inference files...")
+    X = np.random.random_sample((N, L))
+    A = np.random.random_sample((D, L))
+    Y = np.sin(X.dot(A.T)) + 0.01 * np.random.randn(N, D)
+    gllim = GLLiM(K, 0, sigma_type="full", gamma_type="full", verbose=None)
+    gllim.fit(X, Y, {"type": "kmeans"}, maxIter=5)
+    gllim.inversion()
+    Yobs = np.sin(np.random.random_sample((Nobs, L)).dot(A.T))
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "model.inf")
+        ti = time.time()
+        archive.save_inference_file(path, gllim.inference_parameters())
+        print(f"Saving  : {time.time() - ti:.3f} s")
+        ti = time.time()
+        arrays = archive.load_inference_file(path)
+        loaded = GLLiM.from_inference_parameters(arrays)
+        print(f"Loading : {time.time() - ti:.3f} s")
+
+        for name, a in gllim.inference_parameters().items():
+            assert np.array_equal(arrays[name], a)
+            assert not arrays[name].flags.writeable
+        assert np.allclose(arrays["GammakListS_logdet"], np.linalg.slogdet(gllim.GammakListS)[1])
+        assert np.allclose(arrays["SigmakListS_logdet"], np.linalg.slogdet(gllim.SigmakListS)[1])
+        # loaded factorisations and log-determinants are used as is
+        assert loaded.GammakListS_chol is arrays["GammakListS_chol"]
+        assert loaded.GammakListS_logdet is arrays["GammakListS_logdet"]
+        assert loaded.SigmakListS_logdet is arrays["SigmakListS_logdet"]
+        mixtures = loaded.conditionnal_mixture(Yobs)
+        assert mixtures.chols is arrays["SigmakListS_chol"]
+        assert np.array_equal(mixtures.half_log_dets, 0.5 * arrays["SigmakListS_logdet"])
+
+        # forward density against a direct evaluation
+        _, _, normalisation = loaded._helper_forward_conditionnal_density(Yobs)
+        expected = sum(pik * multivariate_normal.pdf(Yobs, ck, Gammak)
+                       for pik, ck, Gammak in zip(gllim.pikList, gllim.ckListS, gllim.GammakListS))
+        assert np.allclose(normalisation[:, 0], expected)
+        Xpred1, Covs1 = gllim.predict_high_low(Yobs, with_covariance=True)
+        Xpred2, Covs2 = loaded.predict_high_low(Yobs, with_covariance=True)
+        assert np.allclose(Xpred1, Xpred2)
+        assert np.allclose(Covs1, Covs2)
+        Xs = np.random.random_sample((Nobs, 10, L))
+        assert np.allclose(gllim.conditionnal_mixture(Yobs).logpdf(Xs), loaded.conditionnal_mixture(Yobs).logpdf(Xs))
+
+        with pytest.raises(ValueError):
+            archive.save_inference_file(path, {"x" * 33: np.zeros(3)})
+        del arrays, loaded
+
+
+if __name__ == '__main__':
+    test_inference_file()
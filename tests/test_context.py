@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+
+from tools import context
+
+
+def _F(X):
+    return np.concatenate((np.sin(3 * X), X ** 2, X[..., :1] * X[..., 1:]), axis=-1)
+
+
+def test_batched_evaluation(N=200, Ns=1000, L=2, batch_size=30000):
+    """Batched evaluation of F (sequential and in threads), skipping invalid samples, against direct evaluation"""
+    print("\nTesting batched evaluation...")
+    Xs = np.random.random_sample((N, Ns, L)) * 1.2 - 0.1
+    bounds = [[0, 1]] * L
+    valid = context.valid_mask(Xs, bounds)
+    expected = _F(Xs) * valid[:, :, None]
+    for n_jobs in (1, 2):
+        ti = time.time()
+        FXs = context.batched_evaluation(_F, Xs, mask=context.valid_mask(Xs, bounds, invalid=True),
+                                         batch_size=batch_size, n_jobs=n_jobs)
+        print(f"Batched evaluation ({n_jobs} jobs) : {time.time() - ti:.3f} s")
+        assert np.allclose(FXs, expected)
+
+    # every sample skipped
+    FXs = context.batched_evaluation(_F, Xs[:2], mask=np.ones((2, Ns), dtype=int), D=5)
+    assert FXs.shape == (2, Ns, 5) and np.all(FXs == 0)
+
+
+def test_batched_evaluation_list(L=2):
+    """List of samples sets, with empty sets and masks from is_X_valid (None for empty sets)"""
+    print("\nTesting batched evaluation of samples sets...")
+    sets = [np.random.random_sample((3, L)) * 1.2 - 0.1, np.empty((0, L)), np.random.random_sample((1, L)),
+            np.empty((0, L))]
+    valid = [(context.valid_mask(x, [[0, 1]] * L) if len(x) > 0 else None) for x in sets]
+    masks = [(None if m is None else ~ m) for m in valid]
+    for mask in (masks, None):
+        FXs = context.batched_evaluation(_F, sets, mask=mask, D=5)
+        assert [len(FX) for FX in FXs] == [len(x) for x in sets]
+        for x, FX, m in zip(sets, FXs, masks):
+            expected = _F(x) if (mask is None or m is None) else _F(x) * (~ m)[:, None]
+            assert np.allclose(FX, expected)
+
+    FXs = context.batched_evaluation(_F, sets, mask=[None] * len(sets), D=5)
+    assert all(np.allclose(FX, _F(x)) for x, FX in zip(sets, FXs))
+
+
+if __name__ == '__main__':
+    test_batched_evaluation()
+    test_batched_evaluation_list()
@@ -0,0 +1,90 @@
+import time
+
+import numpy as np
+
+import hapke.cython
+from hapke import hapke_vect
+
+
+def _geometries(D):
+    """Random geometries, with edge cases : backscattering plane (phi = 0, 180) and nadir view"""
+    SZA, VZA, DPHI = np.random.uniform(0, 70, D), np.random.uniform(0, 70, D), np.random.uniform(0, 180, D)
+    DPHI[0], DPHI[1], VZA[2] = 180, 0, 0
+    SZA[3], VZA[3], DPHI[3] = 30, 30, 180
+    return SZA, VZA, DPHI
+
+
+def _parameters(N):
+    """W, R, BB, CC, HH, B0, with smooth surfaces (R = 0) first"""
+    W, R = np.random.uniform(0.05, 0.95, N), np.random.uniform(0, 30, N)
+    R[:N // 10] = 0
+    return [W, R] + [np.random.random_sample(N) for _ in range(4)]
+
+
+def test_hapke_reference(N=500, D=20):
+    """Cython implementation against the numpy port"""
+    print("\nTesting Hapke against numpy implementation...")
+    SZA, VZA, DPHI = _geometries(D)
+    X = _parameters(N)
+    ti = time.time()
+    reff = hapke.cython.Hapke_cython(SZA, VZA, DPHI, *X)
+    print(f"Cython : {time.time() - ti:.3f} s")
+    args = np.broadcast_arrays(SZA[None, :], VZA[None, :], DPHI[None, :], *[x[:, None] for x in X])
+    ti = time.time()
+    expected = hapke_vect.Hapke_vect(*[np.ravel(a) for a in args]).reshape((N, D))
+    print(f"Numpy  : {time.time() - ti:.3f} s")
+    assert np.isfinite(reff).all()
+    assert np.allclose(reff, expected)
+
+
+def test_hapke_threads(N=20000, D=40):
+    """Sequential and parallel evaluations, with and without geometry plan, give the same values"""
+    print("\nTesting Hapke threads and geometry plan...")
+    SZA, VZA, DPHI = _geometries(D)
+    X = _parameters(N)
+    plan = hapke.cython.GeometryPlan(SZA, VZA, DPHI)
+    assert plan.D == D
+    reff = hapke.cython.Hapke_cython(SZA, VZA, DPHI, *X, num_threads=1)
+    for num_threads in (1, 2, 0):
+        for p in (None, plan):
+            ti = time.time()
+            r = hapke.cython.Hapke_cython(SZA, VZA, DPHI, *X, num_threads=num_threads, plan=p)
+            print(f"{num_threads or 'all'} threads, {'with' if p else 'without'} plan : {time.time() - ti:.3f} s")
+            assert np.array_equal(r, reff)
+    assert hapke.cython.Hapke_cython(SZA, VZA, DPHI, *[x[:0] for x in X]).shape == (0, D)
+
+
+def test_compute_many_hapke(N=50, Ns=300, D=20):
+    """Batched evaluation (defaults, scaling, permutation, mask) against Hapke_vect on each observation"""
+    print("\nTesting compute_many_Hapke...")
+    geometries = _geometries(D)
+    partiel = np.array([0, 1])
+    permutation = np.array([1, 0, 2, 3, 4, 5])  # first variable is the roughness, second the albedo
+    default_values = np.array([0.5, 15, 0.3, 0.4, 0.5, 0.6])  # in Hapke_vect order
+    x0, xrange = np.array([0., 0.05]), np.array([30., 0.9])
+    Xs = np.random.random_sample((N, Ns, 2))
+    Xs[:, :10, 0] = 0  # smooth surfaces
+    mask = np.asarray(np.random.random_sample((N, Ns)) < 0.1, dtype=int)
+
+    plan = hapke.cython.GeometryPlan(*geometries)
+    ti = time.time()
+    FXs = hapke.cython.compute_many_Hapke(geometries, Xs, mask, partiel, default_values, x0, xrange, permutation)
+    print(f"Batched : {time.time() - ti:.3f} s")
+    FXs_plan = hapke.cython.compute_many_Hapke(geometries, Xs, mask, partiel, default_values, x0, xrange,
+                                               permutation, plan=plan)
+    assert np.array_equal(FXs, FXs_plan)
+
+    Xfull = np.tile(default_values, (N, Ns, 1))
+    for j, true_j in enumerate(partiel):
+        Xfull[:, :, permutation[true_j]] = x0[j] + xrange[j] * Xs[:, :, j]
+    for i in range(N):
+        expected = hapke.cython.Hapke_cython(*geometries, *np.ascontiguousarray(Xfull[i].T))
+        expected[mask[i] == 1] = 0
+        assert np.allclose(FXs[i], expected)
+    assert np.isfinite(FXs).all()
+
+
+if __name__ == '__main__':
+    test_hapke_reference()
+    test_hapke_threads()
+    test_compute_many_hapke()
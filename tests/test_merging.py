@@ -0,0 +1,107 @@
+import time
+
+import numpy as np
+
+from Core import mixture_merging, probas_helper
+
+
+def _reference_reduce(weights, means, covs, target_K, threshold=np.inf):
+    """Plain Runnalls reduction of one mixture"""
+    weights, means, covs = list(weights), list(means), list(covs)
+    while len(weights) > target_K:
+        best = None
+        for i in range(len(weights)):
+            for j in range(i + 1, len(weights)):
+                w = weights[i] + weights[j]
+                wi, wj = weights[i] / w, weights[j] / w
+                m = wi * means[i] + wj * means[j]
+                diff = means[i] - means[j]
+                C = wi * covs[i] + wj * covs[j] + wi * wj * np.outer(diff, diff)
+                d = 0.5 * (w * np.linalg.slogdet(C)[1] - weights[i] * np.linalg.slogdet(covs[i])[1]
+                           - weights[j] * np.linalg.slogdet(covs[j])[1])
+                if best is None or d < best[0]:
+                    best = (d, i, j, w, m, C)
+        d, i, j, w, m, C = best
+        if d > threshold:
+            break
+        for l in (weights, means, covs):
+            del l[j]
+        weights[i], means[i], covs[i] = w, m, C
+    return np.array(weights), np.array(means), np.array(covs)
+
+
+def _random_mixtures(N, K, L):
+    covs = []
+    for k in range(K):
+        T = np.tril(np.random.random_sample((L, L))) + np.eye(L)
+        covs.append(np.dot(T, T.T) * 0.1)
+    weightss = np.random.random_sample((N, K))
+    weightss /= weightss.sum(axis=1, keepdims=True)
+    meanss = np.random.random_sample((N, K, L))
+    return weightss, meanss, np.array(covs)
+
+
+def _sorted(ws, ms, covs):
+    order = np.argsort(ws)
+    return ws[order], ms[order], covs[order]
+
+
+def test_merge(N=100, K=10, L=3, target_K=2):
+    """Compare merging engine with a plain python implementation"""
+    print("\nTesting mixture merging...")
+    weightss, meanss, covs = _random_mixtures(N, K, L)
+    mixture_merging._merge(weightss[:1], meanss[:1], covs, target_K=target_K)  # compiling
+
+    ti = time.time()
+    ws, ms, cs = mixture_merging._merge(weightss, meanss, covs, target_K=target_K)
+    print(f"Merging engine : {time.time() - ti:.3f} s")
+
+    ti = time.time()
+    refs = [_reference_reduce(w, m, covs, target_K) for w, m in zip(weightss, meanss)]
+    print(f"Python         : {time.time() - ti:.3f} s")
+
+    for n, ref in enumerate(refs):
+        for a, b in zip(_sorted(ws[n], ms[n], cs[n]), _sorted(*ref)):
+            assert np.allclose(a, b)
+
+
+def test_merge_threshold(N=100, K=10, L=3, threshold=0.02):
+    """Stopping on discrimination : mixtures are padded with null components"""
+    print("\nTesting mixture merging with threshold...")
+    weightss, meanss, covs = _random_mixtures(N, K, L)
+    ws, ms, cs = mixture_merging._merge(weightss, meanss, covs, target_K=1, threshold=threshold)
+    for n in range(N):
+        ref = _reference_reduce(weightss[n], meanss[n], covs, 1, threshold=threshold)
+        kept = ws[n] > 0
+        assert kept.sum() == len(ref[0])
+        assert np.allclose(ws[n][~kept], 0)
+        for a, b in zip(_sorted(ws[n][kept], ms[n][kept], cs[n][kept]), _sorted(*ref)):
+            assert np.allclose(a, b)
+    print(f"Average number of components kept : {(ws > 0).sum(axis=1).mean():.2f}")
+
+
+def test_bulk_merge(N=100, K=30, L=3, m=8):
+    """Pre-pruning : dropping is a reduction of the heaviest components, moment matching preserves moments"""
+    print("\nTesting pre-pruning...")
+    weightss, meanss, covs = _random_mixtures(N, K, L)
+    weightss **= 4
+    weightss /= weightss.sum(axis=1, keepdims=True)
+
+    _, _, Xweights, discarded = mixture_merging.merge_predict(weightss, meanss, covs, pruning=m, with_discarded=True)
+    for n in range(N):
+        order = np.argsort(- weightss[n])[:m]
+        assert np.isclose(discarded[n], 1 - weightss[n, order].sum())
+        ref = _reference_reduce(weightss[n, order] / weightss[n, order].sum(), meanss[n, order], covs[order], 2)
+        assert np.allclose(np.sort(Xweights[n], axis=0), np.sort(ref[1], axis=0))
+
+    Xpred, Covs, _ = mixture_merging.merge_predict(weightss, meanss, covs, pruning=0.01, pruning_mode="moment")
+    Xmean, Xcov = probas_helper.mean_cov_melange(weightss, meanss, covs)
+    assert np.allclose(Xpred, Xmean)
+    assert np.allclose(Covs, Xcov)
+    print(f"Average discarded mass (top {m}) : {discarded.mean():.4f}")
+
+
+if __name__ == '__main__':
+    test_merge()
+    test_merge_threshold()
+    test_bulk_merge()
@@ -1,9 +1,12 @@
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
-from Core import cython, em_is_gllim
+from Core import cython, em_is_gllim, noise_GD
+from Core.gllim import GLLiM
 from old import em_is_gllim_jit
+from tools import context
 
 
 def test_mu_step_diag(Ny=10000, Ns=40, D=10, L=4, K=40):
@@ -131,6 +134,302 @@ def test_mu_step_full(Ny=100, Ns=4000, D=10, L=4, K=40):
     # assert np.allclose(ws3, ws4)
     assert np.allclose(ws3, ws5)
 
+
+def test_mu_step_IS(Ny=200, Ns=500, D=10, L=4, K=40):
+    """Batched kernel (sequential and parallel) against joblib tasks, for diagonal and full noise covariance"""
+    print("\nTesting mu_step_IS...")
+    T = np.tril(np.ones((L, L))) * 0.456
+    gllim_covs = np.array([np.dot(T, T.T)] * K)
+    weightss = np.random.random_sample((Ny, K))
+    weightss /= weightss.sum(axis=1, keepdims=True)
+    meanss = np.random.random_sample((Ny, K, L)) * 12.2
+    current_mean = np.random.random_sample(D)
+    Yobs = np.random.random_sample((Ny, D))
+    Xs = np.random.random_sample((Ny, Ns, L))
+    FXs = np.random.random_sample((Ny, Ns, D)) * 9
+    mask = np.asarray(np.random.random_sample((Ny, Ns)) > 0.4, dtype=int)
+    T = np.tril(np.ones((D, D))) * 0.389
+
+    for current_cov in (np.arange(D) + 1.2, np.dot(T, T.T)):
+        joblib_step = em_is_gllim.mu_step_diag_IS_joblib if current_cov.ndim == 1 else \
+            em_is_gllim.mu_step_full_IS_joblib
+        ti = time.time()
+        maximal_mu1, ws1 = joblib_step(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean, current_cov)
+        print(f"Joblib (threads)  : {time.time() - ti:.3f} s")
+        for num_threads in (1, 0):
+            ti = time.time()
+            maximal_mu2, ws2 = cython.mu_step_IS(Yobs, Xs, meanss, weightss, FXs, mask, gllim_covs, current_mean,
+                                                 current_cov, num_threads=num_threads)
+            print(f"Batched kernel ({num_threads or 'all'} threads) : {time.time() - ti:.3f} s")
+            assert np.allclose(maximal_mu1, maximal_mu2)
+            assert np.allclose(ws1, ws2)
+
+
+def _F(X):
+    return np.concatenate((np.sin(3 * X), X ** 2, X[..., :1] * X[..., 1:]), axis=-1)
+
+
+_F_MATRIX = np.array([[1, 0], [0, 2], [1, 1], [0.5, 0], [1, -1]])
+
+
+def _F_linear(X):
+    return X.dot(_F_MATRIX.T)
+
+
+def _fit_gllim(F, N=3000, K=10, maxIter=10):
+    X = np.random.random_sample((N, 2))
+    Y = F(X) + 0.05 * np.random.randn(N, 5)
+    gllim = GLLiM(K, 0, sigma_type="full", gamma_type="full", verbose=None)
+    gllim.fit(X, Y, {"type": "kmeans"}, maxIter=maxIter)
+    gllim.inversion()
+    return gllim
+
+
+def _setup_em_step(Ny=20, N=3000, K=10, F=_F):
+    """Small gllim learned on F, and helpers as in NoiseEM"""
+    gllim = _fit_gllim(F, N=N, K=K)
+    Yobs = np.ascontiguousarray(F(np.random.random_sample((Ny, 2))) + 0.2 + 0.05 * np.random.randn(Ny, 5))
+
+    def compute_Fs(Xs, mask):
+        FXs = F(Xs)
+        FXs[mask == 1] = 0
+        return FXs
+
+    def get_X_mask(Xs):
+        return np.asarray(~ np.all((0 <= Xs) * (Xs <= 1), axis=2), dtype=int)
+
+    return gllim, compute_Fs, get_X_mask, Yobs
+
+
+def test_em_step_IS_chunked(Ns=4000):
+    """Chunked IS-EM step with one chunk should match the full one, on the same samples"""
+    print("\nTesting chunked IS-EM step...")
+    gllim, compute_Fs, get_X_mask, Yobs = _setup_em_step()
+    config = em_is_gllim.NoiseEMConfig(N_sample_IS=Ns)
+    one_chunk = em_is_gllim.NoiseEMConfig(N_sample_IS=Ns, CHUNK_SIZE_IS=Ns)
+    eight_chunks = em_is_gllim.NoiseEMConfig(N_sample_IS=Ns, CHUNK_SIZE_IS=Ns // 8)
+    for current_cov in (0.01 * np.ones(5), 0.01 * np.eye(5)):
+        current_mean = np.zeros(5)
+        np.random.seed(1)
+        ti = time.time()
+        mu1, sigma1, _ = em_is_gllim._em_step_IS(gllim, compute_Fs, get_X_mask, Yobs, current_cov, current_mean,
+                                                 config=config)
+        print(f"Full step    : {time.time() - ti:.3f} s")
+
+        np.random.seed(1)
+        ti = time.time()
+        mu2, sigma2, _ = em_is_gllim._em_step_IS_chunked(gllim, compute_Fs, get_X_mask, Yobs, current_cov,
+                                                         current_mean, config=one_chunk)
+        print(f"Chunked step : {time.time() - ti:.3f} s")
+        assert np.allclose(mu1, mu2)
+        assert np.allclose(sigma1, sigma2)
+
+        mu3, sigma3, _ = em_is_gllim._em_step_IS_chunked(gllim, compute_Fs, get_X_mask, Yobs, current_cov,
+                                                         current_mean, config=eight_chunks)
+        print(f"Mean with 8 chunks : {mu3} (one chunk : {mu2})")
+
+        # with one random stream per observation, samples don't depend on chunks
+        results = []
+        for chunk_size in (None, Ns, Ns // 8):
+            c = em_is_gllim.NoiseEMConfig(N_sample_IS=Ns, CHUNK_SIZE_IS=chunk_size, SAMPLING_METHOD="streams")
+            step = em_is_gllim._em_step_IS_chunked if chunk_size else em_is_gllim._em_step_IS
+            np.random.seed(1)
+            results.append(step(gllim, compute_Fs, get_X_mask, Yobs, current_cov, current_mean, config=c))
+        for mu, sigma, _ in results[1:]:
+            assert np.allclose(mu, results[0][0])
+            assert np.allclose(sigma, results[0][1])
+
+
+def test_em_step_IS_adaptive(Ns=8000, ess_target=200):
+    """Observations are sampled until their ESS reaches the target, or the maximum number of samples"""
+    print("\nTesting adaptive IS-EM step...")
+    gllim, compute_Fs, get_X_mask, Yobs = _setup_em_step()
+    config = em_is_gllim.NoiseEMConfig(N_sample_IS=Ns, ESS_TARGET=ess_target, ADAPTIVE_BATCH_IS=500)
+    ti = time.time()
+    mu, sigma, infos = em_is_gllim._em_step_IS_adaptive(gllim, compute_Fs, get_X_mask, Yobs, 0.01 * np.ones(5),
+                                                        np.zeros(5), config=config)
+    print(f"Adaptive step : {time.time() - ti:.3f} s")
+    ess, nb_samples = np.array(infos["ess"]), np.array(infos["nb_samples"])
+    assert np.all((ess >= ess_target) + (nb_samples == Ns))
+    assert np.all(nb_samples <= Ns)
+    print(f"Number of samples : {nb_samples.min()} - {nb_samples.max()} (mean {nb_samples.mean():.0f})")
+
+
+def test_concurrent_em_steps(ess_targets=(100, 300), Ns=(2000, 6000)):
+    """Concurrent IS-EM steps with their own configuration don't interfere"""
+    print("\nTesting concurrent IS-EM steps...")
+    gllim, compute_Fs, get_X_mask, Yobs = _setup_em_step()
+    configs = [em_is_gllim.NoiseEMConfig(N_sample_IS=n, ESS_TARGET=e, ADAPTIVE_BATCH_IS=500)
+               for n, e in zip(Ns, ess_targets)]
+
+    def step(config):
+        return em_is_gllim._em_step_IS_adaptive(gllim, compute_Fs, get_X_mask, Yobs, 0.01 * np.ones(5),
+                                                np.zeros(5), config=config)
+
+    em_is_gllim._start_threadsafe_pool()
+    ti = time.time()
+    with ThreadPoolExecutor(len(configs)) as executor:
+        results = list(executor.map(step, configs))
+    print(f"Concurrent steps : {time.time() - ti:.3f} s")
+    for (mu, sigma, infos), n, e in zip(results, Ns, ess_targets):
+        ess, nb_samples = np.array(infos["ess"]), np.array(infos["nb_samples"])
+        assert np.all((ess >= e) + (nb_samples == n))
+        assert np.all(nb_samples <= n)
+        assert np.isfinite(mu).all() and np.isfinite(sigma).all()
+
+
+def test_em_step_IS_recycled(Ns=2000, generations=3, iterations=5):
+    """Pooled samples are weighted by the mixture of the proposals of the pool, which keeps at most
+    RECYCLING_GENERATIONS generations. With one generation, the step matches the fresh-sample one."""
+    print("\nTesting recycled IS-EM step...")
+    gllim, compute_Fs, get_X_mask, Yobs = _setup_em_step(F=_F_linear)
+    current_cov, current_mean = 0.01 * np.ones(5), np.zeros(5)
+
+    single = em_is_gllim.NoiseEMConfig(N_sample_IS=Ns, N_sample_IS_fresh=Ns, RECYCLING_GENERATIONS=1)
+    fresh = em_is_gllim.NoiseEMConfig(N_sample_IS=Ns, CHUNK_SIZE_IS=Ns)
+    np.random.seed(2)
+    mu1, sigma1, _ = em_is_gllim._em_step_IS_recycled(em_is_gllim.SamplePool(1), gllim, compute_Fs, get_X_mask,
+                                                      Yobs, current_cov, current_mean, config=single)
+    np.random.seed(2)
+    mu2, sigma2, _ = em_is_gllim._em_step_IS_chunked(gllim, compute_Fs, get_X_mask, Yobs, current_cov,
+                                                     current_mean, config=fresh)
+    assert np.allclose(mu1, mu2)
+    assert np.allclose(sigma1, sigma2)
+
+    # a different proposal at each iteration, with more fresh samples than the top up
+    config = em_is_gllim.NoiseEMConfig(N_sample_IS=Ns, N_sample_IS_fresh=Ns // 4,
+                                       RECYCLING_GENERATIONS=generations)
+    pool = em_is_gllim.SamplePool(generations)
+    sizes = []
+    for it in range(iterations):
+        g = _fit_gllim(_F_linear, maxIter=it + 1)
+        ti = time.time()
+        mu, sigma, infos = em_is_gllim._em_step_IS_recycled(pool, g, compute_Fs, get_X_mask, Yobs, current_cov,
+                                                            current_mean, config=config)
+        print(f"Recycled step {it + 1} : {time.time() - ti:.3f} s ({infos['nb_samples']} samples)")
+        sizes.append(max(Ns // 4, Ns - sum(sizes[len(sizes) - generations + 1:])))
+        kept = sizes[-generations:]
+        assert len(pool.generations) == min(it + 1, generations)
+        assert infos["nb_samples"] == pool.nb_samples == sum(kept)
+        assert np.isfinite(mu).all() and np.isfinite(sigma).all()
+
+        # balance heuristic : q(x) = sum_g (N_g / N) q_g(x), evaluated directly on all pooled samples
+        Xs, _, _, log_qs = pool.samples()
+        proposals = [pool.generations[id_][0] for id_ in sorted(pool.generations)]
+        direct = sum(n / sum(kept) * proposal.pdf(Xs) for n, proposal in zip(kept, proposals))
+        assert np.allclose(np.exp(log_qs), direct)
+
+
+class _Context(context.abstractFunctionModel):
+    """Small context on _F, with random sampling"""
+    LABEL = "Test function"
+    XLIMS = np.array([[0, 1], [0, 1]])
+    D = 5
+
+    def _F(self, X):
+        return _F(X)
+
+    def get_X_sampling(self, N, method="random"):
+        return np.random.random_sample((N, 2))
+
+
+def test_fit_many(Nobs=30):
+    """Concurrent noise estimations with their own configuration, sharing training data"""
+    print("\nTesting concurrent noise estimations...")
+    cont = _Context()
+    nb_simulations = [0]
+    get_data_training = cont.get_data_training
+
+    def counted_get_data_training(N):
+        nb_simulations[0] += 1
+        return get_data_training(N)
+
+    cont.get_data_training = counted_get_data_training
+    Yobs1 = cont.add_noise_data(cont.F(cont.get_X_sampling(Nobs)), covariance=0.001, mean=0.1)
+    Yobs2 = cont.add_noise_data(cont.F(cont.get_X_sampling(Nobs)), covariance=0.002, mean=-0.2)
+    config1 = em_is_gllim.NoiseEMConfig(Ntrain=3000, K=10, maxIter=3, N_sample_IS=2000, CONVERGENCE_TOL=None)
+    config2 = em_is_gllim.NoiseEMConfig(Ntrain=3000, K=10, maxIter=2, N_sample_IS=2000, CHUNK_SIZE_IS=500,
+                                        CONVERGENCE_TOL=None)
+    ti = time.time()
+    history1, history2 = em_is_gllim.fit_many([dict(Yobs=Yobs1, cont=cont, config=config1),
+                                               dict(Yobs=Yobs2, cont=cont, cov_type="full", config=config2)],
+                                              max_workers=2)
+    print(f"Concurrent estimations : {time.time() - ti:.3f} s")
+    assert len(history1) == 4 and len(history2) == 3
+    assert nb_simulations[0] == 1
+    mean1, cov1, _ = history1[-1]
+    mean2, cov2, _ = history2[-1]
+    assert np.shape(cov1) == (5,) and np.shape(cov2) == (5, 5)
+    assert np.isfinite(cov1).all() and np.isfinite(cov2).all()
+    assert np.all(np.array(mean1) > 0) and np.all(np.array(mean2) < 0)
+
+
+def test_noise_GD_index(N=100000, Nobs=500, D=10):
+    """Nearest images found with the KD-tree against brute force"""
+    print("\nTesting indexed nearest images...")
+    Ytrain = np.random.random_sample((N, D))
+    Yobs = np.random.random_sample((Nobs, D)) + 0.05
+    b = 0.1 * np.random.random_sample(D)
+    for brute, indexed in [(noise_GD.J, noise_GD.J_index), (noise_GD.dJ, noise_GD.dJ_index),
+                           (noise_GD.sigma_estimator_diag, noise_GD.sigma_estimator_diag_index),
+                           (noise_GD.sigma_estimator_full, noise_GD.sigma_estimator_full_index)]:
+        ti = time.time()
+        r1 = brute(b, Ytrain, Yobs)
+        t1 = time.time() - ti
+        index = noise_GD.ImageIndex(Ytrain)  # no cached search
+        ti = time.time()
+        r2 = indexed(b, index, Yobs)
+        print(f"{brute.__name__} : brute force {t1:.3f} s, KD-tree {time.time() - ti:.3f} s")
+        assert np.allclose(r1, r2)
+
+
+def test_noise_GD_cache(N=100000, Nobs=500, D=10, steps=50):
+    """Cached nearest images (checked only near Voronoi boundaries) against fresh searches"""
+    print("\nTesting cached nearest images...")
+    Ytrain = np.random.random_sample((N, D))
+    Yobs = np.random.random_sample((Nobs, D))
+    index = noise_GD.ImageIndex(Ytrain)
+    b = np.zeros(D)
+    for _ in range(steps):
+        b = b + 0.001 * np.random.randn(D)
+        _, n_min = index.tree.query(Yobs - b)
+        assert np.all(index.nearest(b, Yobs) == n_min)
+    print(f"Searches : {index.nb_searches}, reused : {index.nb_reused}")
+
+
+def test_noise_GD_lbfgs(N=50000, Nobs=300, offset=0.1):
+    """L-BFGS decreases J on a single training generation ; the linear case keeps the line search"""
+    print("\nTesting L-BFGS noise mean estimation...")
+    nb_generations = [0]
+
+    def Ytrain_gen():
+        nb_generations[0] += 1
+        return _F(np.random.random_sample((N, 2)))
+
+    Yobs = _F(np.random.random_sample((Nobs, 2))) + offset
+    fitter = noise_GD.GradientDescentGeneral(Yobs, "diag", Ytrain_gen)
+    ti = time.time()
+    history = fitter.run_lbfgs()
+    print(f"L-BFGS : {time.time() - ti:.3f} s, {len(history) - 1} iterations, evaluations {fitter.counts}")
+    Js = [J for _, _, J in history]
+    assert Js[-1] < Js[0]
+    assert nb_generations[0] == 1
+    assert fitter.counts["nb_reused"] > 0
+
+    linear = noise_GD.GradientDescentLinear(np.random.random_sample((Nobs, 5)), "diag", _F_MATRIX)
+    linear.run()
+    assert not hasattr(linear, "counts")  # counts are only set by run_lbfgs
+
+
 if __name__ == '__main__':
     test_mu_step_diag(100,2000)
     test_mu_step_full(100,2000)
+    test_mu_step_IS()
+    test_em_step_IS_chunked()
+    test_em_step_IS_adaptive()
+    test_em_step_IS_recycled()
+    test_concurrent_em_steps()
+    test_fit_many()
+    test_noise_GD_index()
+    test_noise_GD_cache()
+    test_noise_GD_lbfgs()
@@ -0,0 +1,110 @@
+import time
+
+import numpy as np
+
+from Core import probas_helper
+
+
+def _random_covs(K, L):
+    covs = []
+    for k in range(K):
+        T = np.tril(np.random.random_sample((L, L))) + np.eye(L)
+        covs.append(np.dot(T, T.T))
+    return np.array(covs)
+
+
+def test_mixture_density(NX=100000, K=40, L=4, repeat=5):
+    """Compare MixtureDensity (factorised once) with densite_melange"""
+    print("\nTesting MixtureDensity...")
+    weights = np.random.random_sample(K)
+    weights /= weights.sum()
+    means = np.random.random_sample((K, L)) * 3
+    covs = _random_covs(K, L)
+    x_points = np.random.random_sample((NX, L)) * 3
+
+    probas_helper.densite_melange(x_points[:10], weights, means, covs)  # compiling
+    probas_helper.MixtureDensity(weights, means, covs).pdf(x_points[:10])
+
+    ti = time.time()
+    for _ in range(repeat):
+        d1 = probas_helper.densite_melange(x_points, weights, means, covs)
+    print(f"densite_melange : {time.time() - ti:.3f} s")
+
+    ti = time.time()
+    mixture = probas_helper.MixtureDensity(weights, means, covs)
+    for _ in range(repeat):
+        d2 = mixture.pdf(x_points)
+    print(f"MixtureDensity  : {time.time() - ti:.3f} s")
+
+    assert np.allclose(d1, d2)
+    dets = np.sqrt(np.linalg.det(covs))
+    assert np.allclose(mixture.component_heights(), weights / dets)
+    mean, cov = mixture.mean_cov()
+    assert np.allclose(mean, weights.dot(means))
+
+
+def test_mean_cov_melange(N=100000, K=40, L=4):
+    """Compare parallel mixture mean / covariance with einsum formulas"""
+    print("\nTesting mean_cov_melange...")
+    weightss = np.random.random_sample((N, K))
+    weightss /= weightss.sum(axis=1, keepdims=True)
+    meanss = np.random.random_sample((N, K, L)) * 3
+    covs = _random_covs(K, L)
+
+    probas_helper.mean_cov_melange(weightss[:10], meanss[:10], covs)  # compiling
+    out_mean, out_cov = np.empty((N, L)), np.empty((N, L, L))
+    ti = time.time()
+    mean, cov = probas_helper.mean_cov_melange(weightss, meanss, covs, out_mean=out_mean, out_cov=out_cov)
+    print(f"Parallel : {time.time() - ti:.3f} s")
+
+    ti = time.time()
+    mean_ref = np.einsum("nk,nkl->nl", weightss, meanss)
+    diff = meanss - mean_ref[:, None, :]
+    between_ref = np.einsum("nk,nki,nkj->nij", weightss, diff, diff)
+    within_ref = np.einsum("nk,kij->nij", weightss, covs)
+    print(f"Einsum   : {time.time() - ti:.3f} s")
+
+    assert mean is out_mean and cov is out_cov
+    assert np.allclose(mean, mean_ref)
+    assert np.allclose(cov, within_ref + between_ref)
+
+    _, within, between = probas_helper.mean_cov_melange_decomposed(weightss, meanss, covs)
+    assert np.allclose(within, within_ref)
+    assert np.allclose(between, between_ref)
+
+    covss = np.array([covs] * 3) * np.arange(1, 4)[:, None, None, None]
+    _, cov = probas_helper.mean_cov_melange(weightss[:3], meanss[:3], covss)
+    assert np.allclose(cov, np.einsum("nk,nkij->nij", weightss[:3], covss) + between_ref[:3])
+
+
+def test_conditional_logpdf(N=500, NX=2000, K=40, L=4):
+    """Compare blocked log-space kernel with densite_melange, per series points"""
+    print("\nTesting ConditionalMixture.logpdf...")
+    weightss = np.random.random_sample((N, K))
+    weightss /= weightss.sum(axis=1, keepdims=True)
+    meanss = np.random.random_sample((N, K, L)) * 3
+    covs = _random_covs(K, L)
+    Xs = np.random.random_sample((N, NX, L)) * 3
+
+    probas_helper.densite_melange(Xs[0, :10], weightss[0], meanss[0], covs)  # compiling
+    probas_helper.ConditionalMixture(weightss[:2], meanss[:2], covs).logpdf(Xs[:2, :10])
+
+    ti = time.time()
+    d1 = np.array([probas_helper.densite_melange(X, w, m, covs) for X, w, m in zip(Xs, weightss, meanss)])
+    print(f"densite_melange     : {time.time() - ti:.3f} s")
+
+    ti = time.time()
+    d2 = probas_helper.ConditionalMixture(weightss, meanss, covs).logpdf(Xs)
+    print(f"Blocked log kernel  : {time.time() - ti:.3f} s")
+
+    assert np.allclose(np.log(d1), d2)
+
+    # far from every component, linear space underflows
+    mixture = probas_helper.MixtureDensity(weightss[0], meanss[0], covs * 1e-4)
+    assert np.all(np.isfinite(mixture.logpdf(np.full((3, L), 50.))))
+
+
+if __name__ == '__main__':
+    test_mixture_density()
+    test_mean_cov_melange()
+    test_conditional_logpdf()
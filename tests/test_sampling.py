@@ -0,0 +1,151 @@
+import time
+import warnings
+
+import numpy as np
+
+from Core import cython, probas_helper
+
+
+def _random_mixtures(N, K, L):
+    T = np.tril(np.ones((L, L))) * 0.456
+    cov = np.dot(T, T.T) + np.eye(L)
+    covs = np.array([cov * (k + 1) for k in range(K)])
+    weightss = np.random.random_sample((N, K))
+    weightss /= weightss.sum(axis=1, keepdims=True)
+    meanss = np.random.random_sample((N, K, L)) * 12.2
+    return meanss, weightss, covs
+
+
+def test_streams_reproducible(N=200, K=40, L=5, size=10000, chunk_size=3000):
+    """Same seed gives same samples, whatever threads and chunks"""
+    print("\nTesting GMM_sampling_streams...")
+    meanss, weightss, covs = _random_mixtures(N, K, L)
+
+    ti = time.time()
+    s1 = probas_helper.GMM_sampling_streams(meanss, weightss, covs, size, seed=4)
+    print(f"Streams (all threads) : {time.time() - ti:.3f} s")
+
+    ti = time.time()
+    s2 = probas_helper.GMM_sampling_streams(meanss, weightss, covs, size, seed=4, num_threads=1)
+    print(f"Streams (1 thread)    : {time.time() - ti:.3f} s")
+
+    ti = time.time()
+    s3 = np.concatenate(list(probas_helper.GMM_sampling_chunks(meanss, weightss, covs, size, chunk_size=chunk_size,
+                                                               seed=4)), axis=1)
+    print(f"Streams (chunks)      : {time.time() - ti:.3f} s")
+
+    ti = time.time()
+    probas_helper.GMM_sampling(meanss, weightss, covs, size)
+    print(f"GMM_sampling          : {time.time() - ti:.3f} s")
+
+    assert np.array_equal(s1, s2)
+    assert np.array_equal(s1, s3)
+
+    s4 = probas_helper.GMM_sampling_streams(meanss, weightss, covs, size, seed=5)
+    assert not np.allclose(s1, s4)
+
+
+def test_streams_moments(K=3, L=2, size=400000):
+    """Empirical mean and covariance match the mixture ones"""
+    meanss, weightss, covs = _random_mixtures(2, K, L)
+    covss = np.array([covs, covs * 0.5])
+    s = probas_helper.GMM_sampling_streams(meanss, weightss, covss, size, seed=0)
+    for n in range(2):
+        mean, cov = probas_helper.mean_cov_melange(weightss[n:n + 1], meanss[n:n + 1], covss[n])
+        assert np.allclose(s[n].mean(axis=0), mean[0], atol=0.05)
+        assert np.allclose(np.cov(s[n].T), cov[0], rtol=0.05, atol=0.05)
+
+
+def test_sampling_Covs(N=500, K=40, L=5, size=2000):
+    """Compare per-observation covariances sampling with a numpy version"""
+    print("\nTesting _GMM_sampling_Covs...")
+    meanss, weightss, covs = _random_mixtures(N, K, L)
+    covss = covs[None, :, :, :] * (np.random.random_sample(N) + 0.5)[:, None, None, None]
+    clusters_list = np.random.randint(0, K, (N, size))
+    alea = np.random.multivariate_normal(np.zeros(L), np.eye(L), size)
+
+    ti = time.time()
+    chols = np.linalg.cholesky(covss)
+    s1 = np.einsum("nsij,sj->nsi", chols[np.arange(N)[:, None], clusters_list], alea) \
+         + meanss[np.arange(N)[:, None], clusters_list]
+    print(f"Numpy  : {time.time() - ti:.3f} s")
+
+    ti = time.time()
+    out = np.empty((N, size, L))
+    s2 = probas_helper._GMM_sampling_Covs(meanss, clusters_list, covss, alea, out=out)
+    print(f"Cython : {time.time() - ti:.3f} s")
+
+    assert s2 is out
+    assert np.allclose(s1, s2)
+
+
+def test_alias_sampling(N=200, K=500, size=20000):
+    """Alias tables and linear scan must follow the same law"""
+    print("\nTesting alias sampling...")
+    weightss = np.random.random_sample((N, K)) ** 4
+    weightss /= weightss.sum(axis=1, keepdims=True)
+
+    ti = time.time()
+    c1 = cython.multinomial_sampling_cython(weightss, size)
+    print(f"Linear scan : {time.time() - ti:.3f} s")
+
+    ti = time.time()
+    probs, aliases = cython.alias_tables(weightss)
+    c2 = cython.alias_sampling(probs, aliases, size)
+    print(f"Alias       : {time.time() - ti:.3f} s")
+
+    # each table must give back the weights
+    table_weights = probs.copy()
+    np.add.at(table_weights, (np.arange(N)[:, None], aliases), 1 - probs)
+    assert np.allclose(table_weights / K, weightss)
+
+    f1 = np.array([np.bincount(c, minlength=K) for c in c1]) / size
+    f2 = np.array([np.bincount(c, minlength=K) for c in c2]) / size
+    assert np.allclose(f1, weightss, atol=0.01)
+    assert np.allclose(f2, weightss, atol=0.01)
+
+
+
+def test_qmc_variance(N=50, K=10, L=3, size=1024, repeat=20):
+    """Randomised QMC estimator of the mixture mean must be unbiased, with lower variance than MC"""
+    print("\nTesting GMM_sampling_qmc...")
+    meanss, weightss, covs = _random_mixtures(N, K, L)
+    mean, _ = probas_helper.mean_cov_melange(weightss, meanss, covs)
+
+    ti = time.time()
+    est_mc = np.array([probas_helper.GMM_sampling(meanss, weightss, covs, size).mean(axis=1) for _ in range(repeat)])
+    print(f"MC  : {time.time() - ti:.3f} s")
+    ti = time.time()
+    est_qmc = np.array([probas_helper.GMM_sampling_qmc(meanss, weightss, covs, size, seed=i).mean(axis=1)
+                        for i in range(repeat)])
+    print(f"QMC : {time.time() - ti:.3f} s")
+
+    var_mc, var_qmc = est_mc.var(axis=0).mean(), est_qmc.var(axis=0).mean()
+    print(f"Variance of mean estimator : MC {var_mc:.2e}, QMC {var_qmc:.2e}")
+    assert np.allclose(est_qmc.mean(axis=0), mean, atol=0.1)
+    assert var_qmc < var_mc / 5
+
+
+def test_qmc_size(N=5, K=4, L=2, size=1000):
+    """Sizes which are not a power of 2 take the first points of the next net, with a single warning"""
+    print("\nTesting GMM_sampling_qmc size...")
+    meanss, weightss, covs = _random_mixtures(N, K, L)
+    full = probas_helper.GMM_sampling_qmc(meanss, weightss, covs, 1024, seed=3)
+    probas_helper._qmc_size_warned = False
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        s1 = probas_helper.GMM_sampling_qmc(meanss, weightss, covs, size, seed=3)
+        s2 = probas_helper.GMM_sampling_qmc(meanss, weightss, covs, size - 1, seed=3)
+    assert len(caught) == 1
+    assert s1.shape == (N, size, L)
+    assert np.allclose(s1, full[:, :size])
+    assert np.allclose(s2, full[:, :size - 1])
+
+
+if __name__ == '__main__':
+    test_streams_reproducible()
+    test_streams_moments()
+    test_sampling_Covs()
+    test_alias_sampling()
+    test_qmc_variance()
+    test_qmc_size()
@@ -10,6 +10,62 @@ import os
 import scipy.io
 import numpy as np
 
+INFERENCE_MAGIC = b"GLLIMINF"
+INFERENCE_VERSION = 1
+INFERENCE_ALIGNMENT = 64
+"""Arrays offsets in inference files are multiples of this (bytes)"""
+
+_INFERENCE_HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("nb_arrays", "<u4")])
+_INFERENCE_ENTRY = np.dtype([("name", "S32"), ("ndim", "<u4"), ("shape", "<u8", (4,)), ("offset", "<u8")])
+
+
+def _aligned(offset):
+    return - (- offset // INFERENCE_ALIGNMENT) * INFERENCE_ALIGNMENT
+
+
+def save_inference_file(path, arrays):
+    """Writes arrays (dict name -> float array, at most 4 dimensions) in a versionned binary file.
+    Layout : header, table of entries, then little-endian float64 data, each array aligned on INFERENCE_ALIGNMENT."""
+    header = np.zeros(1, dtype=_INFERENCE_HEADER)
+    header["magic"], header["version"], header["nb_arrays"] = INFERENCE_MAGIC, INFERENCE_VERSION, len(arrays)
+    entries = np.zeros(len(arrays), dtype=_INFERENCE_ENTRY)
+    datas = [np.ascontiguousarray(a, dtype="<f8") for a in arrays.values()]
+    offset = _aligned(_INFERENCE_HEADER.itemsize + _INFERENCE_ENTRY.itemsize * len(arrays))
+    for entry, name, data in zip(entries, arrays.keys(), datas):
+        if len(name.encode("ascii")) > _INFERENCE_ENTRY["name"].itemsize:
+            raise ValueError(f"Array name {name} is too long (at most {_INFERENCE_ENTRY['name'].itemsize} bytes)")
+        if data.ndim > 4:
+            raise ValueError(f"Array {name} has more than 4 dimensions")
+        entry["name"], entry["ndim"], entry["offset"] = name.encode("ascii"), data.ndim, offset
+        entry["shape"][:data.ndim] = data.shape
+        offset = _aligned(offset + data.nbytes)
+
+    with open(path, "wb") as f:
+        f.write(header.tobytes())
+        f.write(entries.tobytes())
+        for entry, data in zip(entries, datas):
+            f.seek(int(entry["offset"]))
+            f.write(data.tobytes())
+        f.truncate(offset)
+
+
+def load_inference_file(path):
+    """Inverse function of save_inference_file. Arrays are read-only views of a single memory map :
+    loading is immediate, and pages are shared between processes reading the same file."""
+    mm = np.memmap(path, dtype=np.uint8, mode="r")
+    header = np.frombuffer(mm, dtype=_INFERENCE_HEADER, count=1)[0]
+    if header["magic"] != INFERENCE_MAGIC:
+        raise ValueError(f"{path} is not a GLLiM inference file")
+    if header["version"] != INFERENCE_VERSION:
+        raise ValueError(f"Unsupported inference file version {header['version']} (expected {INFERENCE_VERSION})")
+    entries = np.frombuffer(mm, dtype=_INFERENCE_ENTRY, count=header["nb_arrays"], offset=_INFERENCE_HEADER.itemsize)
+    arrays = {}
+    for entry in entries:
+        shape = tuple(int(n) for n in entry["shape"][:entry["ndim"]])
+        arrays[entry["name"].decode("ascii")] = np.ndarray(shape, dtype="<f8", buffer=mm, offset=int(entry["offset"]))
+    return arrays
+
+
 class Archive():
     """Helps with saving and loading results"""
 
@@ -197,6 +253,21 @@ class Archive():
         logging.debug(f"\tModel parameters loaded from {filename}")
         return d
 
+    def save_gllim_inference(self, gllim):
+        """Exports the inverted gllim for inference only. See load_gllim_inference"""
+        savepath = self.get_path("model", filecategorie="inference")
+        save_inference_file(savepath, gllim.inference_parameters())
+        logging.debug(f"\tInference parameters saved in {savepath}")
+
+    def load_gllim_inference(self):
+        """Memory-maps inference parameters and returns a gllim ready for forward prediction
+        (no json parsing, no inversion)"""
+        from Core.gllim import GLLiM
+        filename = self.get_path("model", filecategorie="inference")
+        gllim = GLLiM.from_inference_parameters(load_inference_file(filename), verbose=self.verbose)
+        logging.debug(f"\tInference parameters loaded from {filename}")
+        return gllim
+
     def load_tracked_thetas(self):
         filename = self.get_path("model", with_track=True)
         with open(filename,encoding='utf8') as f:
@@ -4,13 +4,15 @@ import os
 import random
 from typing import Union
 
+import numba as nb
 import numpy as np
 import pyDOE
 import rpy2.robjects.packages
 import scipy.io
+from joblib import Parallel, delayed
 from rpy2 import robjects
 
-from hapke.cython import Hapke_cython
+from hapke.cython import Hapke_cython, GeometryPlan
 
 randtoolbox = robjects.packages.importr('randtoolbox')
 
@@ -41,6 +43,111 @@ def random_sequence_rqmc(dim, init=True, n=1):
     return(u)
 
 
+# ------------- Validity masks ------------- #
+@nb.njit(cache=True)
+def _in_bounds(x, bounds):
+    for l in range(bounds.shape[0]):
+        if not (bounds[l, 0] <= x[l] <= bounds[l, 1]):  # False for nan
+            return False
+    return True
+
+
+@nb.njit(parallel=True, cache=True)
+def _fill_valid_mask(X, bounds, valid, out):
+    for n in nb.prange(X.shape[0]):
+        out[n] = _in_bounds(X[n], bounds) == valid
+
+
+@nb.njit(parallel=True, cache=True)
+def _fill_ragged_valid_mask(X, offsets, bounds, valid, out, counts):
+    for s in nb.prange(offsets.shape[0] - 1):
+        count = 0
+        for n in range(offsets[s], offsets[s + 1]):
+            ok = _in_bounds(X[n], bounds)
+            out[n] = ok == valid
+            count += ok
+        counts[s] = count
+
+
+def valid_mask(X, bounds, invalid=False, dtype=bool):
+    """Mask of samples of X (shape (..., L), typically (N,L) or (N,Ns,L)) lying in bounds (shape (L,2)).
+    bounds None means every value is valid. If invalid, invalid samples are marked instead.
+    Returns shape X.shape[:-1]"""
+    if bounds is None:
+        return (np.zeros if invalid else np.ones)(X.shape[:-1], dtype=dtype)
+    X = np.ascontiguousarray(X, dtype=float)
+    out = np.empty(X.shape[:-1], dtype=dtype)
+    _fill_valid_mask(X.reshape((-1, X.shape[-1])), np.asarray(bounds, dtype=float), not invalid, out.reshape(-1))
+    return out
+
+
+def pack_samples(Xs):
+    """Packs a list of samples sets (shapes (n_i,L)) in one array (shape (sum n_i, L)).
+    Set i is X[offsets[i]:offsets[i+1]]"""
+    L = next((x.shape[1] for x in Xs if len(x) > 0), 0)
+    offsets = np.zeros(len(Xs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(x) for x in Xs])
+    if offsets[-1] == 0:
+        return np.empty((0, L)), offsets
+    return np.concatenate([np.reshape(x, (len(x), L)) for x in Xs]), offsets
+
+
+def ragged_valid_mask(X, offsets, bounds, invalid=False, dtype=bool):
+    """Same as valid_mask, for packed samples sets (see pack_samples).
+    Returns the packed mask (shape sum n_i) and the number of valid samples of each set"""
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if bounds is None:
+        return valid_mask(X, None, invalid=invalid, dtype=dtype), np.diff(offsets)
+    X = np.ascontiguousarray(X, dtype=float)
+    out = np.empty(X.shape[0], dtype=dtype)
+    counts = np.empty(len(offsets) - 1, dtype=np.int64)
+    _fill_ragged_valid_mask(X, offsets, np.asarray(bounds, dtype=float), not invalid, out, counts)
+    return out, counts
+
+
+# ------------- Batched evaluation ------------- #
+F_BATCH_SIZE = 50000
+"""Number of samples by F call in batched evaluations"""
+
+
+def batched_evaluation(F, X, mask=None, D=None, batch_size=None, n_jobs=1):
+    """Evaluates F on samples X of shape (..., L) (typically (N,Ns,L)), or on a list of samples sets (shapes (n_i,L)).
+    Samples where mask (shape X.shape[:-1], or list of masks) is non zero are skipped, and their values set to 0.
+    Note that such a mask flags invalid samples, as X_mask(X, invalid=True) : it is the negation of is_X_valid.
+    In a list of masks, None skips no sample (is_X_valid returns None for empty sets).
+    F is called on contiguous batches of batch_size samples, in n_jobs threads.
+    D is the dimension of F values, only needed if every sample is skipped.
+    Returns shape (..., D), or a list of arrays (shapes (n_i,D)) for a list input"""
+    batch_size = batch_size or F_BATCH_SIZE
+    if type(X) is list:
+        X = [np.asarray(x) for x in X]
+        flat, offsets = pack_samples(X)
+        if mask is not None:
+            mask, _ = pack_samples([np.zeros((len(x), 1), dtype=bool) if m is None else np.reshape(m, (-1, 1))
+                                    for x, m in zip(X, mask)])
+        Y = batched_evaluation(F, flat, mask=mask, D=D, batch_size=batch_size, n_jobs=n_jobs)
+        return np.split(Y, offsets[1:-1])
+
+    X = np.asarray(X)
+    shape = X.shape[:-1]
+    flat = np.ascontiguousarray(X.reshape((int(np.prod(shape)), X.shape[-1])))
+    index = np.arange(len(flat)) if mask is None else np.flatnonzero(np.reshape(mask, -1) == 0)
+    batches = [index[start:start + batch_size] for start in range(0, len(index), batch_size)]
+    if n_jobs == 1 or len(batches) <= 1:
+        results = [F(flat[batch]) for batch in batches]
+    else:
+        results = Parallel(n_jobs=n_jobs, prefer="threads")(delayed(F)(flat[batch]) for batch in batches)
+
+    D = results[0].shape[1] if results else (D or 0)
+    Y = np.zeros((len(flat), D))
+    if mask is None and len(results) == 1:
+        Y[:] = results[0]
+    else:
+        for batch, Ybatch in zip(batches, results):
+            Y[batch] = Ybatch
+    return Y.reshape(shape + (D,))
+
+
 def _xlims_to_P(xlims):
     """Return latex code for definition domain defined by xlims"""
     return "\\times".join(f""" \left[ {x[0]} , {x[1]} \\right] """ for x in xlims)
@@ -85,6 +192,10 @@ class abstractFunctionModel:
         assert (not check) or np.isfinite(Y).all()
         return Y
 
+    def F_batched(self, X, mask=None, batch_size=None, n_jobs=1):
+        """F on many samples (shape (..., L) or list of samples sets). See batched_evaluation"""
+        return batched_evaluation(self.F, X, mask=mask, D=self.D, batch_size=batch_size, n_jobs=n_jobs)
+
     def _prepare_X(self, X):
         return self.to_X_physique(X)
 
@@ -219,15 +330,30 @@ class abstractFunctionModel:
         return self.get_X_sampling(K,method="sobol")
 
 
+    @property
+    def X_bounds(self):
+        """Bounds (shape (L,2)) of theoretically correct X values (mathematical space).
+        None means every value is correct. Contexts with custom bounds should override it."""
+        return np.array([[0., 1.]] * self.L)
+
+    def X_mask(self, X, invalid=False, dtype=bool):
+        """Mask of theoretically correct (or incorrect if invalid) values of X (shape (..., L)).
+        Returns shape X.shape[:-1]"""
+        return valid_mask(X, self.X_bounds, invalid=invalid, dtype=dtype)
+
+    def ragged_X_mask(self, X, offsets, invalid=False, dtype=bool):
+        """Same as X_mask for packed samples sets (see pack_samples).
+        Returns the packed mask and the number of valid samples of each set"""
+        return ragged_valid_mask(X, offsets, self.X_bounds, invalid=invalid, dtype=dtype)
+
     def is_X_valid(self,X : Union[np.ndarray, list]):
-        """Returns a mask of theoretically correct values"""
+        """Returns a mask of theoretically correct values.
+        For a list of samples sets, returns a list of masks (None for empty sets)"""
         if type(X) is list:
-            mask = [(np.all((0 <= x) * (x <= 1), axis=1) if x.shape[0] > 0 else None) for x in X]
-        elif X.ndim == 3:
-            mask = np.array([(np.all((0 <= x) * (x <= 1), axis=1) if x.shape[0] > 0 else None) for x in X])
-        else:
-            mask = np.array([np.all((0 <= x) * (x <= 1)) for x in X])
-        return mask
+            packed, offsets = pack_samples(X)
+            mask, _ = self.ragged_X_mask(packed, offsets)
+            return [(m if len(m) > 0 else None) for m in np.split(mask, offsets[1:-1])]
+        return self.X_mask(np.asarray(X))
 
     def is_Y_valid(self,Y):
         """By default,accepts all values"""
@@ -402,6 +528,9 @@ class abstractHapkeModel(abstractFunctionModel):
 
     LABEL = "$F_{hapke}$"
 
+    NUM_THREADS = 0
+    """Threads used by Hapke evaluation (0 for all available cores, 1 for sequential)"""
+
     def __init__(self, partiel=None):
         super().__init__(partiel)
         self.geometries = None # emergence, incidence, azimuth
@@ -415,6 +544,16 @@ class abstractHapkeModel(abstractFunctionModel):
     def D(self):
         return self.geometries.shape[1]
 
+    @property
+    def geometry_plan(self):
+        """Geometry-only terms of Hapke model, computed again only when geometries change"""
+        if getattr(self, "_plan_geometries", None) is not self.geometries:
+            t, t0, p = self.geometries
+            self._geometry_plan = GeometryPlan(np.array(t0, dtype=np.double), np.array(t, dtype=np.double),
+                                               np.array(p, dtype=np.double))
+            self._plan_geometries = self.geometries
+        return self._geometry_plan
+
     def _load_context_data(self):
         """Setup context to be able to compute F(X).
         Here, needs to set up geometries as array of shape (3,_ )"""
@@ -457,7 +596,8 @@ class abstractHapkeModel(abstractFunctionModel):
         t, t0, p = self.geometries
         args = (np.array(Xfull[:, i], dtype=np.double) for i in range(Xfull.shape[1]))
         Y = Hapke_cython(np.array(t0, dtype=np.double), np.array(t, dtype=np.double),
-                         np.array(p, dtype=np.double), *args)
+                         np.array(p, dtype=np.double), *args, num_threads=self.NUM_THREADS,
+                         plan=self.geometry_plan)
         assert (not check) or np.isfinite(Y).all()
         return Y
 
@@ -891,8 +1031,9 @@ class LinearFunction(abstractFunctionModel):
         """Maps mathematical X valued to physical ones"""
         return X
 
-    def is_X_valid(self, X):
-        return np.ones(X.shape[:-1], dtype=bool)
+    @property
+    def X_bounds(self):
+        return None
 
 
 
@@ -241,16 +241,7 @@ class Experience():
 
     def compute_FXs(self, Xs, ref_function=None):
         ref_function = ref_function or self.context.F
-        N = len(Xs)
-        cumlenths = np.cumsum([len(X) for X in Xs])
-        Xglue = np.array([x for X in Xs for x in X])
-        Yall = ref_function(Xglue)
-        Ys = []
-        for i in range(N):
-            debut = 0 if i == 0 else cumlenths[i - 1]
-            fin = cumlenths[i]
-            Ys.append(Yall[debut:fin])
-        return Ys
+        return context.batched_evaluation(ref_function, list(Xs), D=self.context.D)
 
     def best_Y_prediction(self, gllim: GLLiM, Y, ref_function=None):
         """Compute modal prediction then choose x for which F(x) is closer to y"""
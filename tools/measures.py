@@ -430,8 +430,7 @@ class VisualisationMesures(Mesures):
         base_title = "Prior density of {},{}"
         modal_pred_full = None
         if with_modal:
-            h, w, c, _ = zip(*(dominant_components(gllim.pikList,
-                                                   gllim.ckList, gllim.GammakList)[0:30]))
+            h, w, c, _ = zip(*(dominant_components(gllim.X_mixture)[0:30]))
             modal_pred_full = np.array(c), np.array(w), np.array(h)
 
         filename = exp.archive.get_path("figures",